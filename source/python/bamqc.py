@@ -0,0 +1,452 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  bamqc.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Single-pass BAM QC: mapping statistics, read GC content, junction annotation and read distribution
+#           computed together (same results as RSeQC bam_stat.py, read_GC.py, junction_annotation.py and
+#           read_distribution.py), with the genome split by region across worker processes
+# Input:    sorted, indexed BAM file, BED12 annotation
+# Output:   <prefix>_bam_qc.txt, <prefix>_bam_gc.txt, <prefix>_bam_jc.txt, <prefix>_bam_rc.txt,
+#           <prefix>.GC.xls, <prefix>.junction.xls
+#############################################################################################################
+
+import os
+import sys
+import math
+import fcntl
+import pickle
+import bisect
+import logging
+import argparse
+import importlib.util
+import multiprocessing
+from collections import Counter
+import checksum
+
+## Minimum mapping quality of a unique read (RSeQC default)
+Q_CUT = 30
+
+## Shorter junctions are filtered (RSeQC default)
+MIN_INTRON = 50
+
+## The genome is split into about this many regions per worker
+REGIONS_PER_THREAD = 4
+
+## Bump when the layout of the annotation index changes
+INDEX_VERSION = 1
+
+## read_distribution rows: (label, region)
+RD_ROWS = [("CDS_Exons", 'cds_exon'), ("5'UTR_Exons", 'utr_5'), ("3'UTR_Exons", 'utr_3'), ("Introns", 'intron'),
+           ("TSS_up_1kb", 'upstream_1kb'), ("TSS_up_5kb", 'upstream_5kb'), ("TSS_up_10kb", 'upstream_10kb'),
+           ("TES_down_1kb", 'downstream_1kb'), ("TES_down_5kb", 'downstream_5kb'), ("TES_down_10kb", 'downstream_10kb')]
+
+SEPARATOR = '=' * 67
+
+
+
+## Can the engine run here? (needs pysam for reading BAM files and RSeQC's qcmodule for the annotation regions)
+def available():
+    return(all([importlib.util.find_spec(x) is not None for x in ['pysam', 'qcmodule']]))
+
+
+
+###########################
+## Annotation index
+###########################
+
+## Point lookup structure for a set of intervals: chromosome -> (starts, ends) of disjoint open intervals
+## (a position p lies in an interval when start < p < end, like bx-python's Intersecter.find(p, p))
+def pointIndex(intervals):
+    by_chrom = {}
+    for x in intervals:
+        by_chrom.setdefault(str(x[0]).upper(), []).append((int(x[1]), int(x[2])))
+    res = {}
+    for chrom, x in by_chrom.items():
+        starts, ends = [], []
+        for start, end in sorted(x):
+            if len(ends) > 0 and start < ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        res[chrom] = (starts, ends)
+    return(res)
+
+
+
+## Does a point index cover position p of chrom?
+def covers(index, chrom, p):
+    if chrom not in index:
+        return(False)
+    starts, ends = index[chrom]
+    i = bisect.bisect_left(starts, p) - 1
+    return(i >= 0 and p < ends[i])
+
+
+
+## Build the annotation index of a BED12 file: read_distribution regions (built with RSeQC's own BED
+## functions, so region boundaries match read_distribution.py) and known intron starts/ends
+def buildIndex(bed_file):
+    from qcmodule import BED
+    bed = BED.ParseBED(bed_file)
+    cds = BED.unionBed3(bed.getCDSExon())
+    regions = {'cds_exon': cds,
+               'utr_5': BED.subtractBed3(BED.unionBed3(bed.getUTR(utr=5)), cds),
+               'utr_3': BED.subtractBed3(BED.unionBed3(bed.getUTR(utr=3)), cds)}
+    intron = BED.unionBed3(bed.getIntron())
+    for x in ['cds_exon', 'utr_5', 'utr_3']:
+        intron = BED.subtractBed3(intron, regions[x])
+    regions['intron'] = intron
+    for direction, name in [('up', 'upstream'), ('down', 'downstream')]:
+        for kb in [1, 5, 10]:
+            x = BED.unionBed3(bed.getIntergenic(direction=direction, size=kb * 1000))
+            for y in ['cds_exon', 'utr_5', 'utr_3', 'intron']:
+                x = BED.subtractBed3(x, regions[y])
+            regions['%s_%skb' % (name, kb)] = x
+
+    ## Known introns, as read by junction_annotation.py
+    intron_starts, intron_ends = {}, {}
+    with open(bed_file) as f:
+        for line in f:
+            fields = line.split()
+            if line.startswith(('#', 'track', 'browser')) or len(fields) < 12:
+                continue
+            chrom, tx_start = fields[0].upper(), int(fields[1])
+            starts = [tx_start + int(x) for x in fields[11].rstrip(',\n').split(',')]
+            ends = [x + int(y) for x, y in zip(starts, fields[10].rstrip(',\n').split(','))]
+            intron_starts.setdefault(chrom, set()).update(ends[:-1])
+            intron_ends.setdefault(chrom, set()).update(starts[1:])
+
+    return({'version': INDEX_VERSION,
+            'regions': dict([(x, pointIndex(y)) for x, y in regions.items()]),
+            'bases': dict([(x, sum([int(i[2]) - int(i[1]) for i in y])) for x, y in regions.items()]),
+            'intron_starts': intron_starts, 'intron_ends': intron_ends})
+
+
+
+## Load the annotation index of a BED file, building it once and keeping it next to the BED file
+## (<bed>.qcindex, rebuilt when the BED file changes; concurrent jobs wait for a single build)
+def loadIndex(bed_file):
+    index_file = bed_file + '.qcindex'
+    key = list(checksum.fileKey(bed_file))
+    with open(index_file + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(index_file):
+            with open(index_file, 'rb') as f:
+                index = pickle.load(f)
+            if index.get('version') == INDEX_VERSION and index.get('key') == key:
+                return(index)
+        logging.info('Building annotation index %s' % (index_file))
+        index = buildIndex(bed_file)
+        index['key'] = key
+        with open(index_file + '.tmp', 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(index_file + '.tmp', index_file)
+    return(index)
+
+
+
+###########################
+## Single pass over a region
+###########################
+
+## Introns of an alignment, as bam_cigar.fetch_intron: [(start, end)]
+def introns(pos, cigar):
+    res = []
+    for op, size in cigar:
+        if op == 3:
+            res.append((pos, pos + size))
+        if op in (0, 2, 3):
+            pos += size
+    return(res)
+
+
+
+## Aligned blocks of an alignment, as bam_cigar.fetch_exon: [(start, end)]
+def exons(pos, cigar):
+    res = []
+    for op, size in cigar:
+        if op == 0:
+            res.append((pos, pos + size))
+        if op in (0, 2, 3, 4):
+            pos += size
+    return(res)
+
+
+
+## Assign an aligned block to a read_distribution group by its midpoint (read_distribution.py precedence)
+def assignTag(regions, chrom, mid, rd):
+    hit = lambda x: covers(regions[x], chrom, mid)
+    if hit('cds_exon'):
+        rd['cds_exon'] += 1
+        return
+    utr_5, utr_3 = hit('utr_5'), hit('utr_3')
+    if utr_5 or utr_3:
+        rd['unassigned' if utr_5 and utr_3 else 'utr_5' if utr_5 else 'utr_3'] += 1
+        return
+    if hit('intron'):
+        rd['intron'] += 1
+        return
+    up, down = hit('upstream_10kb'), hit('downstream_10kb')
+    if up and down:
+        rd['unassigned'] += 1
+        return
+    for name, flank in [('upstream', up), ('downstream', down)]:
+        if hit(name + '_1kb'):
+            rd.update([name + '_1kb', name + '_5kb', name + '_10kb'])
+            return
+        if hit(name + '_5kb'):
+            rd.update([name + '_5kb', name + '_10kb'])
+            return
+        if flank:
+            rd[name + '_10kb'] += 1
+            return
+    rd['unassigned'] += 1
+
+
+
+## Annotation index of a worker process
+_index = None
+
+def initWorker(bed_file):
+    global _index
+    _index = loadIndex(bed_file)
+
+
+
+## Scan the reads starting in one region (contig '*' = reads without a position)
+## Returns Counters: mapping statistics, GC percent histogram, junction events, junction classes, read distribution
+def scanRegion(args):
+    import pysam
+    bam_file, contig, start, end, read_dist = args
+    stat, gc, events, junctions, rd = Counter(), Counter(), Counter(), Counter(), Counter()
+    regions, intron_starts, intron_ends = _index['regions'], _index['intron_starts'], _index['intron_ends']
+    with pysam.AlignmentFile(bam_file) as bam:
+        reads = bam.fetch(contig) if contig == '*' else bam.fetch(contig, start, end)
+        chrom = contig.upper()
+        for read in reads:
+            if contig != '*' and read.reference_start < start:
+                continue
+            flag, mapq, cigar = read.flag, read.mapping_quality, read.cigartuples or []
+            qcfail, dup, secondary, unmapped = flag & 0x200, flag & 0x400, flag & 0x100, flag & 0x4
+
+            ## bam_stat.py
+            stat['total'] += 1
+            if qcfail:
+                stat['qc_failed'] += 1
+            elif dup:
+                stat['duplicate'] += 1
+            elif secondary:
+                stat['non_primary'] += 1
+            elif unmapped:
+                stat['unmapped'] += 1
+            elif mapq < Q_CUT:
+                stat['non_unique'] += 1
+            else:
+                stat['unique'] += 1
+                stat['read_1'] += flag & 0x40 > 0
+                stat['read_2'] += flag & 0x80 > 0
+                stat['minus' if flag & 0x10 else 'plus'] += 1
+                stat['spliced' if any([op == 3 for op, size in cigar]) else 'non_spliced'] += 1
+                if flag & 0x2:
+                    stat['proper_pairs'] += 1
+                    stat['proper_pairs_diff_chrom'] += read.reference_id != read.next_reference_id
+            if unmapped:
+                continue
+
+            ## read_GC.py (duplicates and secondary alignments included)
+            if not qcfail and mapq >= Q_CUT and read.query_sequence:
+                seq = read.query_sequence.upper()
+                gc['%4.2f' % ((seq.count('C') + seq.count('G')) / (len(seq) + 0.0) * 100)] += 1
+            if qcfail or dup or secondary:
+                continue
+
+            ## junction_annotation.py
+            if mapq >= Q_CUT:
+                for i_st, i_end in introns(read.reference_start, cigar):
+                    junctions['total'] += 1
+                    if i_end - i_st < MIN_INTRON:
+                        junctions['filtered'] += 1
+                        continue
+                    events[(chrom, i_st, i_end)] += 1
+                    known_st, known_end = i_st in intron_starts.get(chrom, ()), i_end in intron_ends.get(chrom, ())
+                    junctions['known' if known_st and known_end else 'partial_novel' if known_st or known_end else 'novel'] += 1
+
+            ## read_distribution.py (no mapping quality cut)
+            if read_dist:
+                rd['total_reads'] += 1
+                for st, e in exons(read.reference_start, cigar):
+                    rd['total_tags'] += 1
+                    assignTag(regions, chrom, st + int((e - st) / 2), rd)
+    return(stat, gc, events, junctions, rd)
+
+
+
+## Split the genome into about n regions of similar length (contigs without reads are left out),
+## plus one for the reads without a position
+def splitRegions(bam_file, n):
+    import pysam
+    with pysam.AlignmentFile(bam_file) as bam:
+        used = set([x.contig for x in bam.get_index_statistics() if x.total > 0])
+        contigs = [(x, bam.get_reference_length(x)) for x in bam.references if x in used]
+        size = max(1, int(math.ceil(sum([x[1] for x in contigs]) / float(max(1, n)))))
+        res = [(contig, start, min(start + size, length)) for contig, length in contigs for start in range(0, length, size)]
+        if bam.nocoordinate > 0:
+            res.append(('*', 0, 0))
+    return(res)
+
+
+
+###########################
+## Reports
+###########################
+
+## R-style number (15 significant digits)
+def rNumber(x):
+    return('NA' if x is None else '%.15g' % x)
+
+
+
+## summary() of the GC percent of all reads: min, quartiles (R quantile type 7), mean, max
+def gcSummary(gc):
+    values = sorted([(float(x), n) for x, n in gc.items()])
+    total = sum([n for x, n in values])
+    if total == 0:
+        return([None] * 6)
+    cum = [0]
+    for x, n in values:
+        cum.append(cum[-1] + n)
+    at = lambda k: values[bisect.bisect_right(cum, k) - 1][0]
+    def quantile(p):
+        h = (total - 1) * p
+        lo = int(math.floor(h))
+        return(at(lo) if h == lo else (1 - (h - lo)) * at(lo) + (h - lo) * at(lo + 1))
+    mean = math.fsum([x * n for x, n in values]) / total
+    return([quantile(0), quantile(0.25), quantile(0.5), mean, quantile(0.75), quantile(1)])
+
+
+
+## bam_stat.py report
+def writeStat(stat, file):
+    rows = [('Total records:', 'total'), None, ('QC failed:', 'qc_failed'), ('Optical/PCR duplicate:', 'duplicate'),
+            ('Non primary hits', 'non_primary'), ('Unmapped reads:', 'unmapped'), ('mapq < mapq_cut (non-unique):', 'non_unique'), None,
+            ('mapq >= mapq_cut (unique):', 'unique'), ('Read-1:', 'read_1'), ('Read-2:', 'read_2'), ("Reads map to '+':", 'plus'),
+            ("Reads map to '-':", 'minus'), ('Non-splice reads:', 'non_spliced'), ('Splice reads:', 'spliced'),
+            ('Reads mapped in proper pairs:', 'proper_pairs'), ('Proper-paired reads map to different chrom:', 'proper_pairs_diff_chrom')]
+    with open(file, 'w') as out:
+        out.write('\n#==================================================\n#All numbers are READ count\n#==================================================\n\n')
+        [out.write('\n' if x is None else '%-40s%d\n' % (x[0], stat[x[1]])) for x in rows]
+
+
+
+## read_GC.py histogram and the summary row the pipeline derives from it
+def writeGc(gc, sample, xls_file, file):
+    with open(xls_file, 'w') as out:
+        out.write('GC%\tread_count\n')
+        [out.write('%s\t%s\n' % (x, n)) for x, n in gc.items()]
+    with open(file, 'w') as out:
+        out.write('\t'.join([sample] + [rNumber(x) for x in gcSummary(gc)]) + '\n')
+
+
+
+## junction_annotation.py report (its standard error) and junction table
+def writeJunctions(events, junctions, index, bed_file, xls_file, file):
+    with open(file, 'w') as out:
+        out.write('Reading reference bed file:  %s  ...  Done\nLoad BAM file ...  Done\n' % (bed_file))
+        if junctions['total'] == 0:
+            out.write('No splice junction found.\n')
+            return
+        out.write('\n%s\nTotal splicing  Events:\t%s\nKnown Splicing Events:\t%s\nPartial Novel Splicing Events:\t%s\nNovel Splicing Events:\t%s\nFiltered Splicing Events:\t%s\n'
+                  % (SEPARATOR, junctions['total'], junctions['known'], junctions['partial_novel'], junctions['novel'], junctions['filtered']))
+        known = Counter()
+        with open(xls_file, 'w') as xls:
+            xls.write('chrom\tintron_st(0-based)\tintron_end(1-based)\tread_count\tannotation\n')
+            for (chrom, i_st, i_end), n in events.items():
+                known_st, known_end = i_st in index['intron_starts'].get(chrom, ()), i_end in index['intron_ends'].get(chrom, ())
+                annotation = 'annotated' if known_st and known_end else 'partial_novel' if known_st or known_end else 'complete_novel'
+                known[annotation] += 1
+                xls.write('%s\t%s\t%s\t%s\t %s\n' % (chrom.replace('CHR', 'chr'), i_st, i_end, n, annotation))
+        out.write('\nTotal splicing  Junctions:\t%s\nKnown Splicing Junctions:\t%s\nPartial Novel Splicing Junctions:\t%s\nNovel Splicing Junctions:\t%s\n\n%s\n'
+                  % (len(events), known['annotated'], known['partial_novel'], known['complete_novel'], SEPARATOR))
+
+
+
+## read_distribution.py report
+def writeDistribution(rd, index, file):
+    with open(file, 'w') as out:
+        out.write('%-30s%d\n%-30s%d\n%-30s%d\n' % ('Total Reads', rd['total_reads'], 'Total Tags', rd['total_tags'], 'Total Assigned Tags', rd['total_tags'] - rd['unassigned']))
+        out.write('=' * 69 + '\n%-20s%-20s%-20s%-20s\n' % ('Group', 'Total_bases', 'Tag_count', 'Tags/Kb'))
+        for label, name in RD_ROWS:
+            bases = index['bases'][name]
+            out.write('%-20s%-20d%-20d%-18.2f\n' % (label, bases, rd[name], rd[name] * 1000.0 / (bases + 1)))
+        out.write('=' * 69 + '\n')
+
+
+
+###########################
+## Driver
+###########################
+
+## Run all QC metrics over a BAM file in one pass with the given number of worker processes
+## Writes the per-sample files of the RSeQC rules (the read distribution only if read_dist is set)
+def run(bam_file, bed_file, prefix, sample=None, threads=1, read_dist=True):
+    sample = sample if sample is not None else os.path.basename(prefix)
+    regions = [(bam_file,) + x + (read_dist,) for x in splitRegions(bam_file, threads * REGIONS_PER_THREAD)]
+    logging.info('BAM QC: %s, %s region(s), %s worker(s)' % (bam_file, len(regions), threads))
+    initWorker(bed_file)
+    if threads > 1 and len(regions) > 1:
+        with multiprocessing.Pool(threads, initializer=initWorker, initargs=(bed_file,)) as pool:
+            results = pool.map(scanRegion, regions, chunksize=1)
+    else:
+        results = [scanRegion(x) for x in regions]
+
+    ## Add up the regions (in genome order)
+    stat, gc, events, junctions, rd = [sum([x[i] for x in results], Counter()) for i in range(5)]
+
+    writeStat(stat, prefix + '_bam_qc.txt')
+    writeGc(gc, sample, prefix + '.GC.xls', prefix + '_bam_gc.txt')
+    writeJunctions(events, junctions, _index, bed_file, prefix + '.junction.xls', prefix + '_bam_jc.txt')
+    if read_dist:
+        writeDistribution(rd, _index, prefix + '_bam_rc.txt')
+    return(0)
+
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='bamqc.py', description='Single-pass BAM QC (bam_stat, read_GC, junction_annotation, read_distribution)')
+    parser.add_argument('-i', '--input', required=True, help='sorted, indexed BAM file')
+    parser.add_argument('-r', '--refgene', required=True, help='BED12 gene model')
+    parser.add_argument('-o', '--prefix', required=True, help='output prefix (<prefix>_bam_qc.txt, ...)')
+    parser.add_argument('-s', '--sample', default=None, help='sample ID (default: basename of the prefix)')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--no-read-dist', action='store_true', help='skip the read distribution')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='[bamqc] %(asctime)s - %(levelname)s - %(message)s')
+    return(run(args.input, args.refgene, args.prefix, args.sample, max(1, args.threads), not args.no_read_dist))
+
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,178 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  checksum.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Parallel, cached file checksums
+# Input:    N/A
+# Output:   N/A
+#############################################################################################################
+
+import os
+import hashlib
+import sqlite3
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+## Number of files hashed at once (hashlib releases the GIL while hashing)
+CHECKSUM_THREADS = 4
+
+## Read size used when hashing
+CHUNK_SIZE = 2 ** 22
+
+
+
+## Create a new hash object for the configured hash type (None if checksums are disabled)
+def newHash(hash):
+    if hash in ('sha256', 'md5'):
+        return(hashlib.new(hash))
+    return(None)
+
+
+
+## Identify a version of a file on disk -- any change to size, mtime or inode invalidates the cache
+def fileKey(file):
+    st = os.stat(file)
+    return((st.st_size, st.st_mtime_ns, st.st_ino))
+
+
+
+## Hash a single file
+def hashFile(file, hash):
+    h = newHash(hash)
+    if h is None:
+        return('')
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return(h.hexdigest())
+
+
+
+## Persistent checksum cache stored in a SQLite database (usually the log database)
+class ChecksumCache:
+    def __init__(self, db):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db, timeout=1000, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS checksum_cache(file_path text, hash text, file_bytes integer, mtime_ns integer,
+        inode integer, file_checksum text, primary key (file_path, hash))''')
+        self.conn.commit()
+
+
+    ## Return the cached checksum for a file, or None if it changed since it was hashed
+    def get(self, file, hash):
+        key = fileKey(file)
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT file_bytes, mtime_ns, inode, file_checksum FROM checksum_cache WHERE file_path=(?) AND hash=(?)", (os.path.abspath(file), hash))
+            row = c.fetchone()
+        if row is not None and tuple(row[0:3]) == key:
+            return(row[3])
+        return(None)
+
+
+    ## Store checksums -- takes a list of (file, checksum) tuples
+    def put(self, files, hash):
+        rows = [(os.path.abspath(f), hash) + fileKey(f) + (x, ) for f, x in files]
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO checksum_cache (file_path, hash, file_bytes, mtime_ns, inode, file_checksum) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+
+
+## One cache per database per process
+_caches = {}
+_caches_lock = threading.Lock()
+
+def getCache(db):
+    with _caches_lock:
+        if db not in _caches:
+            _caches[db] = ChecksumCache(db)
+        return(_caches[db])
+
+
+
+## Checksum file(s) in a thread pool, skipping any file whose cached checksum is still valid
+def checksumFiles(file, hash, cache_db=None, threads=CHECKSUM_THREADS):
+    if newHash(hash) is None:
+        return(['' for f in file])
+
+    cache = getCache(cache_db) if cache_db is not None else None
+    res = [cache.get(f, hash) if cache is not None else None for f in file]
+    todo = [i for i in range(len(file)) if res[i] is None]
+    logging.debug('Checksum cache hits: %s of %s file(s)' % (len(file) - len(todo), len(file)))
+
+    ## Hash remaining files
+    if len(todo) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, min(threads, len(todo)))) as pool:
+            for i, x in zip(todo, pool.map(lambda i: hashFile(file[i], hash), todo)):
+                res[i] = x
+        if cache is not None:
+            cache.put([(file[i], res[i]) for i in todo], hash)
+    return(res)
+
+
+
+## Record a checksum computed elsewhere (e.g. while the file was written)
+def storeChecksum(file, hash, checksum, cache_db):
+    if cache_db is not None and checksum:
+        getCache(cache_db).put([(file, checksum)], hash)
+
+
+
+## Binary file wrapper that hashes data as it is written
+class HashingWriter:
+    def __init__(self, file, hash, mode='wb'):
+        self.name = file
+        self.hash = hash
+        self.h = newHash(hash)
+        self.f = open(file, mode)
+
+    def write(self, data):
+        if self.h is not None:
+            self.h.update(data)
+        return(self.f.write(data))
+
+    ## Remember the current position/hash state so a failed partial write can be undone
+    def checkpoint(self):
+        self.f.flush()
+        return((self.f.tell(), self.h.copy() if self.h is not None else None))
+
+    def rollback(self, state):
+        self.f.seek(state[0])
+        self.f.truncate()
+        self.h = state[1].copy() if state[1] is not None else None
+
+    def hexdigest(self):
+        return(self.h.hexdigest() if self.h is not None else '')
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
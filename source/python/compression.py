@@ -0,0 +1,161 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  compression.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Compression policy: fast (parallel) gzip for intermediate files, strong gzip for final results
+# Input:    N/A
+# Output:   N/A
+#############################################################################################################
+
+import io
+import os
+import gzip
+import shutil
+import subprocess
+
+## gzip levels of intermediate files (temporary, read once by the next step) and final results
+INTERMEDIATE = 1
+FINAL = 9
+
+## Parallel gzip compressors, in order of preference. Both write gzip files every consumer in the
+## pipeline reads (pigz: one member, bgzip: a series of BGZF blocks)
+PROGRAMS = {'pigz': '%s -c -%s -p %s', 'bgzip': '%s -c -l %s -@ %s'}
+
+
+
+## Path to the first parallel compressor found on the PATH (None if there is none)
+_compressor = []
+
+def compressor():
+    if len(_compressor) == 0:
+        _compressor.extend([(x, shutil.which(x)) for x in PROGRAMS if shutil.which(x)][:1] or [None])
+    return(_compressor[0])
+
+
+
+## Shell command compressing stdin to stdout
+def compressCommand(level, threads=1):
+    prog = compressor()
+    if prog is None:
+        return('gzip -c -%s' % (level))
+    return(PROGRAMS[prog[0]] % (prog[1], level, max(1, threads)))
+
+
+
+## cutadapt options for its gzipped output (cutadapt compresses in parallel itself with --cores > 1)
+## -Z selects level 1 and is understood by old and new cutadapt versions alike
+def cutadaptOptions(level=INTERMEDIATE):
+    return(' -Z' if level == INTERMEDIATE else '')
+
+
+
+## File object writing gzip data through a parallel compressor, closing waits for the compressor
+class PipeWriter:
+    def __init__(self, file, level, threads):
+        self.file = file
+        self.out = open(file, 'wb')
+        self.proc = subprocess.Popen(compressCommand(level, threads), shell=True, stdin=subprocess.PIPE, stdout=self.out)
+        self.stream = self.proc.stdin
+
+
+    def write(self, data):
+        return(self.stream.write(data))
+
+
+    def writelines(self, lines):
+        self.stream.writelines(lines)
+
+
+    def close(self):
+        if self.proc is None:
+            return
+        self.stream.close()
+        code = self.proc.wait()
+        self.out.close()
+        self.proc = None
+        if code != 0:
+            raise RuntimeError('Compressing %s failed (exit status %s)' % (self.file, code))
+
+
+    def __enter__(self):
+        return(self)
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+## Text mode wrapper of a PipeWriter
+class TextWriter:
+    def __init__(self, writer):
+        self.writer = writer
+        self.text = io.TextIOWrapper(writer.stream)
+
+
+    def write(self, data):
+        return(self.text.write(data))
+
+
+    def writelines(self, lines):
+        self.text.writelines(lines)
+
+
+    def close(self):
+        if self.writer.proc is None:
+            return
+        self.text.flush()
+        self.text.detach()
+        self.writer.close()
+
+
+    def __enter__(self):
+        return(self)
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+## Open a gzip file for writing ('wb' or 'wt')
+## With more than one thread and a parallel compressor on the PATH the data is compressed by that program,
+## otherwise (or for single threaded writers) by Python's gzip module
+def openWrite(file, level=INTERMEDIATE, threads=1, mode='wb'):
+    if threads <= 1 or compressor() is None:
+        return(gzip.open(file, mode, compresslevel=level))
+    writer = PipeWriter(file, level, threads)
+    return(TextWriter(writer) if 't' in mode else writer)
+
+
+
+## Compress a file in place (file -> file.gz), returns the compressed file
+def compressFile(file, level=FINAL, threads=1):
+    with open(file, 'rb') as f, openWrite(file + '.gz.tmp', level, threads) as out:
+        shutil.copyfileobj(f, out, 2 ** 20)
+    os.replace(file + '.gz.tmp', file + '.gz')
+    shutil.copystat(file, file + '.gz')
+    os.remove(file)
+    return(file + '.gz')
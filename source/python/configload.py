@@ -0,0 +1,422 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  configload.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Native, cached parsing of the XLSX configuration file (Python port of parse-configuration.r)
+# Input:    config.xlsx
+# Output:   preprocess_config.yaml, sample_metadata.csv, analysis_config.csv, dir.csv
+#############################################################################################################
+
+import os
+import re
+import json
+import hashlib
+import logging
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+
+## Spreadsheet XML namespaces
+NS = {'m': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+      'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+      'p': 'http://schemas.openxmlformats.org/package/2006/relationships'}
+
+## Cache of the last parsed configuration (kept next to dir.csv)
+CACHE_FILE = '.config_cache.json'
+
+## Result/analysis directories created by the parser
+ANALYSIS_DIRS = ['lcpm', 'lcpm_fc', 'dist', 'pca', 'glm', 'gsea', 'pvclust']
+
+
+
+## R's named colors (grDevices::colors()): names without variants, names that also come in variants 1-4
+## (e.g. dodgerblue4), and gray/grey 0-100
+R_COLOR_NAMES = ('aliceblue beige black blanchedalmond blueviolet cornflowerblue darkblue darkcyan darkgray darkgreen '
+                 'darkgrey darkkhaki darkmagenta darkred darksalmon darkslateblue darkslategrey darkturquoise '
+                 'darkviolet dimgray dimgrey floralwhite forestgreen gainsboro ghostwhite gray greenyellow grey '
+                 'lavender lawngreen lightcoral lightgoldenrodyellow lightgray lightgreen lightgrey lightseagreen '
+                 'lightslateblue lightslategray lightslategrey limegreen linen mediumaquamarine mediumblue '
+                 'mediumseagreen mediumslateblue mediumspringgreen mediumturquoise mediumvioletred midnightblue '
+                 'mintcream moccasin navy navyblue oldlace palegoldenrod papayawhip peru powderblue saddlebrown '
+                 'sandybrown slategrey violet white whitesmoke yellowgreen').split()
+R_COLOR_NAMES_1_4 = ('antiquewhite aquamarine azure bisque blue brown burlywood cadetblue chartreuse chocolate coral '
+                     'cornsilk cyan darkgoldenrod darkolivegreen darkorange darkorchid darkseagreen darkslategray deeppink '
+                     'deepskyblue dodgerblue firebrick gold goldenrod green honeydew hotpink indianred ivory khaki '
+                     'lavenderblush lemonchiffon lightblue lightcyan lightgoldenrod lightpink lightsalmon lightskyblue '
+                     'lightsteelblue lightyellow magenta maroon mediumorchid mediumpurple mistyrose navajowhite olivedrab '
+                     'orange orangered orchid palegreen paleturquoise palevioletred peachpuff pink plum purple red '
+                     'rosybrown royalblue salmon seagreen seashell sienna skyblue slateblue slategray snow springgreen '
+                     'steelblue tan thistle tomato turquoise violetred wheat yellow').split()
+R_COLORS = set(R_COLOR_NAMES + R_COLOR_NAMES_1_4 + [x + str(i) for x in R_COLOR_NAMES_1_4 for i in range(1, 5)] +
+               [x + str(i) for x in ['gray', 'grey'] for i in range(101)])
+
+
+
+## Raised for configuration errors (the R parser exits with status 25 for these)
+class ConfigError(Exception):
+    pass
+
+
+
+########################
+# XLSX reading         #
+########################
+
+## Column index (0-based) from a cell reference such as 'AB12'
+def columnIndex(ref):
+    res = 0
+    for c in re.match(r'[A-Z]+', ref).group(0):
+        res = res * 26 + ord(c) - ord('A') + 1
+    return(res - 1)
+
+
+
+## Text of a shared or inline string element (concatenates rich text runs, skips phonetic runs)
+def stringText(el):
+    t = el.find('m:t', NS)
+    if t is not None:
+        return(t.text or '')
+    return(''.join([x.text or '' for x in el.findall('m:r/m:t', NS)]))
+
+
+
+## Format a numeric cell the way R prints it (as.character, 15 significant digits)
+def formatNumber(v):
+    x = float(v)
+    if x == int(x) and abs(x) < 1e15:
+        return(str(int(x)))
+    res = '%.15g' % (x)
+    if 'e' in res:
+        mant, exp = res.split('e')
+        res = '%se%s%02d' % (mant, exp[0], abs(int(exp)))
+    return(res)
+
+
+
+## Read the sheets of an XLSX workbook as lists of rows (cell values as strings, None for empty cells)
+def readWorkbook(file):
+    with zipfile.ZipFile(file) as z:
+        names = z.namelist()
+        shared = []
+        if 'xl/sharedStrings.xml' in names:
+            shared = [stringText(x) for x in ET.fromstring(z.read('xl/sharedStrings.xml')).findall('m:si', NS)]
+        rels = dict([(x.get('Id'), x.get('Target')) for x in ET.fromstring(z.read('xl/_rels/workbook.xml.rels')).findall('p:Relationship', NS)])
+        sheets = []
+        for sheet in ET.fromstring(z.read('xl/workbook.xml')).findall('m:sheets/m:sheet', NS):
+            target = rels[sheet.get('{%s}id' % NS['r'])]
+            path = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+            sheets.append(readSheet(z.read(path), shared))
+    return(sheets)
+
+
+
+def readSheet(xml, shared):
+    rows = []
+    for row in ET.fromstring(xml).findall('m:sheetData/m:row', NS):
+        values = {}
+        for i, c in enumerate(row.findall('m:c', NS)):
+            t = c.get('t', 'n')
+            v = c.find('m:v', NS)
+            if t == 'inlineStr':
+                x = stringText(c.find('m:is', NS))
+            elif v is None or v.text is None:
+                continue
+            elif t == 's':
+                x = shared[int(v.text)]
+            elif t == 'b':
+                x = 'TRUE' if v.text == '1' else 'FALSE'
+            elif t in ('str', 'e'):
+                x = v.text
+            else:
+                x = formatNumber(v.text)
+            values[columnIndex(c.get('r')) if c.get('r') else i] = x
+        r = int(row.get('r')) - 1 if row.get('r') else len(rows)
+        while len(rows) <= r:
+            rows.append({})
+        rows[r] = values
+    return(rows)
+
+
+
+## Convert sheet rows to a table like openxlsx::read.xlsx: the first non-empty row is the header
+## (spaces in names become '.'), empty rows and columns are skipped, empty cells are None
+def sheetTable(rows):
+    rows = [x for x in rows if len([v for v in x.values() if v != '']) > 0]
+    if len(rows) == 0:
+        return([], [])
+    cols = sorted(set([k for x in rows for k in x.keys()]))
+    header = [(rows[0].get(c) or 'X%s' % (i+1)).replace(' ', '.') for i, c in enumerate(cols)]
+    data = [[x.get(c) for c in cols] for x in rows[1:]]
+    return(header, data)
+
+
+
+## Name/Value pairs of a configuration sheet, in sheet order
+def nameValue(rows):
+    header, data = sheetTable(rows)
+    if 'Name' not in header or 'Value' not in header:
+        raise ConfigError('Configuration sheet is missing the Name/Value columns')
+    i, j = header.index('Name'), header.index('Value')
+    return([[x[i], x[j]] for x in data])
+
+
+
+########################
+# Output formatting    #
+########################
+
+## Quote a string for YAML where needed, as the R yaml package does (single quotes when the
+## plain scalar would not read back as the same string)
+def yamlString(x):
+    import yaml
+    if x == '' or x != x.strip() or re.match(r'^[-?:,\[\]{}#&*!|>\'"%@`]', x) or ': ' in x or ' #' in x or x.endswith(':'):
+        return("'" + x.replace("'", "''") + "'")
+    try:
+        plain = yaml.safe_load(x)
+    except yaml.YAMLError:
+        plain = None
+    if not isinstance(plain, str) or plain != x:
+        return("'" + x.replace("'", "''") + "'")
+    return(x)
+
+
+
+## Write an ordered list of (key, value or list of values) pairs as block style YAML
+## (like R, a single value list is written as a scalar)
+def writeYaml(items, file):
+    with open(file, 'w') as f:
+        for k, v in items:
+            if isinstance(v, list) and len(v) == 1:
+                v = v[0]
+            if isinstance(v, list):
+                f.write('%s:\n' % (k))
+                [f.write('- %s\n' % (yamlString(x))) for x in v]
+            else:
+                f.write('%s: %s\n' % (k, yamlString(v)))
+
+
+
+## write.table(..., sep=',', quote=T, row.names=F) -- NA is written unquoted
+def writeQuotedCsv(header, data, file):
+    def q(x):
+        return('NA' if x is None else '"' + x.replace('"', '\\"') + '"')
+    with open(file, 'w') as f:
+        f.write(','.join([q(x) for x in header]) + '\n')
+        [f.write(','.join([q(x) for x in row]) + '\n') for row in data]
+
+
+
+## write.table(..., sep=',', quote=F, na='', row.names=F)
+def writePlainCsv(header, data, file):
+    with open(file, 'w') as f:
+        f.write(','.join(header) + '\n')
+        [f.write(','.join(['' if x is None else x for x in row]) + '\n') for row in data]
+
+
+
+########################
+# Parsing              #
+########################
+
+## Colors accepted in the sample metadata, as by R's col2rgb: #RRGGBB[AA], a name of colors() (case and
+## blanks are ignored), 'transparent' or 'NA', or a palette index
+def isColor(x):
+    if re.match(r'^(#[0-9A-Fa-f]{6}([0-9A-Fa-f]{2})?|[0-9]+(\.[0-9]*)?)$', x) or x in ('transparent', 'NA'):
+        return(True)
+    return(x.replace(' ', '').lower() in R_COLORS)
+
+
+
+## Parse and validate a configuration workbook
+## Returns the outputs to write, or None if reference data must first be downloaded/prepared by the R parser
+def parseConfig(file):
+    sheets = readWorkbook(file)
+    if len(sheets) < 3:
+        raise ConfigError('Configuration file must contain sample metadata, workflow and analysis sheets')
+
+    ## Sample metadata (the first two rows below the header describe the columns)
+    meta_header, metadata = sheetTable(sheets[0])
+    metadata = metadata[2:]
+    if len(metadata) == 0:
+        raise ConfigError('No samples were found')
+    col = dict([(x, i) for i, x in enumerate(meta_header)])
+    def column(name):
+        return([x[col[name]] for x in metadata] if name in col else [None] * len(metadata))
+
+    ## Workflow (missing values become '') and analysis configuration
+    workflow = [[k, v if v is not None else ''] for k, v in nameValue(sheets[1])]
+    analysis = nameValue(sheets[2])
+    def wf(name):
+        return(([v for k, v in workflow if k == name] + [''])[0])
+    def an(name):
+        return(([v for k, v in analysis if k == name] + [None])[0])
+
+    ## Sanity checks
+    rseqc = [wf('rseqc_dir') + '/' + x for x in ['bam_stat.py', 'junction_annotation.py', 'read_distribution.py', 'read_GC.py']]
+    for x in [wf(k) for k in ['aws_prog', 'openssl_prog', 'samtools_prog', 'fcts_prog', 'fastqc_prog']] + rseqc:
+        if not os.path.exists(x):
+            raise ConfigError('Program does not exist at this location! %s' % (x))
+    mappers = [wf('star_prog'), wf('hisat_prog')]
+    if not any([os.path.exists(x) for x in mappers]):
+        raise ConfigError('Please specify a valid mapping software program location! %s %s' % tuple(mappers))
+    if all([os.path.exists(x) for x in mappers]):
+        raise ConfigError('Please only specify ONE mapping software program location! %s %s' % tuple(mappers))
+    report_dir = an('report_dir') or ''
+    if not os.path.isdir(os.path.dirname(report_dir)):
+        raise ConfigError('Base directory does not exist! %s' % (os.path.dirname(report_dir)))
+    bad = [x for x in column('timec') + column('spctc') + column('trtc') if x is not None and not isColor(x)]
+    if len(bad) > 0:
+        raise ConfigError('The following colors are not recognized in the sample metadata: %s' % (' '.join(bad)))
+    if not re.match(r'^[0-9]+$', wf('ensembl_version')):
+        raise ConfigError('The specified Ensembl version is invalid: %s' % (wf('ensembl_version')))
+    if 'ncores' in [k for k, v in workflow]:
+        logging.error('You are using an old configuration file. ncores is no longer provided in the configuration file. Please provide the ncores in the command line invocation using --threads | -@')
+    if not re.match(r'^[0-9]+(\.0*)?$', wf('quality_trim')) or not 0 <= float(wf('quality_trim')) <= 40:
+        raise ConfigError('Quality trimming value specified is outside allowed range: %s' % (wf('quality_trim')))
+    if wf('ion_torrent') not in ('0', '1'):
+        raise ConfigError('Ion Torrent remapping flag incorrectly set: %s' % (wf('ion_torrent')))
+
+    ## Reference files; these (and gene sets) are downloaded/prepared by the R parser
+    pre_dir = wf('pre_dir')
+    ensembl = wf('ensembl_version')
+    gtf_file = '%s/annot/Homo_sapiens.ensembl.version%s.chr.gtf' % (pre_dir, ensembl)
+    bed_file = re.sub('gtf$', 'bed', gtf_file)
+    genome_file = '%s/genome/Homo_sapiens.ensembl.version%s.genome.fa' % (pre_dir, ensembl)
+    gmt_files = [x for x in wf('gmt_entrez_files').split(';') if x != '']
+    gene_sets = '%s/data/gene_sets/all.ensembl.tab.gz' % (report_dir)
+    if not all([os.path.exists(x) for x in [gtf_file, bed_file, genome_file]]) or (len(gmt_files) > 0 and not os.path.exists(gene_sets)):
+        return(None)
+
+    ## Analysis configuration with workflow values appended
+    analysis = analysis + [['ensembl_version', ensembl], ['run_read_dist', wf('run_read_dist')], ['star_prog', wf('star_prog')], ['save_cram', wf('save_cram')]]
+
+    ## Workflow configuration: list assignment keeps the position of existing names
+    items = []
+    def assign(k, v):
+        for x in items:
+            if x[0] == k:
+                x[1] = v
+                return
+        items.append([k, v])
+    [assign(k, v) for k, v in workflow if k not in ('gmt_entrez_files', 'gmt_entrez_files_labels')]
+    assign('genome_file', genome_file)
+    assign('gtf_file', gtf_file)
+    assign('bed_file', bed_file)
+    assign('samid', column('samid'))
+    assign('fastq1', column('fastq_file_1'))
+    fastq2 = column('fastq_file_2')
+    assign('fastq2', '' if all([x is None for x in fastq2]) else fastq2)
+    assign('tp_adapter_seq', [x if x is not None else 'NA' for x in column('threep_adapter_seq')])
+    assign('fp_adapter_seq', [x if x is not None else 'NA' for x in column('fivep_adapter_seq')])
+    items = [(k, [x if x is not None else '' for x in v] if isinstance(v, list) else v) for k, v in items]
+
+    return({'pre_dir': pre_dir, 'report_dir': report_dir, 'workflow': items, 'analysis': analysis,
+            'metadata': (meta_header, metadata), 'single_end': fastq2 == [None] * len(fastq2)})
+
+
+
+## Create the pre-processing and result directory hierarchy
+def makeDirs(pre_dir, report_dir):
+    dirs = [pre_dir, pre_dir + '/genome', pre_dir + '/annot', report_dir, report_dir + '/data', report_dir + '/data/annot',
+            report_dir + '/data/gene_sets', report_dir + '/analysis', report_dir + '/report'] + [report_dir + '/analysis/' + x for x in ANALYSIS_DIRS]
+    [os.makedirs(x, exist_ok=True) for x in dirs]
+
+
+
+## Write the parsed configuration; returns the dir.csv entries
+def writeConfig(res, dir_csv):
+    pre_dir, report_dir = res['pre_dir'], res['report_dir']
+    makeDirs(pre_dir, report_dir)
+    writeQuotedCsv(['Name', 'Value'], res['analysis'], report_dir + '/data/analysis_config.csv')
+    [writePlainCsv(res['metadata'][0], res['metadata'][1], x + '/sample_metadata.csv') for x in [pre_dir, report_dir + '/data']]
+    logging.info('Working in %s mode' % ('single-end' if res['single_end'] else 'paired-end'))
+    writeYaml(res['workflow'], pre_dir + '/preprocess_config.yaml')
+    dirs = [pre_dir, report_dir, pre_dir + '/preprocess_config.yaml', pre_dir + '/sample_metadata.csv']
+    with open(dir_csv, 'w') as f:
+        [f.write(x + '\n') for x in dirs]
+    return(dirs)
+
+
+
+########################
+# Cache                #
+########################
+
+def fileHash(file):
+    with open(file, 'rb') as f:
+        return(hashlib.sha256(f.read()).hexdigest())
+
+
+
+## Files the parser writes, from the dir.csv entries
+def outputFiles(dirs, dir_csv):
+    return([dir_csv, dirs[2], dirs[3], dirs[1] + '/data/sample_metadata.csv', dirs[1] + '/data/analysis_config.csv'])
+
+
+
+## Return the cached dir.csv entries if the configuration file is unchanged since it was last parsed
+def cachedDirs(config_file, scriptdir):
+    cache_file = os.path.join(scriptdir, '..', CACHE_FILE)
+    dir_csv = os.path.join(scriptdir, '..', 'dir.csv')
+    if not os.path.exists(cache_file):
+        return(None)
+    with open(cache_file) as f:
+        cache = json.load(f)
+    if cache.get('config') != os.path.abspath(config_file) or cache.get('sha256') != fileHash(config_file):
+        return(None)
+    if not all([os.path.exists(x) for x in outputFiles(cache['dirs'], dir_csv)]):
+        return(None)
+    return(cache['dirs'])
+
+
+
+## Remember the dir.csv entries written for a configuration file
+def saveCache(config_file, scriptdir, dirs):
+    with open(os.path.join(scriptdir, '..', CACHE_FILE), 'w') as f:
+        json.dump({'config': os.path.abspath(config_file), 'sha256': fileHash(config_file), 'dirs': dirs}, f)
+
+
+
+## Read dir.csv (pre-processing dir, report dir, YAML config, sample metadata)
+def readDirs(scriptdir):
+    with open(os.path.join(scriptdir, '..', 'dir.csv')) as f:
+        return([f.readline().strip() for i in range(4)])
+
+
+
+## Parse a configuration file unless it is unchanged since the last call
+## Returns the dir.csv entries, or None if the R parser is needed (reference data/gene sets missing)
+def loadConfig(config_file, scriptdir):
+    dirs = cachedDirs(config_file, scriptdir)
+    if dirs is not None:
+        logging.info('Configuration unchanged, using cached parse of %s' % (config_file))
+        return(dirs)
+    logging.info('Parsing configuration %s' % (config_file))
+    res = parseConfig(config_file)
+    if res is None:
+        return(None)
+    dirs = writeConfig(res, os.path.join(scriptdir, '..', 'dir.csv'))
+    saveCache(config_file, scriptdir, dirs)
+    return(dirs)
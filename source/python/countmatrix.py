@@ -0,0 +1,262 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  countmatrix.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Merge per-sample featureCounts results into a gene by sample matrix, split batched results
+# Input:    featureCounts output files (*_count.tab)
+# Output:   gzipped count matrix, gene lengths, optional .npy matrix
+#############################################################################################################
+
+import os
+import re
+import shutil
+import tempfile
+import logging
+import mergecache
+import compression
+from itertools import zip_longest
+
+## Maximum number of count files held open at once -- larger cohorts are merged in blocks
+MAX_OPEN_FILES = 256
+
+## Cached blocks kept at most (every incremental merge adds one, and the final pass holds all of them open);
+## beyond that the blocks after the leading full ones are rebuilt as full blocks
+MAX_BLOCKS = 16
+
+
+
+## Find featureCounts outputs below a directory (sorted by path)
+def findCountFiles(dir):
+    return(mergecache.findFiles(dir, '_count.tab'))
+
+
+
+## Sample ID from a featureCounts output file name
+def sampleId(file):
+    return(re.search(r'([^/]*)_count\.tab$', file).group(1))
+
+
+
+## Iterate over (gene id, gene length, [count]) rows of a single featureCounts output
+## The sample ID from the file name must match the BAM named in the header
+def readCountFile(file):
+    id = sampleId(file)
+    with open(file) as f:
+        for line in f:
+            if line.startswith('# Program'):
+                continue
+            x = line.rstrip('\n').split('\t')
+            if x[0] == 'Geneid':
+                bam_id = re.search(r'([^/]*)\.bam$', x[6]).group(1)
+                if bam_id != id:
+                    raise RuntimeError('IDs do not match (%s:%s)' % (bam_id, id))
+                continue
+            yield (x[0], x[5], [x[6]])
+
+
+
+## Write the featureCounts result of one BAM from a run over several BAMs (and its .summary, if present)
+## The output has the layout of a single-BAM run, with the batch's program/command line kept for provenance
+def splitBatch(batch_file, bam, out_file):
+    with open(batch_file) as f, open(out_file + '.tmp', 'w') as out:
+        for line in f:
+            if line.startswith('# Program'):
+                out.write(line)
+                continue
+            x = line.rstrip('\n').split('\t')
+            if x[0] == 'Geneid':
+                if bam not in x[6:]:
+                    raise RuntimeError('%s not found in %s' % (bam, batch_file))
+                i = x.index(bam, 6)
+            out.write('\t'.join(x[:6] + [x[i]]) + '\n')
+    os.replace(out_file + '.tmp', out_file)
+    
+    if os.path.exists(batch_file + '.summary'):
+        with open(batch_file + '.summary') as f, open(out_file + '.summary', 'w') as out:
+            for line in f:
+                x = line.rstrip('\n').split('\t')
+                if x[0] == 'Status':
+                    i = x.index(bam, 1)
+                out.write(x[0] + '\t' + x[i] + '\n')
+    return(out_file)
+
+
+
+## Iterate over (gene id, gene length, [counts]) rows of a partial matrix written by mergeRows
+def readBlockFile(file):
+    with open(file) as f:
+        f.readline()
+        for line in f:
+            x = line.rstrip('\n').split('\t')
+            yield (x[0], x[1], x[2:])
+
+
+
+## Walk several row iterators in lockstep (the files share the GTF gene order) and join their counts
+def mergeRows(readers):
+    for rows in zip_longest(*readers):
+        if None in rows:
+            raise RuntimeError('Count files contain different numbers of genes')
+        gene = rows[0][0]
+        if any([x[0] != gene for x in rows]):
+            raise RuntimeError('Gene order differs between count files (%s)' % gene)
+        yield (gene, rows[0][1], [c for x in rows for c in x[2]])
+
+
+
+## Merge a block of count files into an uncompressed partial matrix (gene id, length, counts)
+def writeBlock(files, out_file):
+    with open(out_file, 'w') as out:
+        out.write('gene_id\tlength\t' + '\t'.join([sampleId(f) for f in files]) + '\n')
+        for gene, length, counts in mergeRows([readCountFile(f) for f in files]):
+            out.write(gene + '\t' + length + '\t' + '\t'.join(counts) + '\n')
+
+
+
+## Write the merged gene x sample matrix and gene lengths from lockstep row readers
+## Genes are written sorted by ID, as by the earlier Perl merger (sort keys), not in GTF order: the merged rows
+## are spooled to a temporary file in GTF order and then read back by offset in sorted order
+## Optionally also write the counts as an int32 .npy matrix (rows/columns in the same order as the text matrix)
+def writeMatrix(readers, ids, out_file, lengths_file, npy_file=None, compresslevel=compression.FINAL, threads=1):
+    with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(out_file))) as spool:
+        offsets = []
+        for gene, length, counts in mergeRows(readers):
+            offsets.append((gene, spool.tell()))
+            spool.write(('\t'.join([gene, length] + counts) + '\n').encode())
+        offsets.sort()
+
+        npy = None
+        if npy_file is not None:
+            import numpy
+            npy = numpy.lib.format.open_memmap(npy_file, mode='w+', dtype=numpy.int32, shape=(len(offsets), len(ids)))
+
+        with compression.openWrite(out_file, compresslevel, threads, 'wt') as out, open(lengths_file, 'w') as lengths:
+            out.write('gene_id\t' + '\t'.join(ids) + '\n')
+            lengths.write('Geneid Length\n')
+            for i, (gene, offset) in enumerate(offsets):
+                spool.seek(offset)
+                x = spool.readline().decode().rstrip('\n').split('\t')
+                out.write(gene + '\t' + '\t'.join(x[2:]) + '\n')
+                lengths.write(gene + ' ' + x[1] + '\n')
+                if npy is not None:
+                    npy[i, :] = [int(c) for c in x[2:]]
+
+    if npy is not None:
+        npy.flush()
+
+
+
+## Merge featureCounts outputs into a gzipped gene x sample matrix and export gene lengths in one pass over the count files
+## With a cache_dir, blocks of already merged samples are kept between runs and only blocks
+## containing new or changed samples are rebuilt (the final matrix is still rewritten)
+## The matrix is a final result: strong compression, in parallel (pigz/bgzip) with more than one thread
+def mergeCounts(files, out_file, lengths_file, npy_file=None, compresslevel=compression.FINAL, cache_dir=None, hash=None, cache_db=None, threads=1):
+    ids = [sampleId(f) for f in files]
+    if len(set(ids)) != len(ids):
+        raise RuntimeError('Duplicate sample IDs in count files')
+    logging.info('Merging %s featureCounts file(s) into %s' % (len(files), out_file))
+    
+    if cache_dir is not None:
+        return(mergeCountsCached(files, out_file, lengths_file, npy_file, compresslevel, cache_dir, hash, cache_db, threads))
+
+    tmpdir = None
+    try:
+        ## Large cohorts: merge blocks of files first to stay under the open file limit
+        if len(files) > MAX_OPEN_FILES:
+            tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_file)))
+            blocks = []
+            for i in range(0, len(files), MAX_OPEN_FILES):
+                blocks.append(os.path.join(tmpdir, 'block%s.tab' % (len(blocks))))
+                writeBlock(files[i:i+MAX_OPEN_FILES], blocks[-1])
+            readers = [readBlockFile(f) for f in blocks]
+        else:
+            readers = [readCountFile(f) for f in files]
+
+        writeMatrix(readers, ids, out_file, lengths_file, npy_file, compresslevel, threads)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    return(out_file)
+
+
+
+## Write a cached block of count files, return its index entry
+def newBlock(files, fps, block_dir):
+    block = tempfile.NamedTemporaryFile(dir=block_dir, prefix='block', suffix='.tab', delete=False).name
+    writeBlock(files, block)
+    return({'file': block, 'members': [[f, fps[f]] for f in files]})
+
+
+
+## Rebuild the partial blocks (all but the leading full ones) as full blocks once there are too many
+def compactBlocks(blocks, fps, block_dir):
+    if len(blocks) <= MAX_BLOCKS:
+        return(blocks)
+    n = 0
+    while n < len(blocks) and len(blocks[n]['members']) == MAX_OPEN_FILES:
+        n += 1
+    files = [f for b in blocks[n:] for f, fp in b['members']]
+    logging.info('Count matrix: compacting %s cached block(s) of %s sample(s)' % (len(blocks) - n, len(files)))
+    res = blocks[:n] + [newBlock(files[i:i+MAX_OPEN_FILES], fps, block_dir) for i in range(0, len(files), MAX_OPEN_FILES)]
+    [os.remove(b['file']) for b in blocks[n:]]
+    return(res)
+
+
+
+## Incremental variant of mergeCounts using persistent blocks in cache_dir
+## Incremental: parsing and merging the count files of unchanged samples (their blocks are reused)
+## Not incremental: the final matrix, gene lengths and .npy are rewritten from all blocks every time
+def mergeCountsCached(files, out_file, lengths_file, npy_file, compresslevel, cache_dir, hash, cache_db, threads=1):
+    index_file = os.path.join(cache_dir, 'count_blocks.json')
+    index = mergecache.loadIndex(index_file, {'blocks': []})
+    fps = dict(zip(files, mergecache.fingerprints(files, hash, cache_db)))
+    
+    ## Keep blocks whose members are all still present and unchanged
+    keep, drop = [], []
+    for b in index['blocks']:
+        if os.path.exists(b['file']) and all([f in fps and fps[f] == fp for f, fp in b['members']]):
+            keep.append(b)
+        else:
+            drop.append(b)
+    [os.remove(b['file']) for b in drop if os.path.exists(b['file'])]
+    
+    ## Build new blocks from the remaining files
+    done = set([f for b in keep for f, fp in b['members']])
+    todo = [f for f in files if f not in done]
+    logging.info('Count matrix: %s cached block(s), %s sample(s) to merge' % (len(keep), len(todo)))
+    if len(todo) == 0 and len(drop) == 0 and os.path.exists(out_file) and os.path.exists(lengths_file) and (npy_file is None or os.path.exists(npy_file)):
+        return(out_file)
+    
+    block_dir = os.path.join(cache_dir, 'count_blocks')
+    if not os.path.isdir(block_dir):
+        os.makedirs(block_dir)
+    keep += [newBlock(todo[i:i+MAX_OPEN_FILES], fps, block_dir) for i in range(0, len(todo), MAX_OPEN_FILES)]
+    keep = compactBlocks(keep, fps, block_dir)
+    mergecache.saveIndex(index_file, {'blocks': keep})
+    
+    ## Final pass over the blocks
+    ids = [sampleId(f) for b in keep for f, fp in b['members']]
+    writeMatrix([readBlockFile(b['file']) for b in keep], ids, out_file, lengths_file, npy_file, compresslevel, threads)
+    return(out_file)
@@ -32,15 +32,15 @@
 import os
 import subprocess
 import utils
+import checksum
+import transfer
 import shutil
+import logging
 
-## Download file(s) from amazon s3, return path to result
+## Download file(s) from amazon s3 concurrently, return path to result
 def downloadS3File(in_file,aws):
-	res = []
-	for f in in_file:
-		cmd = aws+' s3 cp '+f+' '+os.getcwd()+'/'+os.path.basename(f)
-		utils.logging_call(cmd, shell=True)
-		res.append(os.path.basename(f))
+	res = [os.path.basename(f) for f in in_file]
+	transfer.s3Copy([(f, os.getcwd()+'/'+x) for f, x in zip(in_file, res)], prog=aws, upload=False)
 	return(res)
 
 
@@ -52,30 +52,67 @@ def getSRAUrl(accession):
 
 	
 ## Download file(s) from the sequence read archive, return path to result
-def downloadSRAFile(accession,fastq_dump):
-	res = []
-	for f in accession:
+## prefetch retrieves the sra file into sra.SRA_DIR (where the background prefetch queue, if one was started,
+## may have downloaded it already), fastq-dump/fasterq-dump extracts it; a failed step is retried on its own
+def downloadSRAFile(accession, fastq_dump, prefetch_prog='prefetch', threads=1):
+	import sra
+	return(sra.fetch(accession, os.getcwd(), fastq_dump, prefetch_prog=prefetch_prog, threads=threads))
+
+
+## Stream a single (s3 or local, optionally encrypted) part onto the end of an open output file
+def streamPart(in_file, out, aws_prog, openssl_prog, pw, hash):
+	procs = []
 	
-		## Download from the NCBI ftp site, extract fastq.gz, remove downloaded file
-		## pefetch is more reliable than fastq-dump to retrieve the sra file
-		cmd = 'prefetch -v ' + f + ' -O ' + os.getcwd() + ' && ' + fastq_dump + ' ' + os.getcwd() + '/' + f + '.sra --gzip -O ' + os.getcwd() + ' && rm ' + os.getcwd() + '/' + f + '.sra'
-		
-		## If download times out on the first try, give it up to 2 more tries
-		for i in range(3):
-			try:
-				utils.logging_call(cmd, shell=True)
-			except subprocess.CalledProcessError as e:
-				print('Timeout: ' + e.cmd)
-				if (i == 2):
-					raise e
-			else:
-				break
-				
-		res.append(os.getcwd() + '/' +f+'.fastq.gz')
-	return(res)
+	## Source: aws s3 cp to stdout, or the local file
+	if (in_file[0:5] == 's3://'):
+		procs.append(subprocess.Popen(transfer.s3Command(aws_prog, in_file, '-'), shell=True, stdout=subprocess.PIPE))
+		src = procs[-1].stdout
+	else:
+		src = open(in_file, 'rb')
+	
+	## Decrypt on the fly
+	if (in_file[-4:] == '.enc'):
+		cmd = openssl_prog+' aes-256-cbc -md '+hash+' -d -pass pass:'+pw
+		procs.append(subprocess.Popen(cmd, shell=True, stdin=src, stdout=subprocess.PIPE))
+		src.close()
+		src = procs[-1].stdout
+	
+	## Append to output, check that every stage of the pipe succeeded
+	shutil.copyfileobj(src, out, checksum.CHUNK_SIZE)
+	src.close()
+	for p in procs:
+		if p.wait() != 0:
+			raise subprocess.CalledProcessError(returncode=p.returncode, cmd=p.args.split(' ')[0])
 
 
-def getFile(in_file, out_file, aws_prog, fastq_dump_prog, openssl_prog, pw, hash):
+
+## Stream file(s) download -> decrypt -> concatenate -> out_file (-> checksum) without writing 
+## intermediate copies, so peak disk usage is a single copy of the data
+## A failed part is rolled back and retried up to 3 times
+def streamFile(in_file, out_file, aws_prog, openssl_prog, pw, hash, cache_db=None):
+	with checksum.HashingWriter(out_file, hash if cache_db else None) as out:
+		for f in in_file:
+			state = out.checkpoint()
+			for i in range(3):
+				try:
+					logging.info('Streaming %s to %s' % (f, out_file))
+					streamPart(f, out, aws_prog, openssl_prog, pw, hash)
+				except subprocess.CalledProcessError as e:
+					out.rollback(state)
+					if (i == 2):
+						raise e
+					logging.warning('Streaming %s failed (attempt %s of 3), retrying' % (f, i+1))
+				else:
+					break
+	checksum.storeChecksum(out_file, hash, out.hexdigest(), cache_db)
+	return(0)
+
+
+
+## Pull input file(s), decrypt and merge into out_file
+## If a checksum cache database is given, out_file is hashed while it is written 
+## With stream=True, s3/local input is piped straight into out_file (SRA accessions always go through disk)
+def getFile(in_file, out_file, aws_prog, fastq_dump_prog, openssl_prog, pw, hash, cache_db=None, stream=False, prefetch_prog='prefetch', threads=1):
 	## Set flags
 	file_downloaded = False
 	file_decrypted  = False
@@ -83,17 +120,21 @@ def getFile(in_file, out_file, aws_prog, fastq_dump_prog, openssl_prog, pw, hash
 	## Convert to list so we can handle multiple files
 	in_file = in_file.split(';')
 	
+	## Streaming mode
+	if (stream and in_file[0][0:3] != 'SRR'):
+		return(streamFile(in_file, out_file, aws_prog, openssl_prog, pw, hash, cache_db=cache_db))
+	
 	## Download file (if needed)
 	if (in_file[0][0:5] == 's3://'):
 		in_file = downloadS3File(in_file, aws_prog)
 		file_downloaded = True
 	elif(in_file[0][0:3] == 'SRR'):
-		in_file = downloadSRAFile(in_file, fastq_dump_prog)
+		in_file = downloadSRAFile(in_file, fastq_dump_prog, prefetch_prog=prefetch_prog, threads=threads)
 		file_downloaded = True
 
 	## Decrypt file (if needed)
 	if (in_file[0][-4:] == '.enc'):
-		in_file = utils.decryptFile(in_file, openssl_prog, pw, hash)
+		in_file = utils.decryptFile(in_file, openssl_prog, pw, hash, cache_db=cache_db)
 		file_decrypted = True
 	
 	## If we downloaded & decrypted, remove the encrypted file(s)
@@ -102,22 +143,28 @@ def getFile(in_file, out_file, aws_prog, fastq_dump_prog, openssl_prog, pw, hash
 	
 	## Merge if multiple downloaded files, only keep merged file
 	if (len(in_file) > 1 and file_downloaded):
-		utils.cat(in_file, out_file)
+		utils.cat(in_file, out_file, hash=hash, cache_db=cache_db)
 		[os.remove(s) for s in in_file]
 	
 	## Merge if multiple local files, keep unmerged files
 	elif (len(in_file) > 1 and not file_downloaded):
-		utils.cat(in_file, out_file)
+		utils.cat(in_file, out_file, hash=hash, cache_db=cache_db)
 	
 	## Move if single downloaded file
+	## (rename keeps size/mtime/inode, so carry over a checksum computed while decrypting)
 	elif (len(in_file) == 1 and file_downloaded):
+		file_checksum = checksum.getCache(cache_db).get(in_file[0], hash) if cache_db is not None else None
 		os.rename(in_file[0], out_file)
+		checksum.storeChecksum(out_file, hash, file_checksum, cache_db)
 	
 	## Make a copy if single local file
 	elif (len(in_file) == 1 and not file_downloaded):
 		#cmd = 'cp '+in_file[0]+' '+out_file
 		#subprocess.run(cmd, shell=True, check=True)
-		shutil.copy2(in_file[0], out_file)
+		if cache_db is not None:
+			utils.cat(in_file, out_file, hash=hash, cache_db=cache_db)
+		else:
+			shutil.copy2(in_file[0], out_file)
 		
 	
 	## If everything runs successfully, return 0 
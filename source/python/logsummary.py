@@ -0,0 +1,189 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  logsummary.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Per-rule, per-sample and per-run summaries of the log database from materialized aggregates
+# Input:    log database
+# Output:   summary tables (in the log database), tab-separated reports
+#############################################################################################################
+
+import os
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+import sqlite
+
+## Summary tables: grouping of the process rows, key column of the summary table
+## (processes recorded before runs were registered have no run and only count towards the rule and sample summaries)
+GROUPS = {'rule': ("COALESCE(p.rule, '')", 'rule'), 'sample': ('p.sample_id', 'sample_id'), 'run': ('p.run_id', 'run_id')}
+
+## Summed columns of the summary tables
+SUMS = ['jobs', 'failed', 'wc_time', 'cpu_time', 'thread_time', 'io_read_bytes', 'io_write_bytes', 'input_bytes', 'output_bytes', 'files']
+
+
+
+## Add the processes recorded since the last refresh to the summary tables (sums, peaks, first/last times)
+## Only new processes are read, so the cost is proportional to what was recorded since then
+def refresh(db):
+    sqlite.initSqliteDb(db)
+    writer = sqlite.getWriter(db)
+    with writer.lock:
+        writer.flush()
+        c = writer.conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            last = (c.execute("SELECT value FROM summary_state WHERE name = 'last_process_id'").fetchone() or (0, ))[0]
+            top = c.execute('SELECT COALESCE(MAX(process_id), 0) FROM process').fetchone()[0]
+            if top > last:
+                [c.execute(x, {'last': last, 'top': top}) for group in GROUPS for x in refreshStatements(group)]
+                c.execute("INSERT OR REPLACE INTO summary_state (name, value) VALUES ('last_process_id', ?)", (top, ))
+            c.execute('COMMIT')
+        except Exception:
+            c.execute('ROLLBACK')
+            raise
+    if top > last:
+        logging.debug('Log database summaries: added processes %s to %s' % (last + 1, top))
+    return(top - last)
+
+
+
+## Statements adding the processes in (last, top] to one summary table: the new processes are aggregated
+## into a temporary table, missing summary rows are inserted and all affected rows are then updated
+## (INSERT OR IGNORE and correlated UPDATEs rather than an upsert, which needs SQLite 3.24 -- Ubuntu 18.04 has 3.22)
+def refreshStatements(group):
+    expr, key = GROUPS[group]
+    times = ['first_start', 'last_end'] if group != 'rule' else []
+    delta = '(SELECT d.%%s FROM summary_delta d WHERE d.grp = summary_%s.%s)' % (group, key)
+    updates = ['%s = %s + %s' % (x, x, delta % (x)) for x in SUMS] + ['max_rss = MAX(COALESCE(max_rss, 0), COALESCE(%s, 0))' % (delta % ('max_rss'))]
+    if group != 'rule':
+        updates += ['first_start = MIN(COALESCE(first_start, %s), %s)' % (delta % ('first_start'), delta % ('first_start')),
+                    'last_end = MAX(COALESCE(last_end, 0), %s)' % (delta % ('last_end'))]
+    return(['''CREATE TEMP TABLE summary_delta AS
+        WITH f AS (SELECT process_id, SUM(file_bytes) AS bytes, COUNT(*) AS n FROM file WHERE process_id > :last AND process_id <= :top GROUP BY process_id),
+        b AS (SELECT process_id, SUM(cpu_time) AS cpu, MAX(resident_set_size) AS rss, SUM(io_read_bytes) AS rd, SUM(io_write_bytes) AS wr
+              FROM benchmark WHERE process_id > :last AND process_id <= :top GROUP BY process_id)
+        SELECT %s AS grp, COUNT(*) AS jobs, SUM(COALESCE(p.return_code, 0) != 0) AS failed, SUM(p.wc_time) AS wc_time, SUM(COALESCE(b.cpu, 0)) AS cpu_time,
+            SUM(p.wc_time * COALESCE(p.threads, 1)) AS thread_time, SUM(COALESCE(b.rd, 0)) AS io_read_bytes, SUM(COALESCE(b.wr, 0)) AS io_write_bytes,
+            SUM(COALESCE(p.input_bytes, 0)) AS input_bytes, SUM(COALESCE(f.bytes, 0)) AS output_bytes, SUM(COALESCE(f.n, 0)) AS files, MAX(b.rss) AS max_rss,
+            MIN(p.start_time) AS first_start, MAX(p.end_time) AS last_end
+        FROM process p LEFT JOIN f ON f.process_id = p.process_id LEFT JOIN b ON b.process_id = p.process_id
+        WHERE p.process_id > :last AND p.process_id <= :top AND %s IS NOT NULL GROUP BY %s''' % (expr, expr, expr),
+        'INSERT OR IGNORE INTO summary_%s (%s, %s, max_rss%s) SELECT grp, %s, NULL%s FROM summary_delta' % (
+            group, key, ', '.join(SUMS), ''.join([', ' + x for x in times]), ', '.join(['0'] * len(SUMS)), ', NULL' * len(times)),
+        'UPDATE summary_%s SET %s WHERE %s IN (SELECT grp FROM summary_delta)' % (group, ', '.join(updates), key),
+        'DROP TABLE summary_delta'])
+
+
+
+## Rebuild the summary tables from scratch (e.g. after rows were deleted)
+def rebuild(db):
+    sqlite.initSqliteDb(db)
+    sqlite.getWriter(db).execute([('DELETE FROM summary_%s' % (x), ()) for x in GROUPS] + [("DELETE FROM summary_state WHERE name = 'last_process_id'", ())])
+    return(refresh(db))
+
+
+
+## Summary rows as dictionaries, with mean wall clock time per job and CPU efficiency (CPU time / reserved thread time)
+def query(db, sql, params=()):
+    conn = sqlite3.connect(db, timeout=1000)
+    try:
+        c = conn.execute(sql, params)
+        columns = [x[0] for x in c.description]
+        rows = [dict(zip(columns, x)) for x in c.fetchall()]
+    finally:
+        conn.close()
+    for x in rows:
+        x['mean_wc_time'] = x['wc_time'] / x['jobs'] if x['jobs'] else 0
+        x['cpu_efficiency'] = x['cpu_time'] / x['thread_time'] if x['thread_time'] else 0
+    return(rows)
+
+
+
+## Per-rule summary, slowest rules first
+def ruleSummary(db, refresh_first=True):
+    if refresh_first:
+        refresh(db)
+    return(query(db, 'SELECT * FROM summary_rule ORDER BY wc_time DESC'))
+
+
+
+## Per-sample summary (one sample or all, in sample order)
+def sampleSummary(db, sample=None, refresh_first=True):
+    if refresh_first:
+        refresh(db)
+    where = ' WHERE s.sample_name = ?' if sample is not None else ''
+    return(query(db, 'SELECT s.sample_name, x.* FROM summary_sample x JOIN sample s ON s.sample_id = x.sample_id%s ORDER BY x.sample_id' % (where),
+                 (sample, ) if sample is not None else ()))
+
+
+
+## Per-run summary (one run or all, latest first) with the run's status and number of samples
+def runSummary(db, run_id=None, refresh_first=True):
+    if refresh_first:
+        refresh(db)
+    where = ' WHERE x.run_id = ?' if run_id is not None else ''
+    return(query(db, '''SELECT x.*, r.status, r.host, r.start_time AS run_start, r.end_time AS run_end,
+        (SELECT COUNT(DISTINCT p.sample_id) FROM process p WHERE p.run_id = x.run_id) AS samples
+        FROM summary_run x JOIN run r ON r.run_id = x.run_id%s ORDER BY x.run_id DESC''' % (where), (run_id, ) if run_id is not None else ()))
+
+
+
+## Write summary rows as a tab-separated table
+def writeTable(rows, out=sys.stdout):
+    if len(rows) == 0:
+        return
+    columns = list(rows[0].keys())
+    out.write('\t'.join(columns) + '\n')
+    for x in rows:
+        out.write('\t'.join(['%.3f' % (x[k]) if isinstance(x[k], float) else '' if x[k] is None else str(x[k]) for k in columns]) + '\n')
+
+
+
+## rseqrep summary [options]
+def main(argv):
+    parser = argparse.ArgumentParser(prog='rseqrep summary', description='Summarize the processes recorded in a log database per rule, sample or run')
+    parser.add_argument('db',                   help='Log database (<log file>.db).')
+    parser.add_argument('--by',                 help='Summary to print (default rule).', choices=list(GROUPS), default='rule')
+    parser.add_argument('--sample',             help='Only this sample (--by sample).', default=None)
+    parser.add_argument('--run',                help='Only this run ID (--by run).', type=int, default=None)
+    parser.add_argument('--rebuild',            help='Rebuild the summary tables from all recorded processes.', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        logging.error('Log database %s not found' % (args.db))
+        return(1)
+    try:
+        start_time = time.time()
+        n = rebuild(args.db) if args.rebuild else refresh(args.db)
+        logging.info('Summaries updated with %s process(es) in %.3fs' % (n, time.time() - start_time))
+        rows = {'rule': lambda: ruleSummary(args.db, False), 'sample': lambda: sampleSummary(args.db, args.sample, False),
+                'run': lambda: runSummary(args.db, args.run, False)}[args.by]()
+    except sqlite3.Error as e:
+        logging.error('Summary failed: %s' % (e))
+        return(1)
+    writeTable(rows)
+    return(0)
@@ -0,0 +1,144 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  manifest.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Sample manifest: per-sample inputs, adapters and log database IDs with constant time lookups
+# Input:    sample configuration, log database
+# Output:   manifest file (JSON)
+#############################################################################################################
+
+import os
+import json
+import sqlite3
+
+## Manifest format version (a file with another version is ignored)
+MANIFEST_VERSION = 1
+
+
+
+## Samples of a run in configuration order, stored column-wise with a sample name -> position index
+## fastq1/fastq2 are the input URIs of each end (';' separated for several files), db_ids the sample IDs of
+## the log database (None until attached)
+class SampleManifest:
+    def __init__(self, samples, fastq1, fastq2, fp_adapters, tp_adapters, paired, db_ids=None):
+        self.samples = list(samples)
+        self.fastq1 = self.column(fastq1, '')
+        self.fastq2 = self.column(fastq2, '')
+        self.fp_adapters = self.column(fp_adapters, 'NA')
+        self.tp_adapters = self.column(tp_adapters, 'NA')
+        self.paired = paired
+        self.db_ids = self.column(db_ids, None) if db_ids is not None else [None] * len(self.samples)
+        self.index = dict([(x, i) for i, x in enumerate(self.samples)])
+        if len(self.index) != len(self.samples):
+            raise RuntimeError('Duplicate sample IDs in the sample configuration')
+
+
+    ## One value per sample (a single configured value applies to all samples)
+    def column(self, values, default):
+        values = list(values)
+        if len(values) == 1 and len(self.samples) > 1:
+            return(values * len(self.samples))
+        return(values + [default] * (len(self.samples) - len(values)))
+
+
+    def position(self, sample):
+        if sample not in self.index:
+            raise KeyError('Sample %s is not in the manifest' % (sample))
+        return(self.index[sample])
+
+
+    ## Input URIs of a sample, one per end
+    def inputs(self, sample):
+        i = self.position(sample)
+        return([self.fastq1[i], self.fastq2[i]] if self.paired else [self.fastq1[i]])
+
+
+    def adapters(self, sample):
+        i = self.position(sample)
+        return({'tp': self.tp_adapters[i], 'fp': self.fp_adapters[i]})
+
+
+    def dbId(self, sample):
+        return(self.db_ids[self.position(sample)])
+
+
+    ## sample name -> log database ID of the samples with a known ID
+    def dbIds(self):
+        return(dict([(x, y) for x, y in zip(self.samples, self.db_ids) if y is not None]))
+
+
+    ## Fill in the sample IDs of the log database (one query for all samples)
+    def attach(self, db):
+        conn = sqlite3.connect(db, timeout=1000)
+        try:
+            ids = dict(conn.execute('SELECT sample_name, sample_id FROM sample').fetchall())
+        finally:
+            conn.close()
+        self.db_ids = [ids.get(x, None) for x in self.samples]
+        return(self)
+
+
+    ## Columns, as written to the manifest file
+    def columns(self):
+        return({'samples': self.samples, 'fastq1': self.fastq1, 'fastq2': self.fastq2, 'fp_adapters': self.fp_adapters,
+                'tp_adapters': self.tp_adapters, 'db_ids': self.db_ids})
+
+
+    ## Does another manifest describe the same samples and inputs (database IDs aside)?
+    def matches(self, other):
+        a, b = self.columns(), other.columns()
+        return(self.paired == other.paired and all([a[k] == b[k] for k in a if k != 'db_ids']))
+
+
+    ## Write the manifest (compact JSON, replaced atomically so concurrent readers never see a partial file)
+    def save(self, file):
+        with open(file + '.tmp', 'w') as f:
+            json.dump(dict([('version', MANIFEST_VERSION), ('paired', self.paired)] + list(self.columns().items())), f, separators=(',', ':'))
+        os.replace(file + '.tmp', file)
+        return(file)
+
+
+
+## Read a manifest file, None if it is missing, unreadable or of another version
+def readManifest(file):
+    try:
+        with open(file) as f:
+            x = json.load(f)
+    except (IOError, ValueError):
+        return(None)
+    if x.get('version', None) != MANIFEST_VERSION:
+        return(None)
+    return(SampleManifest(x['samples'], x['fastq1'], x['fastq2'], x['fp_adapters'], x['tp_adapters'], x['paired'], x['db_ids']))
+
+
+
+## Manifest of the configured samples: the one in file (written at the start of the run, with the database
+## IDs) if it describes the same samples and inputs, otherwise the configured samples without IDs
+def loadManifest(file, samples, fastq1, fastq2, fp_adapters, tp_adapters, paired):
+    res = SampleManifest(samples, fastq1, fastq2, fp_adapters, tp_adapters, paired)
+    saved = readManifest(file) if os.path.exists(file) else None
+    if saved is not None and saved.matches(res):
+        return(saved)
+    return(res)
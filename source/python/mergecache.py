@@ -0,0 +1,119 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  mergecache.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Incremental merging of per-sample result files
+# Input:    N/A
+# Output:   N/A
+#############################################################################################################
+
+import os
+import json
+import logging
+import checksum
+
+
+
+## Find files below a directory whose name ends with suffix (sorted by path)
+def findFiles(dir, suffix):
+    res = []
+    for root, dirs, files in os.walk(dir):
+        res.extend([os.path.join(root, f) for f in files if f.endswith(suffix)])
+    return(sorted(res))
+
+
+
+## Fingerprint files by content (through the checksum cache) when a hash and cache database
+## are given, otherwise by size/mtime/inode
+def fingerprints(files, hash=None, cache_db=None):
+    if hash and cache_db:
+        return(checksum.checksumFiles(files, hash, cache_db=cache_db))
+    return(['%s:%s:%s' % checksum.fileKey(f) for f in files])
+
+
+
+## Load/save a JSON cache index
+def loadIndex(file, default):
+    if os.path.exists(file):
+        with open(file) as f:
+            return(json.load(f))
+    return(default)
+
+def saveIndex(file, index):
+    if not os.path.isdir(os.path.dirname(os.path.abspath(file))):
+        os.makedirs(os.path.dirname(os.path.abspath(file)))
+    with open(file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(file + '.tmp', file)
+
+
+
+## Maintain a merged table (header + per-sample rows) incrementally
+## Only new or changed files are parsed; new samples are appended to the existing output,
+## any other change rewrites the output from the cached per-sample rows
+## The index records the size of the output it describes: an output that does not match it (e.g. an
+## append that was interrupted before the index was saved) is rewritten instead of appended to
+## parse(files) must return (header, {file: [rows]}), with the table's fixed header for no files
+def mergeTable(files, out_file, parse, cache_dir, hash=None, cache_db=None):
+    index_file = os.path.join(cache_dir, os.path.basename(out_file) + '.json')
+    index = loadIndex(index_file, {'header': None, 'order': [], 'files': {}, 'size': None})
+    fps = dict(zip(files, fingerprints(files, hash, cache_db)))
+
+    ## Determine what changed since the last merge
+    changed = [f for f in files if f not in index['files'] or index['files'][f]['fp'] != fps[f]]
+    removed = [f for f in index['files'] if f not in fps]
+    added = [f for f in changed if f not in index['files']]
+    logging.info('Merging %s: %s new, %s changed, %s removed, %s cached sample file(s)' % (out_file, len(added), len(changed) - len(added), len(removed), len(files) - len(changed)))
+    intact = os.path.exists(out_file) and os.path.getsize(out_file) == index.get('size')
+    if len(changed) == 0 and len(removed) == 0 and intact:
+        return(out_file)
+
+    ## Parse new/changed files (no files: just the header), update the cache
+    header = index['header']
+    new_header, rows = parse(changed)
+    if header is None:
+        header = new_header
+    for f in changed:
+        index['files'][f] = {'fp': fps[f], 'rows': rows[f]}
+    for f in removed:
+        del index['files'][f]
+
+    ## Keep the existing output order, new samples go last
+    append = len(added) == len(changed) and len(removed) == 0 and header == index['header'] and intact
+    index['order'] = [f for f in index['order'] if f in fps] + added
+    index['header'] = header
+
+    if append:
+        with open(out_file, 'a') as out:
+            [out.write(x + '\n') for f in added for x in index['files'][f]['rows']]
+    else:
+        with open(out_file + '.tmp', 'w') as out:
+            out.write(header + '\n')
+            [out.write(x + '\n') for f in index['order'] for x in index['files'][f]['rows']]
+        os.replace(out_file + '.tmp', out_file)
+
+    index['size'] = os.path.getsize(out_file)
+    saveIndex(index_file, index)
+    return(out_file)
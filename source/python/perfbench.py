@@ -0,0 +1,452 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  perfbench.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Per-rule performance reports and regression benchmarks (rseqrep benchmark)
+# Input:    log database, optional baseline JSON
+# Output:   CSV/JSON performance reports
+#############################################################################################################
+
+import os
+import re
+import sys
+import csv
+import gzip
+import json
+import time
+import random
+import sqlite3
+import logging
+import argparse
+import subprocess
+
+## Metrics reported per rule (seconds, MB for memory, bytes for I/O), and the minimum absolute change 
+## that can count as a regression (small fixtures produce noisy timings, so tiny differences are ignored)
+METRICS = ['wc_time', 'cpu_time', 'resident_set_size', 'io_read_bytes', 'io_write_bytes']
+MIN_DELTA = {'wc_time': 2, 'cpu_time': 2, 'resident_set_size': 64, 'io_read_bytes': 64 * 1024 * 1024, 'io_write_bytes': 64 * 1024 * 1024}
+
+## Default relative slowdown/growth that is flagged as a regression
+THRESHOLD = 0.25
+
+## Files whose imports of helper modules are timed by the import benchmark (relative to the source directory),
+## modules the helpers must not pull in at import time, and the minimum import time increase (seconds)
+## that can count as a regression
+IMPORT_SOURCES = [os.path.join('snakemake', 'Snakefile.sh'), os.path.join('python', 'rseqrep')]
+HEAVY_MODULES = ['snakemake', 'psutil']
+IMPORT_MIN_DELTA = 0.05
+
+## Compression settings timed by the compression benchmark: gzip level and whether the policy's threads are used
+## ('tool default' is what the tools write without the policy: level 6, one thread)
+COMPRESSION = {'tool default': (6, False), 'intermediate': (None, True), 'final': (None, True)}
+
+## Programs used by the fixture configuration (found on the PATH unless overridden by --config)
+PROGRAMS = {'rseqc_dir': '', 'samtools_prog': 'samtools', 'hisat_prog': 'hisat2', 'bowtie_prog': 'bowtie2', 'fcts_prog': 'featureCounts',
+            'aws_prog': 'aws', 'openssl_prog': 'openssl', 'fastqc_prog': 'fastqc', 'cutadapt_prog': 'cutadapt', 'fastqdump_prog': 'fastq-dump',
+            'trimmomatic_prog': 'trimmomatic'}
+
+
+
+########################
+# Synthetic fixture    #
+########################
+
+## Random DNA sequence
+def randomSeq(rng, n):
+    return(''.join([rng.choice('ACGT') for i in range(n)]))
+
+
+
+## Write a small genome, GTF/BED annotation and single-end FASTQ files, plus a matching preprocess_config.yaml
+## Reads are sampled from the exons of the synthetic genes so every stage of the DAG has work to do
+def makeFixture(workdir, srcdir, samples=2, reads=20000, read_length=75, genes=20, seed=1, programs={}):
+    rng = random.Random(seed)
+    [os.makedirs(os.path.join(workdir, x), exist_ok=True) for x in ['genome', 'annot', 'fixture', 'data']]
+    genome_file = os.path.join(workdir, 'genome', 'Homo_sapiens.ensembl.version0.genome.fa')
+    gtf_file = os.path.join(workdir, 'annot', 'Homo_sapiens.ensembl.version0.chr.gtf')
+    bed_file = os.path.join(workdir, 'annot', 'Homo_sapiens.ensembl.version0.chr.bed')
+
+    ## Genome: one chromosome, genes of three exons separated by introns and intergenic sequence
+    chrom, transcripts, pos = [], [], 1
+    for g in range(genes):
+        chrom.append(randomSeq(rng, 500))
+        pos += 500
+        exons = []
+        for e in range(3):
+            exons.append((pos, pos + 299))
+            chrom.append(randomSeq(rng, 300))
+            pos += 300
+            if e < 2:
+                chrom.append('GT' + randomSeq(rng, 196) + 'AG')
+                pos += 200
+        transcripts.append(exons)
+    chrom.append(randomSeq(rng, 500))
+    chrom = ''.join(chrom)
+    with open(genome_file, 'w') as f:
+        f.write('>1\n')
+        [f.write(chrom[i:i+60] + '\n') for i in range(0, len(chrom), 60)]
+
+    ## Annotation
+    with open(gtf_file, 'w') as f:
+        for g, exons in enumerate(transcripts):
+            attr = 'gene_id "ENSG%011d"; transcript_id "ENST%011d"; gene_name "GENE%s"; gene_biotype "protein_coding";' % (g, g, g)
+            f.write('\t'.join(['1', 'fixture', 'gene', str(exons[0][0]), str(exons[-1][1]), '.', '+', '.', attr]) + '\n')
+            f.write('\t'.join(['1', 'fixture', 'transcript', str(exons[0][0]), str(exons[-1][1]), '.', '+', '.', attr]) + '\n')
+            [f.write('\t'.join(['1', 'fixture', 'exon', str(s), str(e), '.', '+', '.', attr]) + '\n') for s, e in exons]
+    with open(bed_file, 'w') as f:
+        subprocess.run(['perl', os.path.join(srcdir, 'perl', 'gtf2bed.pl'), gtf_file], stdout=f, check=True)
+
+    ## Reads: uniform over genes, sampled from the spliced transcript sequence
+    mrna = [''.join([chrom[s-1:e] for s, e in exons]) for exons in transcripts]
+    fastq = []
+    for s in range(samples):
+        fastq.append(os.path.abspath(os.path.join(workdir, 'fixture', 'S%s.fastq.gz' % (s+1))))
+        with gzip.open(fastq[-1], 'wt', compresslevel=1) as f:
+            for r in range(reads):
+                x = mrna[rng.randrange(len(mrna))]
+                start = rng.randrange(len(x) - read_length)
+                f.write('@S%s.%s\n%s\n+\n%s\n' % (s+1, r, x[start:start+read_length], 'I' * read_length))
+
+    ## Workflow configuration (same keys as written by parse-configuration.r)
+    config = dict(PROGRAMS)
+    config.update(programs)
+    config.update({'fp_adapter_seq': ['NA'] * samples, 'tp_adapter_seq': ['NA'] * samples, 'ensembl_version': 0, 'ion_torrent': 0,
+                   'save_cram': 0, 'run_read_dist': 0, 'run_fastqc': 0, 'samid': ['S%s' % (s+1) for s in range(samples)], 'fastq1': fastq,
+                   'fastq2': [''] * samples, 'stranded': 0, 'archive_bucket': '', 'encrypt_local': 0, 'decrypt_pass': '', 'quality_trim': 0,
+                   'hash': 'md5'})
+    writeYaml(config, os.path.join(workdir, 'preprocess_config.yaml'))
+
+    ## Sample metadata, copied to the data directory with the merged results
+    with open(os.path.join(workdir, 'sample_metadata.csv'), 'w') as f:
+        f.write('samid,fastq_file_1,fastq_file_2,threep_adapter_seq,fivep_adapter_seq\n')
+        [f.write('%s,%s,,,\n' % (x, y)) for x, y in zip(config['samid'], fastq)]
+    return(config)
+
+
+
+## Write a flat configuration dictionary as YAML (values are strings, numbers or lists)
+def writeYaml(config, file):
+    def value(x):
+        return(json.dumps(x) if isinstance(x, str) else str(x))
+    with open(file, 'w') as f:
+        for k in sorted(config.keys()):
+            if isinstance(config[k], list):
+                f.write('%s:\n' % (k))
+                [f.write('  - %s\n' % (value(x))) for x in config[k]]
+            else:
+                f.write('%s: %s\n' % (k, value(config[k])))
+
+
+
+## Read program locations from an existing preprocess_config.yaml
+def readPrograms(file):
+    import yaml
+    with open(file) as f:
+        config = yaml.safe_load(f)
+    return(dict([(k, config[k]) for k in PROGRAMS if k in config]))
+
+
+
+########################
+# Run the workflow     #
+########################
+
+## Run the pre-processing DAG on the fixture, returns the log database
+def runPipeline(workdir, srcdir, threads=1, log_level=logging.INFO):
+    import snakemake
+    import utils
+    workdir = os.path.abspath(workdir)
+    log_file = os.path.join(workdir, 'benchmark.log')
+    [os.remove(x) for x in [log_file, log_file + '.db'] if os.path.exists(x)]
+    os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+    ok = snakemake.snakemake(snakefile=os.path.join(srcdir, 'snakemake', 'Snakefile.sh'),
+                             workdir=workdir,
+                             config={'srcdir': srcdir, 'datadir': os.path.join(workdir, 'data'), 'log_level': log_level,
+                                     'log_file': log_file, 'ncores': threads, 'saveintlocalfiles': False},
+                             cores=threads,
+                             forceall=True,
+                             log_handler=utils.logHandler)
+    if not ok:
+        raise RuntimeError('Benchmark workflow failed, see %s' % (log_file))
+    return(log_file + '.db')
+
+
+
+########################
+# Reports              #
+########################
+
+## Summarize the successful processes in a log database per rule
+## Times are summed over samples, memory is the peak over samples
+def ruleSummary(db):
+    conn = sqlite3.connect(db)
+    columns = [x[1] for x in conn.execute('PRAGMA table_info(process)')]
+    group = 'p.rule' if 'rule' in columns else 'p.process_str'
+    rows = conn.execute('''SELECT %s, COUNT(*), SUM(b.wc_time), SUM(b.cpu_time), MAX(b.resident_set_size), SUM(b.io_read_bytes), SUM(b.io_write_bytes)
+        FROM benchmark b JOIN process p ON b.process_id = p.process_id WHERE b.return_code = 0 GROUP BY %s ORDER BY MIN(p.start_time)''' % (group, group)).fetchall()
+    conn.close()
+    res = {}
+    for row in rows:
+        res[row[0] or 'unknown'] = dict(zip(['processes'] + METRICS, [x or 0 for x in row[1:]]))
+    return(res)
+
+
+
+## Compare a summary against a baseline, returns a list of regressions
+def compare(summary, baseline, threshold=THRESHOLD, metrics=METRICS, min_delta=MIN_DELTA):
+    res = []
+    for rule in summary:
+        if rule not in baseline:
+            continue
+        for m in metrics:
+            new, old = summary[rule][m], baseline[rule].get(m, 0)
+            if new - old > min_delta[m] and new > old * (1 + threshold):
+                res.append({'rule': rule, 'metric': m, 'baseline': old, 'current': new, 'change': (new - old) / old if old > 0 else None})
+    return(res)
+
+
+
+## Export a summary as CSV (one row per rule) or JSON
+## Import and compression benchmarks are stored under 'imports' and 'compression' instead of 'rules', so one baseline file can hold all
+def writeCsv(summary, file, columns=['processes'] + METRICS):
+    with open(file, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['rule'] + columns)
+        [w.writerow([rule] + [summary[rule][m] for m in columns]) for rule in summary]
+
+def writeJson(summary, file, regressions=[], key='rules'):
+    res = {}
+    if os.path.exists(file):
+        with open(file) as f:
+            res = json.load(f)
+    res.update({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), key: summary, 'regressions': regressions})
+    with open(file, 'w') as f:
+        json.dump(res, f, indent=2)
+
+def readBaseline(file, key='rules'):
+    with open(file) as f:
+        return(json.load(f).get(key, {}))
+
+
+
+## Print a summary table (and regressions) to the log
+def report(summary, regressions=[]):
+    logging.info('%-24s %5s %10s %10s %10s %10s %10s' % ('rule', 'n', 'wall[s]', 'cpu[s]', 'rss[MB]', 'read[MB]', 'write[MB]'))
+    for rule, x in summary.items():
+        logging.info('%-24s %5s %10.1f %10.1f %10.1f %10.1f %10.1f' % (rule, x['processes'], x['wc_time'], x['cpu_time'], x['resident_set_size'],
+                                                                       x['io_read_bytes'] / 2**20, x['io_write_bytes'] / 2**20))
+    for x in regressions:
+        logging.warning('Regression in %s %s: %s -> %s%s' % (x['rule'], x['metric'], x['baseline'], x['current'],
+                                                            ' (+%.0f%%)' % (100 * x['change']) if x['change'] is not None else ''))
+
+
+
+########################
+# Import benchmark     #
+########################
+
+## Median wall time of a Python command over a number of fresh interpreters
+def pythonTime(args, repeat):
+    res = []
+    for i in range(repeat):
+        start = time.time()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, check=True)
+        res.append(time.time() - start)
+    return(sorted(res)[len(res) // 2])
+
+
+
+## Helper modules imported by the workflow and rseqrep (import lines of IMPORT_SOURCES naming a module of
+## source/python, top-level or inside rules and handlers), in order of first import
+def importModules(srcdir):
+    pydir = os.path.join(srcdir, 'python')
+    res = []
+    for file in IMPORT_SOURCES:
+        with open(os.path.join(srcdir, file)) as f:
+            for line in f:
+                x = re.match(r'\s*(?:import\s+([\w\s,]+?)|from\s+(\w+)\s+import\b.*)\s*$', line)
+                names = [y.strip() for y in (x.group(1) or x.group(2)).split(',')] if x else []
+                res += [y for y in names if y not in res and os.path.isfile(os.path.join(pydir, y + '.py'))]
+    return(res)
+
+
+
+## Time importing each helper module (and rseqrep --version) in a fresh interpreter, net of interpreter startup
+## Also lists any heavy module a helper pulls in at import time
+def importSummary(srcdir, modules=None, repeat=5):
+    pydir = os.path.join(srcdir, 'python')
+    modules = modules if modules is not None else importModules(srcdir)
+    base = pythonTime(['-c', 'pass'], repeat)
+    res = {}
+    for m in modules:
+        code = 'import sys; sys.path.insert(0, %r); import %s' % (pydir, m)
+        heavy = subprocess.run([sys.executable, '-c', code + '; print(" ".join([x for x in %r if x in sys.modules]))' % (HEAVY_MODULES)],
+                               stdout=subprocess.PIPE, check=True).stdout.decode().strip()
+        res[m] = {'wc_time': max(0, pythonTime(['-c', code], repeat) - base), 'heavy_modules': heavy}
+    res['rseqrep --version'] = {'wc_time': max(0, pythonTime([os.path.join(pydir, 'rseqrep'), '--version'], repeat) - base), 'heavy_modules': ''}
+    return(res)
+
+
+
+## Import time regressions, plus any helper that loads a heavy module
+def compareImports(summary, baseline, threshold=THRESHOLD):
+    res = compare(summary, baseline, threshold, metrics=['wc_time'], min_delta={'wc_time': IMPORT_MIN_DELTA})
+    res += [{'rule': m, 'metric': 'heavy_modules', 'baseline': '', 'current': x['heavy_modules'], 'change': None} for m, x in summary.items() if x['heavy_modules']]
+    return(res)
+
+
+
+def reportImports(summary, regressions=[]):
+    logging.info('%-24s %10s  %s' % ('module', 'import[ms]', 'heavy modules'))
+    [logging.info('%-24s %10.1f  %s' % (m, 1000 * x['wc_time'], x['heavy_modules'])) for m, x in summary.items()]
+    [logging.warning('Regression in %s %s: %s -> %s' % (x['rule'], x['metric'], x['baseline'], x['current'])) for x in regressions]
+
+
+
+########################
+# Compression          #
+########################
+
+## Time compressing the decompressed fixture FASTQs with each compression setting
+## Returns setting -> mean wall time and size per sample, and the time saved per sample relative to the tool default
+def compressionSummary(fastq, threads=1):
+    import compression
+    levels = {'intermediate': compression.INTERMEDIATE, 'final': compression.FINAL}
+    res = {}
+    for name, (level, parallel) in COMPRESSION.items():
+        times, sizes = [], []
+        for f in fastq:
+            with gzip.open(f, 'rb') as x:
+                data = x.read()
+            out = f + '.benchmark.gz'
+            start = time.time()
+            with compression.openWrite(out, level or levels[name], threads if parallel else 1) as x:
+                x.write(data)
+            times.append(time.time() - start)
+            sizes.append(os.path.getsize(out))
+            os.remove(out)
+        res[name] = {'wc_time': sum(times) / len(times), 'bytes': sum(sizes) / len(sizes)}
+    [x.update({'saved': res['tool default']['wc_time'] - x['wc_time']}) for x in res.values()]
+    return(res)
+
+
+
+def reportCompression(summary, regressions=[]):
+    logging.info('%-24s %15s %15s %10s' % ('setting', 'wall[s]/sample', 'saved[s]/sample', 'size[MB]'))
+    [logging.info('%-24s %15.2f %15.2f %10.1f' % (m, x['wc_time'], x['saved'], x['bytes'] / 2**20)) for m, x in summary.items()]
+    [logging.warning('Regression in %s %s: %s -> %s' % (x['rule'], x['metric'], x['baseline'], x['current'])) for x in regressions]
+
+
+
+########################
+# Command line         #
+########################
+
+## rseqrep benchmark [options]
+## Returns the exit status: 0 ok, 1 failure, 2 regressions found
+def main(argv, srcdir):
+    parser = argparse.ArgumentParser(prog='rseqrep benchmark', description='Run the pre-processing workflow on a synthetic fixture and report per-rule performance')
+    parser.add_argument('-w','--workdir',       help='Working directory for the fixture and workflow.', default='rseqrep_benchmark')
+    parser.add_argument('-@','--threads',       help='Number of threads to use.', type=int, default=1)
+    parser.add_argument('--config',             help='Existing preprocess_config.yaml to take program locations from.', default=None)
+    parser.add_argument('--samples',            help='Number of fixture samples.', type=int, default=2)
+    parser.add_argument('--reads',              help='Number of reads per fixture sample.', type=int, default=20000)
+    parser.add_argument('--db',                 help='Report on an existing log database instead of running the fixture.', default=None)
+    parser.add_argument('--imports',            help='Benchmark helper module import times instead of running the fixture.', action='store_true', default=False)
+    parser.add_argument('--compression',        help='Benchmark the compression policy on the fixture reads instead of running the fixture.', action='store_true', default=False)
+    parser.add_argument('--baseline',           help='Baseline JSON to compare against.', default=None)
+    parser.add_argument('--threshold',          help='Relative increase flagged as a regression (default %s).' % (THRESHOLD), type=float, default=THRESHOLD)
+    parser.add_argument('--save-baseline',      help='Write the results as a new baseline JSON.', default=None)
+    parser.add_argument('--csv',                help='Export per-rule results as CSV.', default=None)
+    parser.add_argument('--json',               help='Export per-rule results (and regressions) as JSON.', default=None)
+    args = parser.parse_args(argv)
+
+    if args.imports:
+        return(importMain(args, srcdir))
+    if args.compression:
+        return(compressionMain(args, srcdir))
+
+    try:
+        if args.db is None:
+            programs = readPrograms(args.config) if args.config is not None else {}
+            logging.info('Creating benchmark fixture in %s' % (args.workdir))
+            makeFixture(args.workdir, srcdir, samples=args.samples, reads=args.reads, programs=programs)
+            args.db = runPipeline(args.workdir, srcdir, threads=args.threads, log_level=logging.getLogger('').level)
+        summary = ruleSummary(args.db)
+    except (RuntimeError, subprocess.CalledProcessError, sqlite3.Error) as e:
+        logging.error('Benchmark failed: %s' % (e))
+        return(1)
+
+    regressions = compare(summary, readBaseline(args.baseline), args.threshold) if args.baseline is not None else []
+    report(summary, regressions)
+    if args.csv is not None:
+        writeCsv(summary, args.csv)
+    if args.json is not None:
+        writeJson(summary, args.json, regressions)
+    if args.save_baseline is not None:
+        writeJson(summary, args.save_baseline)
+    return(2 if len(regressions) > 0 else 0)
+
+
+
+## rseqrep benchmark --imports
+def importMain(args, srcdir):
+    try:
+        summary = importSummary(srcdir)
+    except subprocess.CalledProcessError as e:
+        logging.error('Import benchmark failed: %s' % (e))
+        return(1)
+
+    regressions = compareImports(summary, readBaseline(args.baseline, 'imports') if args.baseline is not None else {}, args.threshold)
+    reportImports(summary, regressions)
+    if args.csv is not None:
+        writeCsv(summary, args.csv, columns=['wc_time', 'heavy_modules'])
+    if args.json is not None:
+        writeJson(summary, args.json, regressions, key='imports')
+    if args.save_baseline is not None:
+        writeJson(summary, args.save_baseline, key='imports')
+    return(2 if len(regressions) > 0 else 0)
+
+
+
+## rseqrep benchmark --compression
+def compressionMain(args, srcdir):
+    try:
+        logging.info('Creating benchmark fixture in %s' % (args.workdir))
+        config = makeFixture(args.workdir, srcdir, samples=args.samples, reads=args.reads)
+        summary = compressionSummary(config['fastq1'], args.threads)
+    except (RuntimeError, OSError, subprocess.CalledProcessError) as e:
+        logging.error('Compression benchmark failed: %s' % (e))
+        return(1)
+
+    baseline = readBaseline(args.baseline, 'compression') if args.baseline is not None else {}
+    regressions = compare(summary, baseline, args.threshold, metrics=['wc_time'], min_delta={'wc_time': 0.1})
+    reportCompression(summary, regressions)
+    if args.csv is not None:
+        writeCsv(summary, args.csv, columns=['wc_time', 'saved', 'bytes'])
+    if args.json is not None:
+        writeJson(summary, args.json, regressions, key='compression')
+    if args.save_baseline is not None:
+        writeJson(summary, args.save_baseline, key='compression')
+    return(2 if len(regressions) > 0 else 0)
@@ -0,0 +1,151 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  planner.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Plan rule threads and memory from the benchmark history in the log database
+# Input:    log database
+# Output:   N/A
+#############################################################################################################
+
+import os
+import math
+import sqlite3
+import logging
+import sqlite
+
+## Number of most recent jobs per rule used for planning
+HISTORY_JOBS = 20
+
+## Processes recorded per job at most (a fused job records one per stage)
+JOB_PROCESSES = 4
+
+## A rule whose CPU time / wall time reaches this fraction of its threads is considered to scale,
+## and is offered twice as many threads next time
+SCALING = 0.7
+
+## Extra memory on top of the predicted peak; every retry (snakemake --restart-times) adds the same again
+MEM_HEADROOM = 1.25
+
+## Smallest memory request in MB
+MIN_MEM_MB = 256
+
+
+
+## Median of a non-empty list
+def median(x):
+    x = sorted(x)
+    n = len(x)
+    return(x[n // 2] if n % 2 == 1 else (x[n // 2 - 1] + x[n // 2]) / 2)
+
+
+
+## Total size of the input files of a job (files that do not exist yet count as 0)
+def inputBytes(input):
+    return(sum([os.path.getsize(f) for f in input if os.path.isfile(f)]))
+
+
+
+## Load the benchmark history of rules from a log database: rule -> list of jobs, newest first
+## Each job is a dict with sample, threads, input_bytes, cpu_time, wc_time and rss (MB); the processes of
+## a fused job (recorded per stage with the same start time) are added up
+## Only the latest processes of each rule are read (from the end of the (rule, return_code) index), so the
+## cost does not grow with the history kept in the database. Processes of the current run are left out:
+## its jobs parse the Snakefile again in their own processes and must plan the same threads as the
+## scheduler did before the run started
+def loadHistory(db, rules, jobs=HISTORY_JOBS):
+    res = dict([(x, []) for x in rules])
+    if not os.path.exists(db):
+        return(res)
+    run_id = sqlite.currentRun()
+    conn = sqlite3.connect(db, timeout=1000)
+    try:
+        columns = [x[1] for x in conn.execute('PRAGMA table_info(process)')]
+        if 'threads' not in columns or 'run_id' not in columns:
+            return(res)
+        for rule in rules:
+            rows = conn.execute('''SELECT s.sample_name, MAX(p.threads), MAX(p.input_bytes), SUM(b.cpu_time), MAX(b.wc_time), SUM(b.resident_set_size)
+                FROM process p JOIN benchmark b ON b.process_id = p.process_id LEFT JOIN sample s ON s.sample_id = p.sample_id
+                WHERE p.process_id IN (SELECT process_id FROM process WHERE rule = ? AND return_code = 0 AND threads IS NOT NULL
+                                       AND (run_id IS NULL OR run_id != ?) ORDER BY process_id DESC LIMIT ?) AND b.return_code = 0
+                GROUP BY p.sample_id, p.start_time ORDER BY p.start_time DESC LIMIT ?''', (rule, run_id or 0, jobs * JOB_PROCESSES, jobs)).fetchall()
+            res[rule] = [{'sample': sample, 'threads': threads, 'input_bytes': input_bytes or 0, 'cpu_time': cpu_time or 0, 'wc_time': wc_time or 0,
+                          'rss': rss or 0} for sample, threads, input_bytes, cpu_time, wc_time, rss in rows]
+    finally:
+        conn.close()
+    return(res)
+
+
+
+## Plans threads (per rule, when the Snakefile is parsed) and memory (per job, from its input size)
+## Rules without history keep their default threads and memory; a rule's history is loaded when it is
+## first planned
+class ResourcePlanner:
+    def __init__(self, db, ncores, mem_mb=0):
+        self.db = db
+        self.ncores = max(1, ncores)
+        self.mem_mb = mem_mb
+        self.history = {}
+
+
+    ## Latest jobs of a rule, newest first
+    def jobs(self, rule):
+        if rule not in self.history:
+            self.history.update(loadHistory(self.db, [rule]))
+            logging.debug('Resource planner: %s job(s) of history for %s' % (len(self.history[rule]), rule))
+        return(self.history[rule])
+
+
+    ## Thread count for a rule: grow while the rule keeps its threads busy, otherwise shrink to the
+    ## parallelism it actually achieved
+    def threads(self, rule, default, cap=None):
+        cap = min(self.ncores, cap if cap is not None else self.ncores)
+        jobs = [x for x in self.jobs(rule) if x['wc_time'] > 0]
+        if len(jobs) == 0:
+            return(max(1, min(default, cap)))
+        threads = median([x['threads'] for x in jobs])
+        used = median([x['cpu_time'] / x['wc_time'] for x in jobs])
+        planned = threads * 2 if used >= SCALING * threads else math.ceil(used)
+        return(int(max(1, min(planned, cap))))
+
+
+    ## Predicted peak memory (MB) of a job: the peak of earlier jobs of the same sample (or of any sample),
+    ## scaled up when the current input is larger than theirs
+    def predictMem(self, rule, sample, input_bytes, default):
+        jobs = self.jobs(rule)
+        jobs = [x for x in jobs if x['sample'] == sample] or jobs
+        if len(jobs) == 0:
+            return(default)
+        return(max([x['rss'] * max(1, input_bytes / x['input_bytes'] if x['input_bytes'] > 0 else 1) for x in jobs]))
+
+
+    ## Memory request for a rule as a Snakemake resource callable
+    ## Requests are capped at the memory available to the workflow so no job becomes unschedulable
+    def mem(self, rule, default):
+        def mem_mb(wildcards, input, attempt):
+            sample = wildcards.get('sample', None) if hasattr(wildcards, 'get') else None
+            mb = self.predictMem(rule, sample, inputBytes(input), default) * MEM_HEADROOM * attempt
+            mb = max(MIN_MEM_MB, int(math.ceil(mb)))
+            return(min(mb, self.mem_mb) if self.mem_mb > 0 else mb)
+        return(mem_mb)
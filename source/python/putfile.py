@@ -29,12 +29,37 @@
 # Output:   N/A
 #############################################################################################################
 
+import os
+import sys
+import glob
+import json
+import time
 import subprocess
 import logging
+import threading
+import uuid
 import utils
+import sqlite
+import checksum
+import transfer
+
+## Background uploads: each one is described by a record (<id>.json) in UPLOAD_DIR and run by a detached
+## uploader process (this script), which writes <id>.done or <id>.failed once it is finished. Snakemake runs
+## the jobs in their own processes, so these files (not module state) are what waitForUploads() checks
+UPLOAD_DIR = os.path.join('progress', 'uploads')
+
+## Seconds between checks for finished background uploads, and seconds after which a record whose uploader
+## never registered its process ID counts as failed
+UPLOAD_POLL = 1
+UPLOAD_START_TIMEOUT = 60
+
+## Environment variable passing the encryption password to the uploader
+UPLOAD_PASSWORD_ENV = 'RSEQREP_UPLOAD_PASSWORD'
+
 
 
 ## Upload to an Amazon S3 bucket, preserving folder structure
+## Files are uploaded concurrently; the local copy is removed after a successful upload if rm=True
 def s3Upload(file, destination, prog='aws', rm=True):
     if destination[-1] != '/':
         destination += '/'
@@ -42,27 +67,287 @@ def s3Upload(file, destination, prog='aws', rm=True):
     if not isinstance(file, list):
         file = file.split(' ')
 
+    ## Attempt to upload
+    try:
+        transfer.s3Copy([(f, destination+f) for f in file], prog=prog)
+    except subprocess.CalledProcessError:
+        logging.error('S3 upload failed. See above for more details.')
+        exit(1)
+    
+    ## remove encrypted file after uploading
+    if (rm):
+        [os.remove(f) for f in file]
+    return(True)
+
+
+
+## Stage files as hard links next to the originals, so snakemake can remove the job's (temporary) outputs
+## while they are still being uploaded
+def stage(file):
+    staged = []
     for f in file:
-        cmd = '%s s3 cp %s %s' % (prog, f, destination+f)
-        ## command to remove encrypted file
-        if (rm):
-            cmd_rm = 'rm %s' % (f)
+        x = os.path.join(os.path.dirname(f), '.upload.%s.%s' % (uuid.uuid4().hex[:8], os.path.basename(f)))
+        os.link(f, x)
+        staged.append(x)
+    return(staged)
+
+
+
+def writeRecord(file, record):
+    with open(file + '.tmp', 'w') as f:
+        json.dump(record, f)
+    os.replace(file + '.tmp', file)
+
+
+
+## Write a background upload record and start its uploader, detached from the job so the job can finish
+## right away; secrets are passed in the uploader's environment, never written to the record
+def startBackground(record, env={}):
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    base = os.path.join(UPLOAD_DIR, uuid.uuid4().hex)
+    writeRecord(base + '.json', record)
+    with open(base + '.log', 'w') as log:
+        p = subprocess.Popen([sys.executable, os.path.abspath(__file__), base + '.json'], stdin=subprocess.DEVNULL, stdout=log,
+                             stderr=subprocess.STDOUT, start_new_session=True, env=dict(os.environ, **env))
+    with open(base + '.pid', 'w') as f:
+        f.write(str(p.pid))
+    return(base)
+
+
+
+## Upload in the background and return immediately -- waitForUploads() (onsuccess/onerror) reports failures
+## The local files are removed (rm=True) only after a successful upload; after a failure the staged
+## copies are kept
+def s3UploadBackground(file, destination, prog='aws', rm=True):
+    if destination[-1] != '/':
+        destination += '/'
+
+    if not isinstance(file, list):
+        file = file.split(' ')
+    return(startBackground({'kind': 'upload', 'file': file, 'staged': stage(file), 'destination': destination, 'prog': prog, 'rm': rm,
+                            'retries': transfer.TRANSFER_RETRIES, 'endpoint_url': transfer.ENDPOINT_URL}))
+
+
+
+## Uploader of a plain background upload record
+def uploadStaged(record):
+    transfer.s3Copy([(x, record['destination'] + f) for f, x in zip(record['file'], record['staged'])], prog=record['prog'],
+                    retries=record['retries'], endpoint_url=record['endpoint_url'])
+    if record['rm']:
+        [os.remove(f) for f in record['file'] if os.path.exists(f)]
+    [os.remove(x) for x in record['staged']]
+
+
+
+## Is a background upload finished? An uploader that is gone without writing a result has failed
+def uploadFinished(base):
+    if os.path.exists(base + '.done') or os.path.exists(base + '.failed'):
+        return(True)
+    try:
+        with open(base + '.pid') as f:
+            os.kill(int(f.read()), 0)
+        return(False)
+    except (IOError, ValueError):
+        if time.time() - os.path.getmtime(base + '.json') < UPLOAD_START_TIMEOUT:
+            return(False)
+    except OSError:
+        pass
+    with open(base + '.failed', 'w') as f:
+        f.write('uploader exited without a result')
+    return(True)
+
+
+
+## Block until all background uploads (started by any job of this working directory) are done; exit if any
+## of them failed. Records of failed uploads are moved to UPLOAD_DIR/failed, with the uploader's log
+def waitForUploads():
+    failed = []
+    for record_file in sorted(glob.glob(os.path.join(UPLOAD_DIR, '*.json'))):
+        base = record_file[:-len('.json')]
+        while not uploadFinished(base):
+            time.sleep(UPLOAD_POLL)
+        if os.path.exists(base + '.done'):
+            [os.remove(base + x) for x in ['.json', '.done', '.pid', '.log'] if os.path.exists(base + x)]
+            continue
+        with open(record_file) as f:
+            record = json.load(f)
+        with open(base + '.failed') as f:
+            logging.error('Background upload of %s failed (%s); staged copies kept: %s' % (' '.join(record['file']), f.read().strip(), ' '.join(record['staged'])))
+        os.makedirs(os.path.join(UPLOAD_DIR, 'failed'), exist_ok=True)
+        [os.replace(base + x, os.path.join(UPLOAD_DIR, 'failed', os.path.basename(base) + x)) for x in ['.json', '.failed', '.pid', '.log'] if os.path.exists(base + x)]
+        failed.append(base)
+    if len(failed) > 0:
+        logging.error('S3 upload failed. See %s for the uploader logs.' % (os.path.join(UPLOAD_DIR, 'failed')))
+        exit(1)
+
+
+
+## Size of a file encrypted with openssl enc: salt header plus the data padded to whole cipher blocks
+def encryptedSize(size):
+    return(16 + (size // 16 + 1) * 16)
 
-        ## Attempt to upload
+
+
+## Encrypt a file and upload the ciphertext in one pass: file -> openssl -> aws s3 cp - dest
+## Nothing is written to local disk; both the plaintext and the ciphertext are hashed on the way through
+## Returns (plaintext checksum, ciphertext checksum), empty strings if checksums are disabled
+def streamEncrypted(file, dest, prog, openssl, password, hash):
+    enc = subprocess.Popen([openssl, 'aes-256-cbc', '-md', hash, '-pass', 'pass:' + password], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    up = subprocess.Popen(transfer.s3Command(prog, '-', dest) + ' --expected-size %s' % (encryptedSize(os.path.getsize(file))), shell=True, stdin=subprocess.PIPE)
+    plain, cipher = checksum.newHash(hash), checksum.newHash(hash)
+
+    ## Feed openssl from a second thread so neither pipe can fill up and block
+    def feed():
+        try:
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(checksum.CHUNK_SIZE), b''):
+                    if plain is not None:
+                        plain.update(chunk)
+                    enc.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                enc.stdin.close()
+            except BrokenPipeError:
+                pass
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    try:
+        for chunk in iter(lambda: enc.stdout.read(checksum.CHUNK_SIZE), b''):
+            if cipher is not None:
+                cipher.update(chunk)
+            up.stdin.write(chunk)
+    except BrokenPipeError:
+        enc.kill()
+    finally:
+        feeder.join()
+        enc.stdout.close()
+        try:
+            up.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    ## Wait for both processes before reporting a failure (aws exits 0 after an empty stream from a failed openssl)
+    codes = [enc.wait(), up.wait()]
+    for code, cmd in zip(codes, [openssl + ' aes-256-cbc', transfer.s3Command(prog, '-', dest)]):
+        if code != 0:
+            raise subprocess.CalledProcessError(code, cmd)
+    return((plain.hexdigest() if plain is not None else '', cipher.hexdigest() if cipher is not None else ''))
+
+
+
+## Stream one file to <destination><file>.enc, retrying with exponential backoff (the whole stream is repeated)
+## The plaintext checksum is checked against the checksum cache, and both checksums are recorded in the
+## file table of the log database. staged is the file actually read (a hard link when uploading in the background)
+def encryptUploadFile(file, staged, destination, prog, openssl, password, hash, db=None, expected=None):
+    dest = destination + file + '.enc'
+    retries, backoff = transfer.TRANSFER_RETRIES, transfer.TRANSFER_BACKOFF
+    for i in range(retries):
         try:
-            ## upload
-            utils.logging_call(cmd, shell=True)
-            ## remove encrypted file after uploading
-            if (rm):
-                utils.logging_call(cmd_rm, shell=True)
+            start_time = time.time()
+            plain, cipher = streamEncrypted(staged, dest, prog, openssl, password, hash)
+        except subprocess.CalledProcessError as e:
+            if i == retries - 1:
+                raise e
+            logging.warning('Encrypted upload failed (attempt %s of %s), retrying in %ss: %s' % (i+1, retries, backoff * 2 ** i, file))
+            time.sleep(backoff * 2 ** i)
+        else:
+            break
+
+    ## Log throughput
+    wc = max(time.time() - start_time, 1e-6)
+    size = os.path.getsize(staged) / (1024 * 1024)
+    logging.info('Encrypted and transferred %s: %.1f MB in %.1fs (%.1f MB/s)' % (file, size, wc, size / wc))
+
+    if expected is not None and plain and expected != plain:
+        raise RuntimeError('%s changed while it was uploaded (checksum %s, expected %s)' % (file, plain, expected))
+    if db is not None:
+        if expected is None and os.path.exists(file):
+            checksum.storeChecksum(file, hash, plain, db)
+        sqlite.recordArchive(db, file, dest, plain, cipher, os.path.getsize(staged))
+    return(dest)
+
+
+
+## Encrypt and upload files without writing .enc copies; with background=True the files are staged as
+## hard links and streamed by a detached uploader (like s3UploadBackground) while the job continues
+def encryptUpload(file, destination, prog, openssl, password, hash, db=None, background=False):
+    if destination[-1] != '/':
+        destination += '/'
+
+    if not isinstance(file, list):
+        file = file.split(' ')
+
+    ## Checksums already known for the files (e.g. computed when they were recorded)
+    expected = [checksum.getCache(db).get(f, hash) if db is not None and checksum.newHash(hash) is not None else None for f in file]
+
+    if not background:
+        try:
+            [encryptUploadFile(f, f, destination, prog, openssl, password, hash, db, x) for f, x in zip(file, expected)]
         except subprocess.CalledProcessError:
             logging.error('S3 upload failed. See above for more details.')
             exit(1)
+        return(True)
+
+    startBackground({'kind': 'encrypt', 'file': file, 'staged': stage(file), 'destination': destination, 'prog': prog, 'openssl': openssl,
+                     'hash': hash, 'db': db, 'expected': expected, 'retries': transfer.TRANSFER_RETRIES, 'endpoint_url': transfer.ENDPOINT_URL},
+                    env={UPLOAD_PASSWORD_ENV: password})
     return(True)
 
 
 
+## Uploader of an encrypted background upload record: the archives are recorded in the log database before
+## the upload counts as done; the staged copies are removed only after all files were uploaded
+def encryptStaged(record):
+    for f, x, e in zip(record['file'], record['staged'], record['expected']):
+        encryptUploadFile(f, x, record['destination'], record['prog'], record['openssl'], os.environ[UPLOAD_PASSWORD_ENV], record['hash'], record['db'], e)
+    if record['db'] is not None:
+        sqlite.flush(record['db'])
+    [os.remove(x) for x in record['staged']]
+
+
+
+## Archive the outputs of a job: encrypt and/or upload them
+## Encrypted uploads are streamed (no local .enc copy), encryption without an archive destination
+## writes <file>.enc next to each file, plain uploads remove the local copy if rm=True
+def archive(file, destination, cloud, prog, encrypt, openssl, password, hash, db=None, rm=True, background=False):
+    file = file if isinstance(file, list) else file.split(' ')
+    if encrypt and len(destination) > 0:
+        return({'aws': encryptUpload}[cloud](file=file, destination=destination, prog=prog, openssl=openssl, password=password, hash=hash, db=db, background=background))
+    if encrypt:
+        return(utils.encryptFile(file=file, openssl=openssl, password=password, hash=hash))
+    if len(destination) > 0:
+        return(upload(file=file, destination=destination, cloud=cloud, prog=prog, rm=rm, background=background))
+
+
+
 ## Use different functions depending on cloud provider (For now it's just AWS)
-def upload(file, destination, cloud, prog, rm=True):
-    upload_func = {'aws': s3Upload}
-    upload_func[cloud](file=file, destination=destination, prog=prog, rm=rm)
\ No newline at end of file
+## With background=True the upload overlaps with downstream jobs
+def upload(file, destination, cloud, prog, rm=True, background=False):
+    upload_func = {'aws': s3UploadBackground if background else s3Upload}
+    upload_func[cloud](file=file, destination=destination, prog=prog, rm=rm)
+
+
+
+## Uploader of a background upload record: putfile.py <record>
+def runBackground(record_file):
+    base = record_file[:-len('.json')]
+    with open(record_file) as f:
+        record = json.load(f)
+    transfer.ENDPOINT_URL, transfer.TRANSFER_RETRIES = record['endpoint_url'], record['retries']
+    try:
+        {'upload': uploadStaged, 'encrypt': encryptStaged}[record['kind']](record)
+    except Exception as e:
+        logging.error('Background upload of %s failed: %s' % (' '.join(record['file']), e))
+        with open(base + '.failed', 'w') as f:
+            f.write(str(e))
+        return(1)
+    open(base + '.done', 'w').close()
+    return(0)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    sys.exit(runBackground(sys.argv[1]))
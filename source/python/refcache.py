@@ -0,0 +1,177 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  refcache.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Shared, content-addressed cache of reference bundles (genome indexes, splice sites, ...)
+# Input:    N/A
+# Output:   N/A
+#############################################################################################################
+
+import os
+import glob
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import subprocess
+import checksum
+
+## Marker written once a bundle is complete
+COMPLETE = '.complete'
+
+
+
+## Output of a tool version command (empty if it cannot be run)
+_versions = {}
+
+def toolVersion(cmd):
+    if cmd not in _versions:
+        res = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        _versions[cmd] = res.stdout.decode(errors='replace').strip() if res.returncode == 0 else ''
+    return(_versions[cmd])
+
+
+
+## Link a file into place: hard link if possible, otherwise (across file systems) a copy or symbolic link
+## (symbolically linked working directories depend on the bundle, so keep the cache on the same file system)
+def linkFile(src, dst, copy=False):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if os.path.dirname(dst) and not os.path.isdir(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst) if copy else os.symlink(os.path.abspath(src), dst)
+
+
+
+## Total size of a directory in bytes
+def dirBytes(dir):
+    return(sum([os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(dir) for f in files]))
+
+
+
+## A cached reference bundle keyed by the checksums of its inputs, tool versions and build parameters
+## files are glob patterns (relative to the working directory) of the files making up the bundle
+## Use as a context manager to hold the bundle's lock, so concurrent runs wait for a single build:
+##     with Bundle(...) as bundle:
+##         if not bundle.fetch():
+##             build ...
+##             bundle.store()
+## An empty cache_dir disables caching (fetch() always misses, store() does nothing)
+class Bundle:
+    def __init__(self, cache_dir, name, inputs, files, versions=[], params='', cache_db=None, max_gb=0):
+        self.cache_dir = cache_dir
+        self.files = files
+        self.enabled = len(cache_dir) > 0
+        self.max_gb = max_gb
+        self.lock_file = None
+        if not self.enabled:
+            return
+        sums = checksum.checksumFiles(inputs, 'sha256', cache_db=cache_db)
+        key = json.dumps({'inputs': [[os.path.basename(f), x] for f, x in zip(inputs, sums)],
+                          'versions': [toolVersion(x) for x in versions], 'params': params}, sort_keys=True)
+        self.key = hashlib.sha256(key.encode()).hexdigest()
+        self.path = os.path.join(cache_dir, name, self.key)
+        self.description = key
+
+
+    def __enter__(self):
+        if self.enabled:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.lock_file = open(self.path + '.lock', 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return(self)
+
+
+    def __exit__(self, *args):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+
+    ## Link a complete bundle into the working directory, returns False on a cache miss
+    ## On a miss, old bundle files are unlinked so the rebuild cannot write through hard links into the cache
+    def fetch(self):
+        if not self.enabled:
+            return(False)
+        if not os.path.exists(os.path.join(self.path, COMPLETE)):
+            [os.remove(x) for p in self.files for x in glob.glob(p)]
+            return(False)
+        with open(os.path.join(self.path, COMPLETE)) as f:
+            files = json.load(f)['files']
+        [linkFile(os.path.join(self.path, x), x) for x in files]
+        os.utime(self.path)
+        logging.info('Reference cache hit: %s (%s file(s))' % (self.path, len(files)))
+        return(True)
+
+
+    ## Add the freshly built files to the cache
+    def store(self):
+        if not self.enabled:
+            return
+        files = sorted(set([x for p in self.files for x in glob.glob(p)]))
+        tmp = self.path + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        for x in files:
+            linkFile(os.path.realpath(x), os.path.join(tmp, x), copy=True)
+            os.chmod(os.path.join(tmp, x), 0o444)
+        with open(os.path.join(tmp, COMPLETE), 'w') as f:
+            json.dump({'files': files, 'key': json.loads(self.description), 'created': time.strftime('%Y-%m-%dT%H:%M:%S')}, f, indent=2)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmp, self.path)
+        logging.info('Stored reference bundle %s (%s file(s))' % (self.path, len(files)))
+        if self.max_gb > 0:
+            evict(self.cache_dir, self.max_gb * 1024 ** 3, keep=[self.path])
+
+
+
+## Remove least recently used bundles until the cache is below max_bytes
+## Bundles in use (locked by another run) and those listed in keep are never removed
+def evict(cache_dir, max_bytes, keep=[]):
+    bundles = [os.path.dirname(x) for x in glob.glob(os.path.join(cache_dir, '*', '*', COMPLETE))]
+    sizes = dict([(x, dirBytes(x)) for x in bundles])
+    total = sum(sizes.values())
+    for x in sorted(bundles, key=lambda x: os.path.getmtime(x)):
+        if total <= max_bytes:
+            break
+        if x in keep:
+            continue
+        with open(x + '.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            shutil.rmtree(x)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        total -= sizes[x]
+        logging.info('Evicted reference bundle %s (%.1f GB)' % (x, sizes[x] / 1024 ** 3))
+    return(total)
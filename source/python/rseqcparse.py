@@ -0,0 +1,220 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  rseqcparse.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Parse per-sample RSeQC results (bam_stat, read_GC, junction_annotation, read_distribution)
+#           into merged tables, in parallel
+# Input:    RSeQC results (rseqc/*_bam_qc.txt, *_bam_gc.txt, *_bam_jc.txt, *_bam_rc.txt)
+# Output:   merged tables (rseqc/bam_*_parsed.tab)
+#############################################################################################################
+
+import os
+import re
+import logging
+import multiprocessing
+import mergecache
+
+## Result file suffix of each RSeQC table
+SUFFIXES = {'qc': '_bam_qc.txt', 'gc': '_bam_gc.txt', 'jc': '_bam_jc.txt', 'rc': '_bam_rc.txt'}
+
+## Fixed table headers (the junction table takes its columns from the first file)
+HEADERS = {
+    'qc': ['sample_id', 'total', 'qc_failed', 'pcr_duplicates', 'non_primary', 'unmapped', 'non_unique', 'unique', 'read_1', 'read_2',
+           'plus_strand', 'minus_strand', 'non_spliced', 'spliced', 'proper_pairs', 'non_proper_pairs'],
+    'gc': ['sample_id', 'min', 'q1', 'median', 'mean', 'q3', 'max'],
+    'jc': ['sample_id'],
+    'rc': ['sample_id', 'total_reads', 'total_tags', 'total_assigned_tags',
+           'cds_exons_bases', 'cds_exons_tags', 'cds_exons_tags_kb', 'perc_cds_exons_tags',
+           'fp_utr_exons_bases', 'fp_utr_exons_tags', 'fp_utr_exons_tags_kb', 'perc_fp_utr_exons_tags',
+           'tp_utr_exons_bases', 'tp_utr_exons_tags', 'tp_utr_exons_tags_kb', 'perc_tp_utr_exons_tags',
+           'intron_bases', 'intron_tags', 'intron_tags_kb', 'perc_intron_tags',
+           'intergenic_up_bases', 'intergenic_up_tags', 'intergenic_up_tags_kb', 'perc_intergenic_up_tags',
+           'intergenic_down_bases', 'intergenic_down_tags', 'intergenic_down_tags_kb', 'perc_intergenic_down_tags',
+           'perc_exon_tags', 'perc_intergenic_tags']}
+
+## read_distribution rows: (line pattern, column prefix)
+RC_GROUPS = [(r"^CDS_Exons", 'cds_exons'), (r"^5'UTR_Exons", 'fp_utr_exons'), (r"3'UTR_Exons", 'tp_utr_exons'),
+             (r"^Introns", 'intron'), (r"^TSS_up_10kb", 'intergenic_up'), (r"^TES_down_10kb", 'intergenic_down')]
+
+## Fewer files than this are parsed in-process (starting workers costs more than it saves)
+MIN_POOL_FILES = 16
+
+
+
+## Sample ID from a result file name
+def sampleId(file, kind):
+    return(os.path.basename(file).replace(SUFFIXES[kind], ''))
+
+
+
+## Lines of a result file without their line endings
+def readLines(file):
+    with open(file, newline='') as f:
+        return([x.rstrip('\n') for x in f])
+
+
+
+## Field i of a whitespace-split line ('' if missing)
+def field(parts, i):
+    return(parts[i].strip() if i < len(parts) else '')
+
+
+
+## Number formatted like a Perl scalar
+def perlNumber(x):
+    return('%.15g' % x)
+
+
+
+## bam_stat.py: one row of counts (a crashed run gives an additional 'Segmentation fault' row)
+def parseQc(file):
+    id = sampleId(file, 'qc')
+    rows, values = [], []
+    for line in readLines(file):
+        line = line.replace('Non primary hits', 'Non primary hits:', 1)
+        if 'Segmentation fault' in line:
+            rows.append(id + '\tSegmentation fault (core dumped)')
+            break
+        if line == '' or 'Load' in line or re.match(r'\s', line) or line.startswith('#'):
+            continue
+        parts = line.split(':', 1)
+        values.append(parts[1].strip() if len(parts) > 1 else '0')
+    if len(values) > 0:
+        rows.append('\t'.join([id] + values))
+    return('\t'.join(HEADERS['qc']), rows)
+
+
+
+## read_GC.py summary: the file already holds the table row
+def parseGc(file):
+    return('\t'.join(HEADERS['gc']), readLines(file))
+
+
+
+## junction_annotation.py: one 'key: value' column per line
+def parseJc(file):
+    keys, values = ['sample_id'], [sampleId(file, 'jc')]
+    for line in readLines(file):
+        if 'Reading reference' in line or 'Load' in line or line == '' or re.match(r'[\s#=]', line):
+            continue
+        parts = line.split(':', 1)
+        key = re.sub(r'\s\s', ' ', parts[0].strip().lower())
+        keys.append(re.sub(r'\s', '_', key))
+        values.append(parts[1].strip() if len(parts) > 1 else '')
+    return('\t'.join(keys), ['\t'.join(values)] if len(values) > 1 else [])
+
+
+
+## read_distribution.py: tag counts per genomic feature and their percentage of all assigned tags
+def parseRc(file):
+    res = dict([(x, '') for x in HEADERS['rc']])
+    res['sample_id'] = sampleId(file, 'rc')
+    lines = [x for x in readLines(file) if not (x.startswith('=') or x.startswith('Group'))]
+    for line in lines:
+        parts = re.split(r'\s+', line, 4)
+        if line.startswith('Total Reads'):
+            res['total_reads'] = field(parts, 2)
+        elif line.startswith('Total Tags'):
+            res['total_tags'] = field(parts, 2)
+        elif line.startswith('Total Assigned Tags'):
+            res['total_assigned_tags'] = field(parts, 3)
+        else:
+            for pattern, group in RC_GROUPS:
+                if re.search(pattern, line):
+                    res[group + '_bases'], res[group + '_tags'], res[group + '_tags_kb'] = field(parts, 1), field(parts, 2), field(parts, 3)
+                    res['perc_' + group + '_tags'] = '%.4f' % (float(res[group + '_tags']) / float(res['total_assigned_tags']) * 100)
+                    break
+    perc = lambda groups: perlNumber(sum([float(res['perc_' + x + '_tags'] or 0) for x in groups]))
+    res['perc_exon_tags'] = perc(['cds_exons', 'fp_utr_exons', 'tp_utr_exons'])
+    res['perc_intergenic_tags'] = perc(['intergenic_up', 'intergenic_down'])
+    return('\t'.join(HEADERS['rc']), ['\t'.join([res[x] for x in HEADERS['rc']])])
+
+
+
+PARSERS = {'qc': parseQc, 'gc': parseGc, 'jc': parseJc, 'rc': parseRc}
+
+def parseFile(args):
+    kind, file = args
+    return(PARSERS[kind](file))
+
+
+
+## Find the result files of several tables in a single walk of dir: kind -> files (sorted by path)
+def findResults(dir, kinds):
+    res = dict([(x, []) for x in kinds])
+    for root, dirs, files in os.walk(dir):
+        for f in files:
+            for kind in kinds:
+                if f.endswith(SUFFIXES[kind]):
+                    res[kind].append(os.path.join(root, f))
+    return(dict([(x, sorted(res[x])) for x in res]))
+
+
+
+## Parse a set of result files, in a pool of the given number of workers if one is given
+## Returns the table header (that of the first file) and the rows of each file, like mergecache.mergeTable expects
+def parseFiles(kind, files, pool=None, workers=1):
+    args = [(kind, f) for f in files]
+    if pool is not None and len(files) >= MIN_POOL_FILES:
+        res = pool.map(parseFile, args, chunksize=max(1, len(files) // (workers * 4)))
+    else:
+        res = [parseFile(x) for x in args]
+    header = res[0][0] if len(res) > 0 else '\t'.join(HEADERS[kind])
+    return(header, dict(zip(files, [x[1] for x in res])))
+
+
+
+## Write a merged table (rows in file order)
+def writeTable(header, rows, files, out_file):
+    with open(out_file + '.tmp', 'w') as out:
+        out.write(header + '\n')
+        [out.write(x + '\n') for f in files for x in rows[f]]
+    os.replace(out_file + '.tmp', out_file)
+
+
+
+## Merge the RSeQC results below dir into tables [(kind, out_file)], sharing one pool of workers
+## (started only once there are enough files to parse)
+## With a cache_dir, per-sample rows are cached by fingerprint and only new/changed files are parsed
+def mergeResults(dir, tables, workers=1, cache_dir=None, hash=None, cache_db=None):
+    results = findResults(dir, [kind for kind, out_file in tables])
+    logging.info('Found %s RSeQC result file(s), parsing with up to %s worker(s)' % (sum([len(x) for x in results.values()]), workers))
+    pool = []
+    def parse(files, kind):
+        if workers > 1 and len(files) >= MIN_POOL_FILES and len(pool) == 0:
+            pool.append(multiprocessing.Pool(workers))
+        return(parseFiles(kind, files, pool[0] if len(pool) > 0 else None, workers))
+    try:
+        for kind, out_file in tables:
+            if cache_dir is not None:
+                mergecache.mergeTable(results[kind], out_file, lambda x, kind=kind: parse(x, kind), cache_dir, hash=hash, cache_db=cache_db)
+            else:
+                header, rows = parse(results[kind], kind)
+                writeTable(header, rows, results[kind], out_file)
+    finally:
+        for x in pool:
+            x.close()
+            x.join()
+    return([out_file for kind, out_file in tables])
@@ -0,0 +1,207 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  scratch.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Disk budget for intermediate files: footprint estimates, sample admission, scratch volume
+# Input:    log database
+# Output:   N/A
+#############################################################################################################
+
+import os
+import json
+import math
+import shutil
+import hashlib
+import sqlite3
+import logging
+import planner
+
+## Output bytes per input byte of the rules writing large intermediates, used until the log database
+## has history for a rule (gzipped FASTQ in; SAM is ~5x, BAM ~1.2x the size of the gzipped reads)
+DEFAULT_RATIOS = {'trimadapters': 1.0, 'qualityfilter': 0.95, 'trim_qualityfilter': 0.95, 'run_hisat': 5.0,
+                  'sam_to_bam': 0.25, 'sort_bam': 0.8, 'align_sort_bam': 1.2}
+
+## Smallest disk request in MB
+MIN_DISK_MB = 1
+
+
+
+## Median output/input size ratio per rule from the file sizes recorded in a log database
+## Also returns the size of each sample's reads (bytes written by its latest getfile jobs)
+def loadFootprints(db):
+    if not os.path.exists(db):
+        return({}, {})
+    conn = sqlite3.connect(db, timeout=1000)
+    try:
+        columns = [x[1] for x in conn.execute('PRAGMA table_info(process)')]
+        if 'input_bytes' not in columns:
+            return({}, {})
+        rows = conn.execute('''SELECT p.rule, MAX(p.input_bytes), SUM(f.file_bytes)
+            FROM process p JOIN file f ON f.process_id = p.process_id
+            WHERE p.return_code = 0 AND p.rule IS NOT NULL AND p.rule != 'getfile' AND f.file_bytes IS NOT NULL
+            GROUP BY p.rule, p.sample_id, p.start_time ORDER BY p.start_time DESC''').fetchall()
+        reads = conn.execute('''SELECT s.sample_name, f.file_name, f.file_bytes
+            FROM process p JOIN file f ON f.process_id = p.process_id JOIN sample s ON s.sample_id = p.sample_id
+            WHERE p.return_code = 0 AND p.rule = 'getfile' AND f.file_bytes IS NOT NULL ORDER BY p.start_time''').fetchall()
+    finally:
+        conn.close()
+    ratios = {}
+    for rule, input_bytes, output_bytes in rows:
+        if input_bytes and len(ratios.setdefault(rule, [])) < planner.HISTORY_JOBS:
+            ratios[rule].append(output_bytes / input_bytes)
+    files = dict([((sample, file), size) for sample, file, size in reads])
+    samples = {}
+    [samples.update({sample: samples.get(sample, 0) + size}) for (sample, file), size in files.items()]
+    return(dict([(k, planner.median(v)) for k, v in ratios.items() if len(v) > 0]), samples)
+
+
+
+## Disk budget for the intermediates of a run
+## Estimates the footprint of a sample (its reads and the intermediates written by the chain of rules leading
+## to the sorted BAM, each reading the previous rule's output) and decides how many samples may hold
+## intermediates at the same time. samples maps sample -> input read files
+class ScratchManager:
+    def __init__(self, db, samples, chain, budget_mb=0):
+        self.budget = budget_mb * 1024 ** 2
+        self.chain = chain
+        self.ratios, history = loadFootprints(db)
+        self.sizes = dict([(s, self.readBytes(files, history.get(s, None))) for s, files in samples.items()])
+        logging.debug('Scratch manager: size history for %s rule(s), %s sample(s)' % (len(self.ratios), len(history)))
+
+
+    def ratio(self, rule):
+        return(self.ratios.get(rule, DEFAULT_RATIOS.get(rule, 1.0)))
+
+
+    ## Size of a sample's reads: local input files, else the size fetched by an earlier run (None if unknown)
+    @staticmethod
+    def readBytes(files, history):
+        if len(files) > 0 and all([os.path.isfile(x) for x in files]):
+            return(sum([os.path.getsize(x) for x in files]))
+        return(history)
+
+
+    ## Projected output size of a rule of the chain (or the reads themselves for getfile) for a sample
+    ## None if the sample's size is unknown
+    def outputBytes(self, sample, rule):
+        size = self.sizes.get(sample, None)
+        if size is None:
+            return(None)
+        for r in self.chain[:self.chain.index(rule) + 1] if rule in self.chain else []:
+            size *= self.ratio(r)
+        return(size)
+
+
+    ## Projected peak disk use of one sample, assuming no intermediate has been removed yet
+    def footprint(self, sample):
+        if self.sizes.get(sample, None) is None:
+            return(None)
+        return(self.sizes[sample] + sum([self.outputBytes(sample, r) for r in self.chain]))
+
+
+    ## Admission order: sample -> earlier sample whose intermediates must be cleared before it starts
+    ## Slots are sized for the largest known sample; without a budget or any size information all
+    ## samples are admitted at once
+    def admission(self, order):
+        peaks = [x for x in [self.footprint(s) for s in order] if x is not None]
+        if self.budget <= 0 or len(peaks) == 0 or max(peaks) <= 0:
+            if self.budget > 0:
+                logging.info('Disk budget: sample sizes unknown, all samples admitted')
+            return({})
+        slots = max(1, int(self.budget // max(peaks)))
+        logging.info('Disk budget %.0f MB, projected peak %.0f MB per sample: %s sample(s) at a time' % (self.budget / 1024 ** 2, max(peaks) / 1024 ** 2, min(slots, len(order))))
+        return(dict([(order[i], order[i - slots]) for i in range(slots, len(order))]))
+
+
+    ## Disk request of a rule as a Snakemake resource callable: the projected size of its output
+    ## (from the job's input files when the sample's size is unknown)
+    ## Requests are capped at the budget so no job becomes unschedulable
+    def disk(self, rule):
+        def disk_mb(wildcards, input):
+            sample = wildcards.get('sample', None) if hasattr(wildcards, 'get') else None
+            size = self.outputBytes(sample, rule)
+            if size is None:
+                size = planner.inputBytes(input) * self.ratio(rule)
+            mb = max(MIN_DISK_MB, int(math.ceil(size / 1024 ** 2)))
+            return(min(mb, int(self.budget / 1024 ** 2)) if self.budget > 0 else mb)
+        return(disk_mb)
+
+
+
+## Samples with at least one final output missing (patterns contain {sample}), in the given order
+def pendingSamples(samples, patterns):
+    return([s for s in samples if not all([os.path.exists(x.format(sample=s)) for x in patterns])])
+
+
+
+## Save the admission order of a run at its start, so that its jobs (which parse the workflow again in their
+## own processes, while outputs and sizes change) use the order the scheduler planned with
+def saveAdmission(file, run_id, admit_after):
+    with open(file + '.tmp', 'w') as f:
+        json.dump({'run_id': run_id, 'admit_after': admit_after}, f)
+    os.replace(file + '.tmp', file)
+    return(file)
+
+
+
+## Admission order saved for a run, None if there is none (e.g. when the scheduler itself parses the workflow)
+def loadAdmission(file, run_id):
+    if run_id is None or not os.path.exists(file):
+        return(None)
+    try:
+        with open(file) as f:
+            x = json.load(f)
+    except ValueError:
+        return(None)
+    return(x['admit_after'] if x.get('run_id', None) == run_id else None)
+
+
+
+## Free space (MB) on the volume holding a directory (or the directory it will be created in)
+def freeMb(dir):
+    dir = os.path.abspath(dir)
+    while not os.path.exists(dir):
+        dir = os.path.dirname(dir)
+    return(int(shutil.disk_usage(dir).free / 1024 ** 2))
+
+
+
+## Put a working directory on a scratch volume (fast local disk or tmpfs): dir becomes a symbolic link
+## to a directory on the scratch volume (one per working directory). A non-empty dir (continued run) is left in place
+def linkScratch(dir, scratch_dir):
+    target = os.path.join(scratch_dir, 'rseqrep-' + hashlib.md5(os.getcwd().encode()).hexdigest()[:12], dir)
+    if os.path.islink(dir):
+        if os.path.realpath(dir) == os.path.realpath(target):
+            return(target)
+        os.remove(dir)
+    elif os.path.isdir(dir):
+        if len(os.listdir(dir)) > 0:
+            logging.warning('%s is not empty, not moving it to the scratch volume %s' % (dir, scratch_dir))
+            return(dir)
+        os.rmdir(dir)
+    os.makedirs(target, exist_ok=True)
+    os.symlink(target, dir)
+    logging.info('Temporary files in %s are written to %s' % (dir, target))
+    return(target)
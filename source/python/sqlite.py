@@ -31,91 +31,385 @@
 
 import sqlite3
 import utils
+import checksum
 import os
 import logging
+import threading
+import atexit
+import time
+
+## Number of queued processes / seconds to wait before committing a batch
+## (queued records are also committed when the process exits, see flush() below)
+BATCH_SIZE = 50
+BATCH_DELAY = 10
+
+
+
+## Persistent provenance writer for a single database, one WAL-mode connection per process
+## Snakemake 5.x runs each run: job in its own snakemake process (unless --force-use-threads), so a
+## job's writer only queues the few processes of that job and commits them in one transaction when
+## they are read back (flush) or the job exits (atexit) -- one write lock and fsync per job instead of
+## one per record. Batching across jobs only happens where jobs share a process: with threads, and
+## in onstart/onsuccess/onerror, which run in the scheduler. The lock guards the connection against
+## threads of the same process; BEGIN IMMEDIATE + busy timeout keeps the job processes and other
+## writers (other runs, cluster jobs) safe.
+class ProvenanceWriter:
+    def __init__(self, db, batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY):
+        self.db = db
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue = []
+        self.samids = dict(_samids.get(db, {}))
+        self.last_flush = time.time()
+        self.lock = threading.RLock()
+        
+        ## Autocommit mode -- transactions are managed explicitly
+        self.conn = sqlite3.connect(db, timeout=1000, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        
+        
+    ## Run a list of (sql, params) statements in a single write transaction
+    def execute(self, statements):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                res = [c.execute(sql, params).lastrowid for sql, params in statements]
+                c.execute('COMMIT')
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+            return(res)
+    
+    
+    ## Pull (and cache) the database sample ID for a given sample name
+    def getSamid(self, sample_name):
+        with self.lock:
+            if sample_name not in self.samids:
+                c = self.conn.cursor()
+                c.execute("SELECT sample_id FROM sample WHERE sample_name=(?)", (sample_name, ))
+                self.samids[sample_name] = c.fetchone()[0]
+            return(self.samids[sample_name])
+    
+    
+    ## Queue a process with its output files and benchmark
+    def record(self, sample_name, cmd, start_time, end_time, bench_obj=None, return_code=None, file=[], file_type='', hash='', rule='', threads=None, input=[]):
+        samid = self.getSamid(sample_name)
+        
+        ## Checksum files outside of the lock 
+        file = utils.toList(file)
+        input_bytes = sum([os.path.getsize(f) for f in utils.toList(input) if os.path.isfile(f)])
+        file_rows = [(f, sample_name, x, os.path.getsize(f), file_type) for f, x in zip(file, checksum.checksumFiles(file, hash, cache_db=self.db))]
+        
+        ## Snapshot benchmark values
+        bench_row, series_rows = None, []
+        if bench_obj is not None:
+            return_code = bench_obj.return_code
+            bench_row = benchmarkRow(bench_obj)
+            series_rows = benchmarkSeriesRows(bench_obj)
+        
+        with self.lock:
+            self.queue.append((samid, (cmd, return_code, start_time, end_time, end_time - start_time, rule, threads, input_bytes, currentRun()), file_rows, bench_row, series_rows))
+            if len(self.queue) >= self.batch_size or time.time() - self.last_flush >= self.batch_delay:
+                self.flush()
+    
+    
+    ## Commit all queued records in one transaction
+    def flush(self):
+        with self.lock:
+            if len(self.queue) == 0:
+                return
+            c = self.conn.cursor()
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                for samid, process_row, file_rows, bench_row, series_rows in self.queue:
+                    c.execute('''INSERT INTO process (sample_id, process_str, return_code, start_time, end_time, wc_time, rule, threads, input_bytes, run_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (samid, ) + process_row)
+                    procid = c.lastrowid
+                    c.executemany('''INSERT INTO file (sample_id, process_id, file_path, file_name, file_checksum, file_bytes, file_type) VALUES (?, ?, ?, ?, ?, ?, ?)''', [(samid, procid) + x for x in file_rows])
+                    if bench_row is not None:
+                        c.execute(BENCHMARK_INSERT, (procid, samid) + bench_row)
+                        benchid = c.lastrowid
+                        c.executemany(BENCHMARK_SERIES_INSERT, [(benchid, procid, samid) + x for x in series_rows])
+                c.execute('COMMIT')
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+            logging.debug('Committed %s process record(s) to %s' % (len(self.queue), self.db))
+            self.queue = []
+            self.last_flush = time.time()
+            
+            
+    ## Flush and close the connection
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+
+
+## Benchmark rows
+BENCHMARK_INSERT = '''INSERT INTO benchmark (process_id, sample_id, virtual, resident_set_size, cpu_time, wc_time, return_code, io_read_bytes, io_write_bytes, max_threads, ctx_switches) 
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+BENCHMARK_SERIES_INSERT = '''INSERT INTO benchmark_series (benchmark_id, process_id, sample_id, elapsed, pid, ppid, name, cpu_time, resident_set_size, virtual,
+    io_read_bytes, io_write_bytes, threads, ctx_switches) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+def benchmarkRow(bench_obj):
+    procs = bench_obj.processes.values()
+    return((bench_obj.max_vms, bench_obj.max_rss, bench_obj.cpu_seconds, bench_obj.running_time, bench_obj.return_code, bench_obj.io_read_bytes, bench_obj.io_write_bytes,
+            sum([x['max_threads'] for x in procs]), sum([x['ctx_switches'] for x in procs])))
+
+def benchmarkSeriesRows(bench_obj):
+    return([(x['elapsed'], x['pid'], x['ppid'], x['name'], x['cpu_seconds'], x['rss'], x['vms'], x['read_bytes'], x['write_bytes'], x['threads'], x['ctx_switches']) for x in bench_obj.series])
+
+
+
+## One writer per database per process
+_writers = {}
+_writers_lock = threading.Lock()
+
+## Known sample IDs per database (e.g. from the sample manifest), used before asking the database
+_samids = {}
+
+def getWriter(db):
+    with _writers_lock:
+        if db not in _writers:
+            _writers[db] = ProvenanceWriter(db)
+        return(_writers[db])
+
+
+
+## Provide sample name -> ID mappings so records of these samples need no ID lookup
+def setSamids(db, samids):
+    with _writers_lock:
+        _samids.setdefault(db, {}).update(samids)
+        writer = _writers.get(db, None)
+    if writer is not None:
+        with writer.lock:
+            writer.samids.update(samids)
+
+
+
+## Commit queued records for one or all databases
+def flush(db=None):
+    for k in list(_writers.keys()):
+        if db is None or k == db:
+            _writers[k].flush()
+
+atexit.register(flush)
+
+
 
 ## Initialize a SQLite3 database if it doesn't already exist 
 def initSqliteDb(db):
     
-    ## Open the connection, get the cursor
-    conn = sqlite3.connect(db)
-    c = conn.cursor()
-    
     ## Create process table
-    c.execute('''CREATE TABLE IF NOT EXISTS process(process_id integer primary key autoincrement, process_str text, return_code, start_time integer,
-    end_time integer,wc_time integer, sample_id integer,created timestamp default (datetime('now','localtime')))''')
+    getWriter(db).execute([('''CREATE TABLE IF NOT EXISTS process(process_id integer primary key autoincrement, process_str text, return_code, start_time integer,
+    end_time integer,wc_time integer, sample_id integer,created timestamp default (datetime('now','localtime')))''', ()),
     
     ## Create file table
-    c.execute('''CREATE TABLE IF NOT EXISTS file(file_id integer primary key autoincrement, file_name text, file_checksum text, file_bytes integer, file_type text, 
-    process_id integer, sample_id integer, file_path text, created timestamp default (datetime('now','localtime')))''')
+    ('''CREATE TABLE IF NOT EXISTS file(file_id integer primary key autoincrement, file_name text, file_checksum text, file_bytes integer, file_type text, 
+    process_id integer, sample_id integer, file_path text, created timestamp default (datetime('now','localtime')))''', ()),
     
     ## Create sample table
-    c.execute('''CREATE TABLE IF NOT EXISTS sample(sample_id integer primary key autoincrement, sample_name text unique,
-    created timestamp default (datetime('now','localtime')))''');
+    ('''CREATE TABLE IF NOT EXISTS sample(sample_id integer primary key autoincrement, sample_name text unique,
+    created timestamp default (datetime('now','localtime')))''', ()),
     
     ## Create benchmark table
-    c.execute('''CREATE TABLE IF NOT EXISTS benchmark(benchmark_id integer primary key autoincrement, process_id integer, sample_id integer, virtual integer, 
-    resident_set_size integer, cpu_time integer, wc_time integer, return_code integer, created timestamp default (datetime('now','localtime')))''')
+    ('''CREATE TABLE IF NOT EXISTS benchmark(benchmark_id integer primary key autoincrement, process_id integer, sample_id integer, virtual integer, 
+    resident_set_size integer, cpu_time integer, wc_time integer, return_code integer, created timestamp default (datetime('now','localtime')))''', ()),
     
-    ## Commit and close the connection
-    conn.commit()
-    conn.close()
+    ## Create benchmark time series table (one row per process in the tree per sample)
+    ('''CREATE TABLE IF NOT EXISTS benchmark_series(benchmark_series_id integer primary key autoincrement, benchmark_id integer, process_id integer, sample_id integer,
+    elapsed real, pid integer, ppid integer, name text, cpu_time real, resident_set_size real, virtual real, io_read_bytes integer, io_write_bytes integer, 
+    threads integer, ctx_switches integer)''', ())])
+    
+    ## Add columns introduced after the benchmark table was first created
+    addColumns(db, 'benchmark', [('io_read_bytes', 'integer'), ('io_write_bytes', 'integer'), ('max_threads', 'integer'), ('ctx_switches', 'integer')])
+    addColumns(db, 'process', [('rule', 'text'), ('threads', 'integer'), ('input_bytes', 'integer')])
+    addColumns(db, 'file', [('archive_path', 'text'), ('archive_checksum', 'text')])
+    
+    ## Bring the schema to the current version (foreign keys, indexes, run and summary tables)
+    migrate(db)
+
+
+
+## Add any missing columns to an existing table
+def addColumns(db, table, columns):
+    writer = getWriter(db)
+    with writer.lock:
+        existing = [x[1] for x in writer.conn.execute('PRAGMA table_info(%s)' % (table))]
+    writer.execute([('ALTER TABLE %s ADD COLUMN %s %s' % (table, name, type), ()) for name, type in columns if name not in existing])
 
     
 
-## Add a sample to the sample table
+## Schema version of the log database, kept in PRAGMA user_version
+## MIGRATIONS[i] brings a database from version i to version i+1; tables created by initSqliteDb are version 0
+SCHEMA_VERSION = 1
+
+## Tables rebuilt with foreign keys (SQLite cannot add constraints to an existing table), parents first
+SCHEMA_TABLES = [
+    ('run', '''CREATE TABLE run(run_id integer primary key autoincrement, start_time integer, end_time integer, status text, 
+    host text, created timestamp default (datetime('now','localtime')))'''),
+    ('process', '''CREATE TABLE process(process_id integer primary key autoincrement, process_str text, return_code, start_time integer,
+    end_time integer, wc_time integer, sample_id integer references sample(sample_id), created timestamp default (datetime('now','localtime')),
+    rule text, threads integer, input_bytes integer, run_id integer references run(run_id))'''),
+    ('file', '''CREATE TABLE file(file_id integer primary key autoincrement, file_name text, file_checksum text, file_bytes integer, file_type text, 
+    process_id integer references process(process_id) on delete cascade, sample_id integer references sample(sample_id), file_path text, 
+    created timestamp default (datetime('now','localtime')), archive_path text, archive_checksum text)'''),
+    ('benchmark', '''CREATE TABLE benchmark(benchmark_id integer primary key autoincrement, process_id integer references process(process_id) on delete cascade, 
+    sample_id integer references sample(sample_id), virtual integer, resident_set_size integer, cpu_time integer, wc_time integer, return_code integer, 
+    created timestamp default (datetime('now','localtime')), io_read_bytes integer, io_write_bytes integer, max_threads integer, ctx_switches integer)'''),
+    ('benchmark_series', '''CREATE TABLE benchmark_series(benchmark_series_id integer primary key autoincrement, 
+    benchmark_id integer references benchmark(benchmark_id) on delete cascade, process_id integer references process(process_id) on delete cascade, 
+    sample_id integer references sample(sample_id), elapsed real, pid integer, ppid integer, name text, cpu_time real, resident_set_size real, virtual real, 
+    io_read_bytes integer, io_write_bytes integer, threads integer, ctx_switches integer)''')]
+
+## Indexes for joins on process/sample IDs and the lookups of the planner, scratch manager and reports
+SCHEMA_INDEXES = ['CREATE INDEX IF NOT EXISTS process_sample_idx ON process(sample_id)',
+                  'CREATE INDEX IF NOT EXISTS process_rule_idx ON process(rule, return_code)',
+                  'CREATE INDEX IF NOT EXISTS process_run_idx ON process(run_id, sample_id)',
+                  'CREATE INDEX IF NOT EXISTS file_process_idx ON file(process_id)',
+                  'CREATE INDEX IF NOT EXISTS file_sample_idx ON file(sample_id)',
+                  'CREATE INDEX IF NOT EXISTS file_path_idx ON file(file_path)',
+                  'CREATE INDEX IF NOT EXISTS benchmark_process_idx ON benchmark(process_id)',
+                  'CREATE INDEX IF NOT EXISTS benchmark_sample_idx ON benchmark(sample_id)',
+                  'CREATE INDEX IF NOT EXISTS benchmark_series_benchmark_idx ON benchmark_series(benchmark_id)',
+                  'CREATE INDEX IF NOT EXISTS benchmark_series_process_idx ON benchmark_series(process_id)']
+
+## Materialized aggregates maintained by logsummary.refresh (sums and counts, means are derived when queried)
+SUMMARY_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS summary_rule(rule text primary key, jobs integer, failed integer, wc_time real, cpu_time real, thread_time real,
+    max_rss real, io_read_bytes integer, io_write_bytes integer, input_bytes integer, output_bytes integer, files integer)''',
+    '''CREATE TABLE IF NOT EXISTS summary_sample(sample_id integer primary key references sample(sample_id), jobs integer, failed integer, wc_time real, 
+    cpu_time real, thread_time real, max_rss real, io_read_bytes integer, io_write_bytes integer, input_bytes integer, output_bytes integer, files integer, 
+    first_start integer, last_end integer)''',
+    '''CREATE TABLE IF NOT EXISTS summary_run(run_id integer primary key references run(run_id), jobs integer, failed integer, wc_time real, 
+    cpu_time real, thread_time real, max_rss real, io_read_bytes integer, io_write_bytes integer, input_bytes integer, output_bytes integer, files integer, 
+    first_start integer, last_end integer)''',
+    '''CREATE TABLE IF NOT EXISTS summary_state(name text primary key, value integer)''']
+
+
+
+## Version 0 -> 1: rebuild the tables with foreign keys, add the run table, indexes and summary tables
+def migrateForeignKeys(c):
+    for table, sql in SCHEMA_TABLES:
+        if c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (table, )).fetchone()[0] == 0:
+            c.execute(sql)
+            continue
+        c.execute(sql.replace('CREATE TABLE %s(' % (table), 'CREATE TABLE %s_new(' % (table), 1))
+        new = [x[1] for x in c.execute('PRAGMA table_info(%s_new)' % (table))]
+        columns = ', '.join([x[1] for x in c.execute('PRAGMA table_info(%s)' % (table)) if x[1] in new])
+        c.execute('INSERT INTO %s_new (%s) SELECT %s FROM %s' % (table, columns, columns, table))
+        c.execute('DROP TABLE %s' % (table))
+        c.execute('ALTER TABLE %s_new RENAME TO %s' % (table, table))
+    [c.execute(x) for x in SCHEMA_INDEXES + SUMMARY_TABLES]
+
+MIGRATIONS = [migrateForeignKeys]
+
+
+
+## Apply the migrations a database is missing, each in its own transaction together with its version number
+## Foreign key enforcement is off while tables are rebuilt; references broken before the migration are reported
+def migrate(db):
+    writer = getWriter(db)
+    with writer.lock:
+        writer.flush()
+        version = writer.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return(version)
+        writer.conn.execute('PRAGMA foreign_keys=OFF')
+        try:
+            for i in range(version, SCHEMA_VERSION):
+                start_time = time.time()
+                c = writer.conn.cursor()
+                c.execute('BEGIN IMMEDIATE')
+                try:
+                    if c.execute('PRAGMA user_version').fetchone()[0] == i:
+                        MIGRATIONS[i](c)
+                        c.execute('PRAGMA user_version = %s' % (i + 1))
+                    c.execute('COMMIT')
+                except Exception:
+                    c.execute('ROLLBACK')
+                    raise
+                logging.info('Log database %s migrated to schema version %s in %.1fs' % (db, i + 1, time.time() - start_time))
+            broken = writer.conn.execute('PRAGMA foreign_key_check').fetchall()
+            if len(broken) > 0:
+                logging.warning('%s row(s) of the log database refer to missing rows (kept as they are)' % (len(broken)))
+        finally:
+            writer.conn.execute('PRAGMA foreign_keys=ON')
+    return(SCHEMA_VERSION)
+
+
+
+## Run currently recording processes (set by startRun, inherited by jobs started in other processes)
+def currentRun():
+    run_id = os.environ.get('RSEQREP_RUN_ID', '')
+    return(int(run_id) if run_id else None)
+
+
+
+## Register the start of a workflow run; processes recorded from now on (in this process and its children) belong to it
+def startRun(db):
+    run_id = getWriter(db).execute([("INSERT INTO run (start_time, status, host) VALUES (?, 'running', ?)", (time.time(), os.uname()[1]))])[0]
+    os.environ['RSEQREP_RUN_ID'] = str(run_id)
+    return(run_id)
+
+
+
+## Register the end of the current run
+def endRun(db, status):
+    run_id = currentRun()
+    if run_id is not None:
+        flush(db)
+        getWriter(db).execute([('UPDATE run SET end_time = ?, status = ? WHERE run_id = ?', (time.time(), status, run_id))])
+    return(run_id)
+
+
+
+## Add sample(s) to the sample table
 def addSample(db, sample_name):
-    
-    ## Open the connection, get the cursor
-    conn = sqlite3.connect(db, timeout=1000)
-    c = conn.cursor()
-    
-    ## Try to insert into table
-    c.execute("INSERT OR IGNORE INTO sample (sample_name) VALUES (?)", (sample_name, ))
-    
-    ## Commit and close the connection
-    conn.commit()
-    conn.close()
+    getWriter(db).execute([("INSERT OR IGNORE INTO sample (sample_name) VALUES (?)", (x, )) for x in utils.toList(sample_name)])
     
 
 
 ## Pull the database sample ID for a given sample name
 def getSamid(db, sample_name):
+    return(getWriter(db).getSamid(sample_name))
 
-    ## Open the connection, get the cursor
-    conn = sqlite3.connect(db, timeout=1000)
-    c = conn.cursor()
-    
-    ## Pull samid
-    c.execute("SELECT sample_id FROM sample WHERE sample_name=(?)", (sample_name, ))
-    samid = c.fetchone()[0]
-    
-    ## Close the connection & return
-    conn.close()
-    return(samid)
+
+
+## Record a process, its output file(s) and its benchmark in a single call
+## Records are queued and committed in batches -- call flush() before reading them back
+## rule is the Snakemake rule name, used to group processes in performance reports; the job's threads 
+## and total input size are kept for resource planning (see planner.py)
+def recordProcess(db, sample_name, cmd, start_time, end_time, bench_obj=None, return_code=None, file=[], file_type='', hash='', rule='', threads=None, input=[]):
+    getWriter(db).record(sample_name=sample_name, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, 
+                         return_code=return_code, file=file, file_type=file_type, hash=hash, rule=rule, threads=threads, input=input)
     
 
 
+## Record where a file was archived and the checksum of the archived (encrypted) bytes on its latest file row
+## Files without a row (not recorded by a process, e.g. merged results) are added with file_type 'archive'
+def recordArchive(db, file, archive_path, file_checksum, archive_checksum, file_bytes=None):
+    writer = getWriter(db)
+    with writer.lock:
+        writer.flush()
+        writer.execute([('''UPDATE file SET archive_path = ?, archive_checksum = ? WHERE file_id = (SELECT MAX(file_id) FROM file WHERE file_path = ?)''', (archive_path, archive_checksum, file)),
+                        ('''INSERT INTO file (file_path, file_checksum, file_bytes, file_type, archive_path, archive_checksum) SELECT ?, ?, ?, 'archive', ?, ? WHERE changes() = 0''',
+                         (file, file_checksum, file_bytes if file_bytes is not None else os.path.getsize(file), archive_path, archive_checksum))])
+
+
+
 ## Add a process to the process table
 def addProcess(db, samid, cmd, return_code, start_time, end_time):
     
     ## Compute wall clock time
     wc = end_time - start_time
     
-    ## Open the connection, get the cursor
-    conn = sqlite3.connect(db, timeout=1000)
-    c = conn.cursor()
-
-    ## Add process to table
-    c.execute('''INSERT INTO process (sample_id, process_str, return_code, start_time, end_time, wc_time) VALUES (?, ?, ?, ?, ?, ?)''', (samid, cmd, return_code, start_time, end_time, wc))
-
-    ## Return process ID
-    c.execute("SELECT MAX(process_id) from PROCESS")
-    procid = c.fetchone()[0]
-    
-    ## Commit, close the connection, return process id
-    conn.commit()
-    conn.close()
+    ## Add process to table, return process id
+    procid = getWriter(db).execute([('''INSERT INTO process (sample_id, process_str, return_code, start_time, end_time, wc_time) VALUES (?, ?, ?, ?, ?, ?)''', (samid, cmd, return_code, start_time, end_time, wc))])[0]
     return(procid)
 
 
@@ -123,31 +417,12 @@ def addProcess(db, samid, cmd, return_code, start_time, end_time):
 ## Add file(s) to the file table
 def addFile(db, samid, procid, file, sample_name, file_type, hash):
     
-    ## Make sure file is a list
-    file = utils.toList(file) 
-    
-    for f in file:
-        
-        ## execute checksum
-        file_checksum = ''
-        if hash == 'sha256':
-            file_checksum = utils.sha256(f)
-        elif hash == 'md5': 
-            file_checksum = utils.md5(f)
-            
-        ## file size in bytes
-        file_size = os.path.getsize(f)
+    ## Make sure file is a list, compute checksums/sizes before taking the write lock
+    file = utils.toList(file)
+    rows = [(samid, procid, f, sample_name, x, os.path.getsize(f), file_type) for f, x in zip(file, checksum.checksumFiles(file, hash, cache_db=db))]
         
-        ## Open the connection, get the cursor
-        conn = sqlite3.connect(db, timeout=1000)
-        c = conn.cursor()
-            
-        ## Add file to table
-        c.execute('''INSERT INTO file (sample_id, process_id, file_path, file_name, file_checksum, file_bytes, file_type) VALUES (?, ?, ?, ?, ?, ?, ?)''', (samid, procid, f, sample_name, file_checksum, file_size, file_type))
-        
-        ## Commit and close the connection
-        conn.commit()
-        conn.close()
+    ## Add files to table
+    getWriter(db).execute([('''INSERT INTO file (sample_id, process_id, file_path, file_name, file_checksum, file_bytes, file_type) VALUES (?, ?, ?, ?, ?, ?, ?)''', x) for x in rows])
 
 
 
@@ -162,17 +437,8 @@ def parseBenchmark(bench_file):
 
 ## Add a process benchmark to the benchmark table
 def addBenchmark(db, procid, samid, bench_obj):
-    
-    ## Open the connection, get the cursor
-    conn = sqlite3.connect(db, timeout=1000)
-    c = conn.cursor()
-
-    ## Add file to table
-    c.execute('''INSERT INTO benchmark (process_id, sample_id, virtual, resident_set_size, cpu_time, wc_time, return_code) VALUES (?, ?, ?, ?, ?, ?, ?)''', (procid, samid, bench_obj.max_vms, bench_obj.max_rss, bench_obj.cpu_seconds, bench_obj.running_time, bench_obj.return_code))
-
-    ## Commit and close the connection
-    conn.commit()
-    conn.close()
+    benchid = getWriter(db).execute([(BENCHMARK_INSERT, (procid, samid) + benchmarkRow(bench_obj))])[0]
+    getWriter(db).execute([(BENCHMARK_SERIES_INSERT, (benchid, procid, samid) + x) for x in benchmarkSeriesRows(bench_obj)])
 
 
 
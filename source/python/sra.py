@@ -0,0 +1,282 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  sra.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  SRA retrieval: background prefetch queue, multi-threaded extraction to gzipped FASTQ
+# Input:    SRA run accessions
+# Output:   gzipped FASTQ files
+#############################################################################################################
+
+import os
+import time
+import fcntl
+import shutil
+import logging
+import threading
+import subprocess
+import utils
+import compression
+from concurrent.futures import ThreadPoolExecutor
+
+## Attempts per step (prefetch, extraction) and initial wait between attempts in seconds (doubled every time)
+SRA_RETRIES = 3
+SRA_BACKOFF = 5
+
+## Accessions downloaded at once by the prefetch queue
+PREFETCH_WORKERS = 2
+
+## Download directory shared by the prefetch queue (main process) and the getfile jobs (their own processes)
+SRA_DIR = os.path.join('tmp', 'sra')
+
+## Seconds between checks of the prefetch budget (accessions are taken by other processes)
+PREFETCH_POLL = 1
+
+## The prefetch queue, once started
+_queue = None
+
+
+
+## Is this input an SRA run accession (not a file)?
+def isAccession(x):
+    return(x[0:3] == 'SRR')
+
+
+
+## Run a command, retrying with exponential backoff; only this step is repeated on failure
+def retryCall(cmd, step, retries=SRA_RETRIES, backoff=SRA_BACKOFF):
+    for i in range(retries):
+        try:
+            return(utils.logging_call(cmd, shell=True, executable='/bin/bash'))
+        except subprocess.CalledProcessError as e:
+            if i == retries - 1:
+                raise e
+            logging.warning('%s failed (attempt %s of %s), retrying in %ss' % (step, i+1, retries, backoff * 2 ** i))
+            time.sleep(backoff * 2 ** i)
+
+
+
+## Downloaded .sra file of an accession (prefetch writes <dir>/<acc>.sra or <dir>/<acc>/<acc>.sra), None if absent
+def sraFile(accession, dir):
+    res = [x for x in [os.path.join(dir, accession + '.sra'), os.path.join(dir, accession, accession + '.sra')] if os.path.isfile(x)]
+    return(res[0] if len(res) > 0 else None)
+
+
+
+## Download an accession with prefetch (kept if already downloaded), return the .sra file
+def prefetch(accession, dir, prefetch_prog='prefetch'):
+    res = sraFile(accession, dir)
+    if res is not None:
+        return(res)
+    os.makedirs(dir, exist_ok=True)
+    retryCall('%s -O %s %s' % (prefetch_prog, dir, accession), 'prefetch %s' % (accession))
+    res = sraFile(accession, dir)
+    if res is None:
+        raise RuntimeError('prefetch did not write %s.sra to %s' % (accession, dir))
+    return(res)
+
+
+
+## Lock an accession in the download directory (<dir>/<accession>.lock), so that one process at a time
+## downloads or uses it; returns the locked file descriptor, or None if block=False and it is locked
+## flock() locks are released when their process ends, so a killed job does not leave a stale lock
+def lock(accession, dir, block=True):
+    os.makedirs(dir, exist_ok=True)
+    fd = os.open(os.path.join(dir, accession + '.lock'), os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | (0 if block else fcntl.LOCK_NB))
+    except BlockingIOError:
+        os.close(fd)
+        return(None)
+    return(fd)
+
+
+
+def unlock(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+
+## Accessions requested by a getfile job are marked <dir>/<accession>.taken; the prefetch queue no longer
+## downloads them, counts them against its budget or removes them
+def markTaken(accession, dir):
+    os.makedirs(dir, exist_ok=True)
+    open(os.path.join(dir, accession + '.taken'), 'w').close()
+
+
+
+def isTaken(accession, dir):
+    return(os.path.exists(os.path.join(dir, accession + '.taken')))
+
+
+
+## Extraction command writing all reads of a .sra file to stdout (mates of a spot concatenated, like fastq-dump)
+## fasterq-dump extracts with several threads, fastq-dump with one
+def extractCommand(sra_file, fastq_dump_prog, threads=1, tmp_dir=None):
+    if os.path.basename(fastq_dump_prog.split(' ')[0]).startswith('fasterq-dump'):
+        return('%s --concatenate-reads --stdout -e %s -t %s %s' % (fastq_dump_prog, max(1, threads), tmp_dir or os.path.dirname(sra_file), sra_file))
+    return('%s --stdout %s' % (fastq_dump_prog, sra_file))
+
+
+
+## Extract a .sra file to a gzipped FASTQ (parallel compression, written under a temporary name)
+def extract(sra_file, out_file, fastq_dump_prog, threads=1):
+    tmp = out_file + '.tmp'
+    cmd = 'set -o pipefail; %s | %s > %s' % (extractCommand(sra_file, fastq_dump_prog, threads), compression.compressCommand(compression.INTERMEDIATE, threads), tmp)
+    retryCall(cmd, 'Extracting %s' % (os.path.basename(sra_file)))
+    os.replace(tmp, out_file)
+    return(out_file)
+
+
+
+## Remove a downloaded accession
+def removeSra(sra_file):
+    os.remove(sra_file)
+    if os.path.basename(os.path.dirname(sra_file)) + '.sra' == os.path.basename(sra_file):
+        shutil.rmtree(os.path.dirname(sra_file), ignore_errors=True)
+
+
+
+## Downloads upcoming accessions in the background while earlier samples are processed
+## At most max_files downloaded-but-unused accessions (and max_mb MB of them, if > 0) are kept ahead; a
+## download that is over the budget waits until earlier ones are taken
+## The getfile jobs run in their own processes, so the queue coordinates with them only through the
+## download directory: accession locks and .taken markers (see fetch())
+class PrefetchQueue:
+    def __init__(self, accessions, dir, prefetch_prog='prefetch', workers=PREFETCH_WORKERS, max_files=None, max_mb=0):
+        self.dir = dir
+        self.prefetch_prog = prefetch_prog
+        self.max_files = max_files if max_files is not None else 2 * workers
+        self.max_bytes = max_mb * 1024 ** 2
+        self.ready = {}
+        self.running = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = dict([(x, self.executor.submit(self.run, x)) for x in accessions])
+        logging.info('Prefetching %s SRA accession(s) in the background (%s at a time)' % (len(accessions), workers))
+
+
+    ## Projected disk use of the accessions ahead: finished downloads plus running ones at their mean size
+    def used(self):
+        self.ready = dict([(x, y) for x, y in self.ready.items() if not isTaken(x, self.dir)])
+        mean = sum(self.ready.values()) / len(self.ready) if len(self.ready) > 0 else 0
+        return(len(self.ready) + self.running, sum(self.ready.values()) + self.running * mean)
+
+
+    ## Download an accession once it fits the budget, unless a job has taken (and downloads) it already
+    ## A failed download is left to the job, which downloads the accession again
+    def run(self, accession):
+        with self.cond:
+            while True:
+                if self.stopped or isTaken(accession, self.dir):
+                    return(None)
+                files, size = self.used()
+                if files < self.max_files and (self.max_bytes <= 0 or size < self.max_bytes):
+                    break
+                self.cond.wait(PREFETCH_POLL)
+            self.running += 1
+        res = None
+        fd = lock(accession, self.dir, block=False)
+        try:
+            if fd is not None and not isTaken(accession, self.dir):
+                res = prefetch(accession, self.dir, self.prefetch_prog)
+        except (subprocess.CalledProcessError, RuntimeError) as e:
+            logging.warning('Background prefetch of %s failed: %s' % (accession, e))
+        finally:
+            with self.cond:
+                self.running -= 1
+                if res is not None and not isTaken(accession, self.dir):
+                    if self.stopped:
+                        removeSra(res)
+                    else:
+                        self.ready[accession] = os.path.getsize(res)
+                self.cond.notify_all()
+            if fd is not None:
+                unlock(fd)
+        return(res)
+
+
+    ## Cancel downloads that have not started and remove the downloaded accessions that were never taken
+    ## (downloads still running are removed when they finish)
+    def stop(self):
+        [x.cancel() for x in self.futures.values()]
+        with self.cond:
+            self.stopped = True
+            for x in list(self.ready):
+                fd = lock(x, self.dir, block=False)
+                if fd is None:
+                    continue
+                res = sraFile(x, self.dir)
+                if res is not None and not isTaken(x, self.dir):
+                    removeSra(res)
+                unlock(fd)
+            self.ready = {}
+            self.cond.notify_all()
+        self.executor.shutdown(wait=False)
+
+
+
+## Accessions of the samples whose reads still have to be fetched (any getfile output missing; patterns
+## contain {sample}), in sample order
+def pendingAccessions(manifest, samples, patterns):
+    return([x for s in samples if not all([os.path.exists(p.format(sample=s)) for p in patterns])
+            for f in manifest.inputs(s) for x in f.split(';') if isAccession(x)])
+
+
+
+## Start prefetching accessions (in the order they will be needed); markers of earlier runs are cleared
+def startPrefetch(accessions, dir=SRA_DIR, prefetch_prog='prefetch', workers=PREFETCH_WORKERS, max_mb=0):
+    global _queue
+    if len(accessions) > 0 and _queue is None:
+        [os.remove(os.path.join(dir, x + '.taken')) for x in accessions if isTaken(x, dir)]
+        _queue = PrefetchQueue(accessions, dir, prefetch_prog, workers, max_mb=max_mb)
+
+
+
+def stopPrefetch():
+    global _queue
+    if _queue is not None:
+        _queue.stop()
+        _queue = None
+
+
+
+## Fetch accession(s) to <out_dir>/<accession>.fastq.gz, return the FASTQ files
+## The accession is taken from sra_dir, the prefetch queue's directory: its lock waits for a download that
+## is running, an accession that was not (or not successfully) prefetched is downloaded now
+## A failed download or extraction is retried on its own; the .sra file is removed once extracted
+def fetch(accession, out_dir, fastq_dump_prog, prefetch_prog='prefetch', threads=1, sra_dir=SRA_DIR):
+    res = []
+    for x in accession:
+        markTaken(x, sra_dir)
+        fd = lock(x, sra_dir)
+        try:
+            sra_file = prefetch(x, sra_dir, prefetch_prog)
+            res.append(extract(sra_file, os.path.join(out_dir, x + '.fastq.gz'), fastq_dump_prog, threads))
+            removeSra(sra_file)
+        finally:
+            unlock(fd)
+    return(res)
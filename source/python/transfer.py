@@ -0,0 +1,89 @@
+#############################################################################################################
+# RSEQREP: RNA-Seq Reports, an open-source cloud-enabled framework for reproducible
+# RNA-Seq data processing, analysis, and result reporting
+#
+# https://github.com/emmesgit/RSEQREP
+#
+# Copyright (C) 2019 The Emmes Corporation
+#
+# This program is free software that contains third party software subject to various licenses,
+# namely, the GNU General Public License version 3 (or later), the GNU Affero General Public License
+# version 3 (or later), and the LaTeX Project Public License v.1.3(c). A list of the software contained
+# in this program, including the applicable licenses, can be accessed here:
+#
+# https://github.com/emmesgit/RSEQREP/blob/master/SOFTWARE.xlsx
+#
+# You can redistribute and/or modify this program, including its components, only under the terms of
+# the applicable license(s).
+#
+# This program is distributed in the hope that it will be useful, but "as is," WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# To cite this software, please reference doi:10.12688/f1000research.13049.1
+#
+# Program:  transfer.py
+# Version:  RSEQREP 2.3.0
+# Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
+# Purpose:  Concurrent cloud file transfers with retries
+# Input:    N/A
+# Output:   N/A
+#############################################################################################################
+
+import os
+import time
+import logging
+import subprocess
+import utils
+from concurrent.futures import ThreadPoolExecutor
+
+## Number of files transferred at once (the aws cli already transfers the parts of each file concurrently)
+TRANSFER_WORKERS = 4
+
+## Number of attempts per file, and initial wait between attempts in seconds (doubled after every failure)
+TRANSFER_RETRIES = 3
+TRANSFER_BACKOFF = 5
+
+## Alternate S3 endpoint, e.g. a local MinIO/moto server for testing (also read from RSEQREP_S3_ENDPOINT)
+ENDPOINT_URL = os.environ.get('RSEQREP_S3_ENDPOINT', '')
+
+
+
+## Build an aws s3 cp command; either side may be '-' to stream through stdin/stdout
+def s3Command(prog, src, dst, endpoint_url=None):
+    endpoint_url = ENDPOINT_URL if endpoint_url is None else endpoint_url
+    cmd = '%s s3 cp %s %s' % (prog, src, dst)
+    if endpoint_url:
+        cmd += ' --endpoint-url %s' % (endpoint_url)
+    return(cmd)
+
+
+
+## Run a single transfer command, retrying with exponential backoff
+## local_file is only used to log the throughput once the transfer is done
+def transferFile(cmd, local_file, retries=TRANSFER_RETRIES, backoff=TRANSFER_BACKOFF):
+    for i in range(retries):
+        try:
+            start_time = time.time()
+            utils.logging_call(cmd, shell=True)
+        except subprocess.CalledProcessError as e:
+            if i == retries - 1:
+                raise e
+            logging.warning('Transfer failed (attempt %s of %s), retrying in %ss: %s' % (i+1, retries, backoff * 2 ** i, local_file))
+            time.sleep(backoff * 2 ** i)
+        else:
+            break
+
+    ## Log throughput
+    wc = max(time.time() - start_time, 1e-6)
+    size = os.path.getsize(local_file) / (1024 * 1024) if os.path.exists(local_file) else 0
+    logging.info('Transferred %s: %.1f MB in %.1fs (%.1f MB/s)' % (local_file, size, wc, size / wc))
+    return(local_file)
+
+
+
+## Copy a list of (source, destination) pairs to/from S3 using a bounded worker pool
+## Returns the local file of each pair once all transfers are complete
+def s3Copy(pairs, prog='aws', upload=True, workers=TRANSFER_WORKERS, retries=TRANSFER_RETRIES, endpoint_url=None):
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pairs)))) as pool:
+        futures = [pool.submit(transferFile, s3Command(prog, src, dst, endpoint_url), src if upload else dst, retries) for src, dst in pairs]
+        return([x.result() for x in futures])
@@ -24,7 +24,7 @@
 # Program:  trimadapters.py
 # Version:  RSEQREP 2.3.0
 # Author:   William F Hooper, Travis L. Jensen, Johannes B. Goll
-# Purpose:  Cutadapt wrapper 
+# Purpose:  Cutadapt wrapper, sliding window quality trimming
 # Input:    N/A
 # Output:   N/A
 #############################################################################################################
@@ -34,19 +34,11 @@ import os
 import subprocess
 import utils
 import argparse
+import compression
 
 
-## Get the correct adapter sequences for this sample
-def getAdapters(sam, fp_adapters, tp_adapters, samid_all):
-	fp_adapter = [fp_adapters[i[0]] for i in enumerate(samid_all) if samid_all[i[0]] == sam][0]
-	tp_adapter = [tp_adapters[i[0]] for i in enumerate(samid_all) if samid_all[i[0]] == sam][0]
-	return({'tp':tp_adapter, 'fp':fp_adapter})
-
-
-def trimAdapters(cutadapt, infile, outfile, adapt3='NA', adapt5='NA', threads='1'):
-	
-	## Determine how many adapters there are, and the ended-ness of the data
-	is_paired_end  = False if len(infile) == 1 else True
+## Cutadapt adapter options for the adapters present and the ended-ness of the data
+def adapterOptions(is_paired_end, adapt3='NA', adapt5='NA'):
 	is_three_prime = False if adapt3 == 'NA' else True
 	is_five_prime  = False if adapt5 == 'NA' else True
 	
@@ -56,23 +48,150 @@ def trimAdapters(cutadapt, infile, outfile, adapt3='NA', adapt5='NA', threads='1
 	
 	## If both adapters are present and this is single ended data, use linked trimming
 	if (is_three_prime and is_five_prime and not is_paired_end):
-		trim_string = '-a '+adapt5+'...'+adapt3+' -o '+outfile[0]+' '+infile[0]
+		return('-a '+adapt5+'...'+adapt3)
 		
 	## If only single ended and 5' adapter, use anchored 5' trimming
 	elif (is_five_prime and not is_three_prime and not is_paired_end):
-		trim_string = '-g ^'+adapt5+' -o '+outfile[0]+' '+infile[0]
-		
+		return('-g ^'+adapt5)
 	
 	## If only single ended and 3' adapter, use default 3' trimming
 	elif (is_three_prime and not is_five_prime and not is_paired_end):
-		trim_string = '-a '+adapt3+' -o '+outfile[0]+' '+infile[0]
-		
+		return('-a '+adapt3)
 	
 	## If paired end, make sure that both adapters are present
 	elif (is_three_prime and is_five_prime and is_paired_end):
-		trim_string = '-a '+adapt3 + ' -A '+adapt5+' -o '+outfile[0]+' -p '+outfile[1]+' '+infile[0]+' '+infile[1]
+		return('-a '+adapt3 + ' -A '+adapt5)
+	
+	raise RuntimeError('Paired end trimming needs both adapters')
+
+
+def trimAdapters(cutadapt, infile, outfile, adapt3='NA', adapt5='NA', threads='1'):
+	
+	## Determine the ended-ness of the data
+	is_paired_end  = False if len(infile) == 1 else True
+	
+	## Adapter options, output(s) and input(s)
+	trim_string = adapterOptions(is_paired_end, adapt3, adapt5)+' -o '+outfile[0]
+	if is_paired_end:
+		trim_string += ' -p '+outfile[1]
+	trim_string += ' '+' '.join(infile)
 		
-	trim_cmd = cutadapt+' '+trim_string+' -m 15 -e 0.1 -O 5 --cores '+str(threads)
+	trim_cmd = cutadapt+' '+trim_string+' -m 15 -e 0.1 -O 5 --cores '+str(threads)+compression.cutadaptOptions()
 	bench_obj = utils.logging_call(trim_cmd, shell=True)
 	
-	return(bench_obj)
\ No newline at end of file
+	return(bench_obj)
+
+
+## Adapter trimming and quality trimming in one streaming pass: cutadapt writes uncompressed reads
+## (interleaved pairs for paired end data) to a pipe, the sliding window trimmer (this script) writes
+## the compressed outputs of Trimmomatic SLIDINGWINDOW:<window>:<quality> (1P 1U 2P 2U for paired end)
+def trimAdaptersQuality(cutadapt, infile, outfile, adapt3='NA', adapt5='NA', threads='1', quality=20, window=4):
+	is_paired_end  = False if len(infile) == 1 else True
+	interleaved = ' --interleaved' if is_paired_end else ''
+	trim_cmd = cutadapt+' '+adapterOptions(is_paired_end, adapt3, adapt5)+interleaved+' -o - '+' '.join(infile)+' -m 15 -e 0.1 -O 5 --cores '+str(threads)
+	filter_cmd = '%s %s --window %s --quality %s --threads %s%s %s' % (sys.executable, os.path.abspath(__file__), window, quality, threads, interleaved, ' '.join(outfile))
+	bench_obj = utils.logging_call('set -o pipefail; '+trim_cmd+' | '+filter_cmd, shell=True, executable='/bin/bash')
+	return(bench_obj)
+
+
+## Length of a read to keep after Trimmomatic SLIDINGWINDOW:<window>:<quality> (0 = drop the read)
+## Cut where the average quality of a window first drops below quality, then drop low quality
+## bases from the new end; qual is the Phred+33 quality line as bytes
+def slidingWindow(qual, window, quality, offset=33):
+	if len(qual) < window:
+		return(0)
+	required = (quality + offset) * window
+	total = sum(qual[:window])
+	if total < required:
+		return(0)
+	keep = len(qual)
+	for i in range(len(qual) - window):
+		total += qual[i + window] - qual[i]
+		if total < required:
+			keep = i + window
+			break
+	while keep > 0 and qual[keep - 1] < quality + offset:
+		keep -= 1
+	return(keep)
+
+
+## FASTQ records (lists of 4 lines, as bytes) of a stream
+def readFastq(stream):
+	while True:
+		record = [stream.readline() for i in range(4)]
+		if not record[0]:
+			return
+		yield record
+
+
+## Quality trimmed record, None if nothing is left
+def trimRecord(record, window, quality):
+	qual = record[3].rstrip(b'\r\n')
+	n = slidingWindow(qual, window, quality)
+	if n == 0:
+		return(None)
+	if n == len(qual):
+		return(record)
+	return([record[0], record[1][:n]+b'\n', record[2], qual[:n]+b'\n'])
+
+
+## Sliding window quality trimming of (interleaved) FASTQ from a stream into gzipped output(s)
+## Paired end: pairs with both reads left go to 1P/2P, single survivors to 1U/2U (like Trimmomatic PE)
+def qualityTrim(stream, outfile, window, quality, interleaved=False, threads=1):
+	outs = [compression.openWrite(x, compression.INTERMEDIATE, threads) for x in outfile]
+	counts = [0, 0, 0, 0, 0]
+	try:
+		records = readFastq(stream)
+		for r1 in records:
+			counts[0] += 1
+			t1 = trimRecord(r1, window, quality)
+			if not interleaved:
+				if t1 is not None:
+					outs[0].writelines(t1)
+					counts[1] += 1
+				continue
+			r2 = next(records, None)
+			if r2 is None:
+				raise RuntimeError('Interleaved input ends with an unpaired read')
+			t2 = trimRecord(r2, window, quality)
+			if t1 is not None and t2 is not None:
+				outs[0].writelines(t1)
+				outs[2].writelines(t2)
+				counts[1] += 1
+			elif t1 is not None:
+				outs[1].writelines(t1)
+				counts[2] += 1
+			elif t2 is not None:
+				outs[3].writelines(t2)
+				counts[3] += 1
+			else:
+				counts[4] += 1
+	finally:
+		[x.close() for x in outs]
+	
+	## Trimmomatic-style summary
+	pct = lambda x: 100.0 * x / max(1, counts[0])
+	if interleaved:
+		print('Input Read Pairs: %s Both Surviving: %s (%.2f%%) Forward Only Surviving: %s (%.2f%%) Reverse Only Surviving: %s (%.2f%%) Dropped: %s (%.2f%%)'
+			% (counts[0], counts[1], pct(counts[1]), counts[2], pct(counts[2]), counts[3], pct(counts[3]), counts[4], pct(counts[4])), file=sys.stderr)
+	else:
+		print('Input Reads: %s Surviving: %s (%.2f%%) Dropped: %s (%.2f%%)' % (counts[0], counts[1], pct(counts[1]), counts[0] - counts[1], pct(counts[0] - counts[1])), file=sys.stderr)
+	return(counts)
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Sliding window quality trimming (Trimmomatic SLIDINGWINDOW) of FASTQ read from standard input')
+	parser.add_argument('--window', type=int, default=4, help='window size')
+	parser.add_argument('--quality', type=float, required=True, help='required average quality')
+	parser.add_argument('--threads', type=int, default=1, help='compression threads per output file')
+	parser.add_argument('--interleaved', action='store_true', help='input holds interleaved read pairs (outputs: 1P 1U 2P 2U)')
+	parser.add_argument('outfile', nargs='+', help='gzipped output file(s)')
+	args = parser.parse_args(argv)
+	if len(args.outfile) != (4 if args.interleaved else 1):
+		parser.error('expected %s output file(s)' % (4 if args.interleaved else 1))
+	qualityTrim(sys.stdin.buffer, args.outfile, args.window, args.quality, args.interleaved, args.threads)
+	return(0)
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -31,55 +31,142 @@
 
 import datetime
 import shutil
-import snakemake
 import subprocess
 import logging
 import os
-import glob
 import hashlib
-import psutil
 import time
+import checksum
+import threading
 from itertools import chain
 
+## Heavy/rarely used dependencies (snakemake, psutil, the merge modules) are imported where they are 
+## used: helper modules are loaded by every rseqrep call and by every job, most of which never need them
+
 
 ## Simple benchmark class
 ## Essentially a stripped down version of the one provided by snakemake
+## Keeps a record per process in the tree (CPU, memory, I/O, threads, context switches) plus a time 
+## series sampled every series_interval seconds.  CPU time is the sum of the last observed user+system 
+## time of every process seen; peak memory is the largest tree-wide sum observed in a single sample.
+## Cheap counters (memory_info) are used unless full_memory=True (memory_full_info walks smaps).
 class Benchmark:
-    def __init__(self):
+    def __init__(self, series_interval=5, full_memory=False):
         self.running_time = 0
         self.cpu_seconds = 0
         self.max_rss = 0
         self.max_vms = 0 
+        self.io_read_bytes = 0
+        self.io_write_bytes = 0
         self.return_code = None
+        self.monitor_seconds = 0
+        self.processes = {}
+        self.series = []
+        self.series_interval = series_interval
+        self.full_memory = full_memory
+        self.start_time = time.time()
+        self.last_series = None
+        
+        
+    ## Benchmark restricted to the processes whose command line contains pattern (e.g. one stage of a pipe)
+    ## Peak memory is the sum of the per-process peaks, an upper bound on the stage's concurrent peak
+    def stage(self, pattern):
+        res = Benchmark()
+        res.running_time = self.running_time
+        res.return_code = self.return_code
+        procs = dict([(k, v) for k, v in self.processes.items() if pattern in v['cmd']])
+        res.processes = procs
+        res.series = [x for x in self.series if x['pid'] in procs]
+        res.summarize()
+        res.max_rss = sum([x['max_rss'] for x in procs.values()])
+        res.max_vms = sum([x['max_vms'] for x in procs.values()])
+        return(res)
+    
+    
+    ## A sample's share of a benchmark covering several samples (one batched run)
+    ## Times and I/O are scaled by fraction, peak memory is that of the whole run; the resource series
+    ## is only kept if requested (so it is stored once per run)
+    def share(self, fraction, series=False):
+        res = Benchmark()
+        res.return_code = self.return_code
+        res.running_time = self.running_time * fraction
+        res.cpu_seconds = self.cpu_seconds * fraction
+        res.io_read_bytes = int(self.io_read_bytes * fraction)
+        res.io_write_bytes = int(self.io_write_bytes * fraction)
+        res.max_rss = self.max_rss
+        res.max_vms = self.max_vms
+        res.processes = self.processes
+        res.series = self.series if series else []
+        return(res)
+    
+    
+    ## Recompute totals from the per-process records
+    def summarize(self):
+        self.cpu_seconds = sum([x['cpu_seconds'] for x in self.processes.values()])
+        self.io_read_bytes = sum([x['read_bytes'] for x in self.processes.values()])
+        self.io_write_bytes = sum([x['write_bytes'] for x in self.processes.values()])
         
         
     ## Take measurements
     def update(self, pid):
+        import psutil
     
         # Memory measurements
         rss, vms = 0, 0
+        now = time.time()
+        keep_series = self.last_series is None or now - self.last_series >= self.series_interval
         
         # Iterate over process and all children
         try:
             main = psutil.Process(pid)
+            procs = list(chain((main,), main.children(recursive=True)))
+        except psutil.Error as e:
+            return
             
-            ## Sum virtual memory, resident set size over all threads
-            ## For a given update, sum CPU times across threads and replace recorded time with sum
-            for proc in chain((main,), main.children(recursive=True)):
-                self.cpu_seconds = sum([x for x in proc.cpu_times()])
-                meminfo = proc.memory_full_info()
-                rss += meminfo.rss
-                vms += meminfo.vms
+        for proc in procs:
+            try:
+                with proc.oneshot():
+                    cpu = proc.cpu_times()
+                    meminfo = proc.memory_full_info() if self.full_memory else proc.memory_info()
+                    try:
+                        io = proc.io_counters()
+                        read_bytes, write_bytes = io.read_bytes, io.write_bytes
+                    except (psutil.AccessDenied, AttributeError):
+                        read_bytes, write_bytes = 0, 0
+                    ctx = proc.num_ctx_switches()
+                    
+                    ## Per-process record, keyed by pid (command is program + first argument)
+                    if proc.pid not in self.processes:
+                        self.processes[proc.pid] = {'cmd': ' '.join(proc.cmdline()[0:2]), 'name': proc.name(), 'ppid': proc.ppid(), 
+                                                    'cpu_seconds': 0, 'max_rss': 0, 'max_vms': 0, 'read_bytes': 0, 'write_bytes': 0, 
+                                                    'max_threads': 0, 'ctx_switches': 0}
+                    rec = self.processes[proc.pid]
+                    rec['cpu_seconds'] = cpu.user + cpu.system
+                    rec['max_rss'] = max(rec['max_rss'], meminfo.rss / (1024 * 1024))
+                    rec['max_vms'] = max(rec['max_vms'], meminfo.vms / (1024 * 1024))
+                    rec['read_bytes'] = read_bytes
+                    rec['write_bytes'] = write_bytes
+                    rec['max_threads'] = max(rec['max_threads'], proc.num_threads())
+                    rec['ctx_switches'] = ctx.voluntary + ctx.involuntary
+                    rss += meminfo.rss
+                    vms += meminfo.vms
+                    
+                    if keep_series:
+                        self.series.append({'elapsed': now - self.start_time, 'pid': proc.pid, 'ppid': rec['ppid'], 'name': rec['name'], 
+                                            'cpu_seconds': rec['cpu_seconds'], 'rss': meminfo.rss / (1024 * 1024), 'vms': meminfo.vms / (1024 * 1024), 
+                                            'read_bytes': read_bytes, 'write_bytes': write_bytes, 'threads': proc.num_threads(), 'ctx_switches': rec['ctx_switches']})
+                    
+            ## Process exited between listing and sampling -- keep its last observation
+            except psutil.Error as e:
+                continue
                 
-            rss /= 1024 * 1024
-            vms /= 1024 * 1024
-            
-            # Update benchmark record's RSS and VMS
-            self.max_rss = max(self.max_rss, rss)
-            self.max_vms = max(self.max_vms, vms)
+        if keep_series:
+            self.last_series = now
             
-        except psutil.Error as e:
-            return
+        # Update benchmark record's totals, RSS and VMS
+        self.summarize()
+        self.max_rss = max(self.max_rss, rss / (1024 * 1024))
+        self.max_vms = max(self.max_vms, vms / (1024 * 1024))
             
        
 
@@ -91,7 +178,11 @@ def logHandler(x):
 
 
 ## Run a process and redirect process output to log
-def logging_call(popenargs, **kwargs):
+## Output is drained on a reader thread so the child never blocks on a full pipe, while the
+## main thread samples resource usage every `interval` seconds and returns as soon as the child exits
+## The child is reaped with wait4: its resource usage includes the processes it waited for, so the CPU time 
+## of short-lived children that exited between two samples is not lost
+def logging_call(popenargs, interval=0.5, poll=0.05, **kwargs):
     
     ## Log command
     logging.debug(popenargs)
@@ -101,23 +192,44 @@ def logging_call(popenargs, **kwargs):
     process = subprocess.Popen(popenargs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
     pid = process.pid
     
-    ## Check/capture process output    
-    def check_io():
-        output = process.stdout.readline().decode()
-        if output:
-            logging.info(output)
+    ## Capture process output until EOF
+    def drain():
+        for line in iter(process.stdout.readline, b''):
+            logging.info(line.decode(errors='replace'))
+        process.stdout.close()
+    
+    reader = threading.Thread(target=drain, daemon=True)
+    reader.start()
     
     ## Init benchmark object
     bench_obj = Benchmark()
 
-    ## keep checking stdout/stderr until the child exits
-    while process.poll() is None:
-        check_io()
+    ## Sample resources on a fixed timer, checking for the child's exit every `poll` seconds in between
+    usage = None
+    while usage is None:
+        monitor_start = time.time()
         bench_obj.update(pid)
-        time.sleep(0.5)
+        bench_obj.monitor_seconds += time.time() - monitor_start
+        deadline = time.time() + interval
+        while True:
+            wpid, status, ru = os.wait4(pid, os.WNOHANG)
+            if wpid == pid:
+                usage = ru
+                process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                break
+            if time.time() >= deadline:
+                break
+            time.sleep(min(poll, max(0, deadline - time.time())))
+    
+    ## CPU time of the whole process tree: the samples also cover children that were never waited for
+    bench_obj.cpu_seconds = max(bench_obj.cpu_seconds, usage.ru_utime + usage.ru_stime)
+    
+    ## Make sure all remaining output has been logged
+    reader.join()
     
     ## Compute wall clock time
     bench_obj.running_time = time.time() - start_time 
+    logging.debug('Monitor overhead: %.3fs of %.3fs wall clock time' % (bench_obj.monitor_seconds, bench_obj.running_time))
     
     ## Check return code
     bench_obj.return_code = process.returncode
@@ -140,25 +252,75 @@ def toList(x):
     
 
 ## cat together files
-def cat(in_files, out_file):
-    f = ' '.join(in_files)
-    cmd = 'cat '+f+' > '+out_file
-    subprocess.run(cmd, shell=True, check=True)
+## If a checksum cache is given, the output is hashed as it is written and the digest cached
+def cat(in_files, out_file, hash=None, cache_db=None):
+    with checksum.HashingWriter(out_file, hash if cache_db else None) as out:
+        for f in in_files:
+            with open(f, 'rb') as src:
+                shutil.copyfileobj(src, out, checksum.CHUNK_SIZE)
+    checksum.storeChecksum(out_file, hash, out.hexdigest(), cache_db)
     
     
     
 ## Decrypt file(s), return path to result
-def decryptFile(in_file, openssl, password, hash):
+## If a checksum cache is given, the decrypted output is hashed as it is written and the digest cached
+def decryptFile(in_file, openssl, password, hash, cache_db=None):
     res = []
     for f in in_file:
-        cmd = openssl+' aes-256-cbc -md '+hash+' -d -pass pass:'+password+' < '+f+' > ' + os.getcwd() + '/' +os.path.basename(f)[:-4]
-        #subprocess.run(cmd, shell=True, check=True)
-        logging_call(cmd, shell=True)
-        res.append(os.getcwd() + '/' +os.path.basename(f)[:-4])
+        out_file = os.getcwd() + '/' +os.path.basename(f)[:-4]
+        cmd = openssl+' aes-256-cbc -md '+hash+' -d -pass pass:'+password+' < '+f
+        logging.debug(openssl+' aes-256-cbc -md '+hash+' -d < '+f)
+        with checksum.HashingWriter(out_file, hash if cache_db else None) as out:
+            process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+            shutil.copyfileobj(process.stdout, out, checksum.CHUNK_SIZE)
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(returncode=process.returncode, cmd=cmd)
+        checksum.storeChecksum(out_file, hash, out.hexdigest(), cache_db)
+        res.append(out_file)
     return(res)
 
 
 
+## Repack a zip archive as a gzipped tar without extracting it: entries are streamed from the zip into the tar
+## below prefix (the layout of unzip -d prefix followed by tar -czf out_file prefix)
+## If a checksum cache is given, the archive is hashed as it is written and the digest cached
+def zipToTarGz(zip_file, out_file, prefix, hash=None, cache_db=None):
+    import gzip
+    import tarfile
+    import zipfile
+    import compression
+    root = prefix.rstrip('/')
+    dirs = set()
+    
+    ## Directory member, added once (with its parents up to prefix) before the first entry below it
+    def addDir(tar, name, mtime):
+        if name in dirs or not name.startswith(root):
+            return
+        addDir(tar, os.path.dirname(name), mtime)
+        x = tarfile.TarInfo(name)
+        x.type, x.mode, x.mtime = tarfile.DIRTYPE, 0o755, mtime
+        tar.addfile(x)
+        dirs.add(name)
+    
+    with zipfile.ZipFile(zip_file) as zf, checksum.HashingWriter(out_file, hash if cache_db else None) as out:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=out, compresslevel=compression.FINAL) as gz, tarfile.open(fileobj=gz, mode='w|') as tar:
+            addDir(tar, root, time.time())
+            for info in zf.infolist():
+                name = os.path.join(prefix, info.filename).rstrip('/')
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                addDir(tar, os.path.dirname(name), mtime)
+                if info.is_dir():
+                    addDir(tar, name, mtime)
+                    continue
+                x = tarfile.TarInfo(name)
+                x.size, x.mtime, x.mode = info.file_size, mtime, (info.external_attr >> 16) & 0o7777 or 0o644
+                with zf.open(info) as src:
+                    tar.addfile(x, src)
+    checksum.storeChecksum(out_file, hash, out.hexdigest(), cache_db)
+    return(out_file)
+
+
+
 ## Encrypt file(s), return path to result
 def encryptFile(file, openssl, password, hash):
     res = []
@@ -201,24 +363,24 @@ def returnCode(log, sample='', process='', outfile=''):
 
 
 
-## Timestamp and compress the log upon exit
-def archiveLog(log):
+## Timestamp and compress the log upon exit (final result: strong compression, parallel if pigz/bgzip is available)
+def archiveLog(log, threads=1):
+    import compression
     t = datetime.datetime.now().strftime('%Y-%m-%d.h%H-m%M-s%S')
     new_log = log+'.'+t
     try:
         shutil.copy2(log, new_log)
-        snakemake.shell('gzip -9 '+new_log)
-    except (FileNotFoundError, PermissionError) as e:
+        compression.compressFile(new_log, compression.FINAL, threads)
+    except (FileNotFoundError, PermissionError, RuntimeError) as e:
         pass
 
 
 
 ## Shorthand for touch - takes list<str> or str
 def touch(file):
-    if type(file) is list:
-        [snakemake.shell('touch ' + x) for x in file]
-    else:
-        snakemake.shell('touch {file}')
+    for x in toList(file):
+        with open(x, 'a'):
+            os.utime(x)
     
 
 
@@ -235,23 +397,53 @@ def addResultsToDataDir(datadir, resdir):
     destdir = datadir + '/' + resdir 
     if (not os.path.isdir(destdir)):
         os.mkdir(destdir)
+    import glob
     [shutil.copy2(x, destdir) for x in glob.glob(resdir+'/*_counts.RData')]
     
     
     
 ## Determine the outputs from HISAT2 -- changes depending on whether we're remapping or not
 def hisatOutput(ends, iontorrent):
+    import snakemake
     res = {'aln' : snakemake.io.temp('tmp/{sample}.sam')}
             
     if (iontorrent):
-        res['un_aln'] = snakemake.io.temp(expand('tmp/{{sample}}_iontorrent_{pe}.fastq.gz', pe=ends))
+        res['un_aln'] = snakemake.io.temp(snakemake.io.expand('tmp/{{sample}}_iontorrent_{pe}.fastq.gz', pe=ends))
         
     return(res)
     
 
 
+## Build HISAT2 read input and (for iontorrent remapping) unaligned read output arguments
+def hisatArgs(fa, ends, sample, iontorrent):
+    unmapped_str = ''
+    if (len(ends) == 1):
+        in_fa_str = "-U "+fa[0]
+        if (iontorrent):
+            unmapped_str = "--un-gz tmp/"+sample+"_iontorrent_1.fastq.gz"
+    elif (len(ends) == 2):
+        in_fa_str = '-1 '+fa[0]+' -2 '+fa[2]
+        if (iontorrent):
+            unmapped_str = "--un-conc-gz tmp/"+sample+"_iontorrent_%.fastq.gz"
+    return(in_fa_str, unmapped_str)
+
+
+
+## Determine the outputs of the fused HISAT2 -> sort job
+def fusedAlignOutput(ends, iontorrent, cram, temp):
+    import snakemake
+    res = {'bam' : sortBamOutput(iontorrent=iontorrent, cram=cram, temp=temp)}
+    
+    if (iontorrent):
+        res['un_aln'] = snakemake.io.temp(snakemake.io.expand('tmp/{{sample}}_iontorrent_{pe}.fastq.gz', pe=ends))
+        
+    return(res)
+
+
+
 ## Determine bam output based on whether we're remapping/compressing
 def sortBamOutput(iontorrent, cram, temp):
+    import snakemake
     if iontorrent:
         return(snakemake.io.temp('tmp/{sample}_sorted.bam'))
     else:
@@ -263,38 +455,26 @@ def sortBamOutput(iontorrent, cram, temp):
 
 
 ## Merge RSeQC results, return paths to merged results
-def mergeRSEQC(srcdir, run_read_dist):
+## RSeQC results are parsed by a pool of worker processes
+## With count_npy=True the count matrix is also written as a .npy matrix
+## With a cache_dir, per-sample results are cached by fingerprint and only new/changed samples are parsed
+def mergeRSEQC(run_read_dist, count_npy=False, cache_dir=None, hash=None, cache_db=None, workers=1):
+    import rseqcparse
+    import countmatrix
     retvals = ['sample_metadata.csv','rseqc/bam_qc_parsed.tab', 'rseqc/bam_gc_parsed.tab', 'rseqc/bam_jc_parsed.tab', 'feature_counts/fragment_count_matrix.tab.gz','feature_counts/gene_lengths.tab']
     
-    ## QC
-    snakemake.shell("find rseqc | grep -P 'bam_qc.txt$' > bam_qc_outfiles.txt")
-    snakemake.shell("perl {srcdir}/perl/parse-rseqc-bam-qc-results.pl bam_qc_outfiles.txt > rseqc/bam_qc_parsed.tab")
-    snakemake.shell("rm bam_qc_outfiles.txt")
-
-    ## GC
-    snakemake.shell("find rseqc | grep -P 'bam_gc.txt$' > bam_gc_outfiles.txt")
-    snakemake.shell("perl {srcdir}/perl/parse-rseqc-bam-gc-results.pl bam_gc_outfiles.txt > rseqc/bam_gc_parsed.tab")
-    snakemake.shell("rm bam_gc_outfiles.txt")
-
-    ## JC
-    snakemake.shell("find rseqc | grep -P 'bam_jc.txt$' > bam_jc_outfiles.txt")
-    snakemake.shell("perl {srcdir}/perl/parse-rseqc-bam-jc-results.pl bam_jc_outfiles.txt > rseqc/bam_jc_parsed.tab")
-    snakemake.shell("rm bam_jc_outfiles.txt")
-    
-    ## RC
+    ## RSeQC tables: (result type, output)
+    tables = [('qc', 'rseqc/bam_qc_parsed.tab'), ('gc', 'rseqc/bam_gc_parsed.tab'), ('jc', 'rseqc/bam_jc_parsed.tab')]
     if (run_read_dist) == 1:
-        snakemake.shell("find rseqc | grep -P 'bam_rc.txt$' > bam_rc_outfiles.txt")
-        snakemake.shell("perl {srcdir}/perl/parse-rseqc-read-distribution-results.pl bam_rc_outfiles.txt > rseqc/bam_rc_parsed.tab")
-        snakemake.shell("rm bam_rc_outfiles.txt")
+        tables.append(('rc', 'rseqc/bam_rc_parsed.tab'))
         retvals.append('rseqc/bam_rc_parsed.tab')
-
-    ## featureCounts
-    snakemake.shell("find feature_counts | grep -P '_count.tab$' > feature_counts_outfiles.txt")
-    snakemake.shell("perl {srcdir}/perl/parse-read-count-matrix-subread-1.4.6.pl feature_counts_outfiles.txt > feature_counts/fragment_count_matrix.tab")
-    snakemake.shell("gzip -f feature_counts/fragment_count_matrix.tab")
-    
-    ## Export gene lengths from a single featurecounts file 
-    snakemake.shell("head -1 feature_counts_outfiles.txt | xargs tail -n +2 | awk '{{print $1,$6}}' > feature_counts/gene_lengths.tab")
-    snakemake.shell("rm feature_counts_outfiles.txt")
+    rseqcparse.mergeResults('rseqc', tables, workers=workers, cache_dir=cache_dir, hash=hash, cache_db=cache_db)
+
+    ## featureCounts -- merge counts and export gene lengths in one pass over the count files
+    npy_file = 'feature_counts/fragment_count_matrix.npy' if count_npy else None
+    countmatrix.mergeCounts(countmatrix.findCountFiles('feature_counts'), 'feature_counts/fragment_count_matrix.tab.gz', 'feature_counts/gene_lengths.tab', npy_file=npy_file,
+                            cache_dir=cache_dir, hash=hash, cache_db=cache_db, threads=workers)
+    if count_npy:
+        retvals.append(npy_file)
     
     return(retvals)
@@ -31,6 +31,7 @@
 #############################################################################################################
 
 ## Import modules
+import os
 import shutil
 import logging as _logging
 
@@ -62,12 +63,15 @@ SOURCEDIR     = config["srcdir"]
 DATADIR       = config["datadir"]
 
 ## Use the source dir to import helper modules
+## Modules only used by a single rule (getfile, trimadapters, refcache) are imported inside that rule
+## (bamqc runs as its own process)
 sys.path.append(SOURCEDIR+'/python')
-import trimadapters
-import getfile  
 import putfile  
 import utils 
 import sqlite
+import planner
+import scratch
+import manifest
 import time 
 
 ## Adapter sequences
@@ -90,6 +94,11 @@ INDEXSEQ = 'genome/Homo_sapiens.ensembl.version'+str(ENSEMBL)+'.genome.fa'
 ANNOTATIONS_BED = 'annot/Homo_sapiens.ensembl.version'+str(ENSEMBL)+'.chr.bed'
 ANNOTATIONS_GTF = 'annot/Homo_sapiens.ensembl.version'+str(ENSEMBL)+'.chr.gtf'
 
+## Shared reference cache (genome indexes are linked from here instead of rebuilt; empty = disabled)
+## reference_cache_gb limits its size, least recently used bundles are evicted first (0 = no limit)
+REFCACHE_DIR = config.get("reference_cache", "")
+REFCACHE_GB  = float(config.get("reference_cache_gb", 0))
+
 ## Remap reads? 
 IONTORRENT   = int(config["ion_torrent"]) == 1
 
@@ -101,6 +110,18 @@ CRAMFLAG     = ['bam','cram'][CRAM]
 RUN_READ_DIST = int(config["run_read_dist"])
 RUN_FASTQC = int(config["run_fastqc"])
 
+## QC engine: 'rseqc' runs bam_stat, read_GC, junction_annotation and read_distribution separately,
+## 'bamqc' computes the same results in a single pass over each BAM (needs pysam, otherwise RSeQC is used)
+QC_ENGINE = config.get("qc_engine", "rseqc")
+if QC_ENGINE == 'bamqc':
+    import bamqc
+    BAMQC = bamqc.available()
+else:
+    BAMQC = False
+
+## Also export the count matrix as a .npy matrix (requires numpy)?
+COUNT_NPY = int(config.get("count_matrix_npy", 0)) == 1
+
 ## List of samples to process
 SAMID        = utils.toList(config["samid"]) 
 
@@ -114,9 +135,20 @@ if (FASTQ_2 != ['']):
 else:
     ENDS  = ['1']
 
+## Sample manifest: inputs, adapters and log database IDs per sample with constant time lookups by sample name
+## (written next to the log database at the start of the run, with the IDs, and loaded by jobs run in other processes)
+MANIFEST_FILE = LOG_FILE + '.manifest.json'
+MANIFEST = manifest.loadManifest(MANIFEST_FILE, SAMID, FASTQ_1, FASTQ_2, FP_ADAPTERS, TP_ADAPTERS, paired=len(ENDS) == 2)
+sqlite.setSamids(LOG_DB, MANIFEST.dbIds())
+
 ## strandedness of experiment
 STRANDED = int(config["stranded"]) 
 
+## Count consecutive groups of count_batch_size samples with one featureCounts run each (0 = one run per sample)
+COUNT_BATCH   = int(config.get("count_batch_size", 0))
+COUNT_BATCHES = [SAMID[i:i+COUNT_BATCH] for i in range(0, len(SAMID), COUNT_BATCH)] if COUNT_BATCH > 0 else []
+COUNT_BATCH_OF = dict([(x, str(i)) for i, batch in enumerate(COUNT_BATCHES) for x in batch])
+
 ## Determine whether adapters should be trimmed or not
 TRIM_FP = sum([x == 'NA'  for x in FP_ADAPTERS]) == 0
 TRIM_TP = sum([x == 'NA'  for x in TP_ADAPTERS]) == 0
@@ -131,12 +163,46 @@ DOENCRYPT    = int(config["encrypt_local"]) == 1
 DECRYPT_PASS = config["decrypt_pass"]
 ENCRYPT_PASS = config["decrypt_pass"]
 
+## Stream input download -> decrypt -> concatenate without intermediate files?
+STREAM_INPUT = int(config.get("stream_input", 0)) == 1
+
+## Fuse HISAT2 alignment, BAM conversion and sorting into one streaming job?
+## sort_mem is samtools sort -m (per thread); sort_threads=0 gives the sorter a quarter of the job's threads
+FUSE_ALIGN   = int(config.get("fuse_align_sort", 0)) == 1
+SORT_MEM     = config.get("sort_mem", "768M")
+SORT_THREADS = int(config.get("sort_threads", 0))
+
 ## Configure quality trimming level
 QUAL_CUTOFF = config["quality_trim"]
 
+## Trim adapters and low quality ends in one streaming pass (cutadapt piped into a sliding window trimmer
+## with Trimmomatic SLIDINGWINDOW semantics) instead of cutadapt followed by Trimmomatic?
+FUSE_TRIM    = int(config.get("fuse_trim", 0)) == 1 and int(QUAL_CUTOFF) > 0
+
 ## number of cores to use
 NCORES  = int(config["ncores"])
 
+## Memory available to the workflow in MB (0 = not limited)
+MEM_MB  = int(config.get("mem_mb", 0))
+
+## Disk available to intermediate files in MB (0 = not limited): new samples are held back while the projected
+## intermediates of the samples in flight would not fit, and jobs are scheduled so their projected output fits
+DISK_MB = int(config.get("disk_mb", 0))
+
+## Fast local volume or tmpfs for temporary files (tmp/ and TMPDIR of all jobs; empty = working directory)
+SCRATCH_DIR = config.get("scratch_dir", "")
+
+## SRA accessions: prefetch program, number of accessions downloaded at once by the background prefetch queue
+## (0 = download when the sample's getfile job runs) and the disk space in MB the queue may fill ahead
+## of the samples being processed (0 = a quarter of disk_mb; without either, two accessions per download)
+PREFETCH        = config.get("prefetch_prog", "prefetch")
+SRA_PREFETCH    = int(config.get("sra_prefetch", 2))
+SRA_PREFETCH_MB = int(config.get("sra_prefetch_mb", 0)) or DISK_MB // 4
+
+## Plan threads/memory of the heavy rules from earlier runs recorded in the log database
+## (rules without history use the defaults given below)
+PLANNER = planner.ResourcePlanner(db=LOG_DB, ncores=NCORES, mem_mb=MEM_MB)
+
 ## hash for encryption/decryption & Checksums
 HASH = config["hash"]
 
@@ -146,38 +212,97 @@ _logging.basicConfig(level=LOG_LEVEL,
                     datefmt='%m/%d/%Y %I:%M:%S %p',
                     handlers=[_logging.FileHandler(LOG_FILE),
                              _logging.StreamHandler(sys.stdout)])
+if QC_ENGINE == 'bamqc' and not BAMQC:
+    _logging.warning('qc_engine bamqc needs pysam and RSeQC in this Python, running the RSeQC scripts instead')
 
+## Rules writing a sample's large intermediates (on the way to its sorted BAM)
+SCRATCH_CHAIN = (['trim_qualityfilter'] if FUSE_TRIM and (TRIM_FP or TRIM_TP) else ['trimadapters', 'qualityfilter'] if TRIM_FP or TRIM_TP else ['qualityfilter']) + \
+                (['align_sort_bam'] if FUSE_ALIGN else ['run_hisat', 'sam_to_bam', 'sort_bam'])
+SCRATCH = scratch.ScratchManager(db=LOG_DB, samples=dict([(x, [y for y in MANIFEST.inputs(x) if y]) for x in SAMID]),
+                                 chain=SCRATCH_CHAIN, budget_mb=DISK_MB)
 
-## Define final output
-OUTPUT = [expand('rseqc/{sample}_bam_qc.txt', sample=SAMID),
-    expand('rseqc/{sample}_bam_gc.txt', sample=SAMID),
-    expand('rseqc/{sample}_bam_jc.txt', sample=SAMID),
-    expand('feature_counts/{sample}_count.tab', sample=SAMID)]
+
+## Define final output (per-sample patterns)
+OUTPUT_PATTERNS = ['rseqc/{sample}_bam_qc.txt', 'rseqc/{sample}_bam_gc.txt', 'rseqc/{sample}_bam_jc.txt', 'feature_counts/{sample}_count.tab']
 if CRAM == 1 and REMOVEINTFILES:
-    OUTPUT.append(expand('progress/{sample}_cram.done', sample=SAMID))
+    OUTPUT_PATTERNS.append('progress/{sample}_cram.done')
 if not REMOVEINTFILES:
-    OUTPUT.append(expand(CRAMFLAG+'/{sample}.'+CRAMFLAG, sample=SAMID))
+    OUTPUT_PATTERNS.append(CRAMFLAG+'/{sample}.'+CRAMFLAG)
 if RUN_READ_DIST == 1:
-    OUTPUT.append(expand('rseqc/{sample}_bam_rc.txt', sample=SAMID))
+    OUTPUT_PATTERNS.append('rseqc/{sample}_bam_rc.txt')
 if RUN_FASTQC == 1:
-    OUTPUT.append(expand('fastqc/{sample}_fastqc.tar.gz', sample=SAMID))
+    OUTPUT_PATTERNS.append('fastqc/{sample}_fastqc.tar.gz')
+OUTPUT = [expand(x, sample=SAMID) for x in OUTPUT_PATTERNS]
+
+## Sample admission order: sample -> earlier sample whose sorted BAM must exist before the sample's reads are fetched
+## Only samples with missing final outputs are chained, so a continued run never recreates the (temporary)
+## BAMs of finished samples. The order is saved at the start of the run and loaded by the jobs run in other
+## processes, which would otherwise compute it again from the outputs and sizes of that moment
+ADMISSION_FILE = LOG_FILE + '.admission.json'
+ADMIT_AFTER = scratch.loadAdmission(ADMISSION_FILE, sqlite.currentRun())
+if ADMIT_AFTER is None:
+    ADMIT_AFTER = SCRATCH.admission(scratch.pendingSamples(SAMID, OUTPUT_PATTERNS))
 
 
 # RULE DEFINITIONS #
 onstart:
-    ## Initialize the SQL metadata database, add samples
+    ## Initialize (or migrate) the SQL metadata database, register this run, add samples
     sqlite.initSqliteDb(db=LOG_DB)
-    [sqlite.addSample(db=LOG_DB, sample_name=x) for x in SAMID]
+    sqlite.startRun(db=LOG_DB)
+    scratch.saveAdmission(ADMISSION_FILE, sqlite.currentRun(), ADMIT_AFTER)
+    sqlite.addSample(db=LOG_DB, sample_name=SAMID)
+    MANIFEST.attach(LOG_DB).save(MANIFEST_FILE)
+    sqlite.setSamids(LOG_DB, MANIFEST.dbIds())
+    
+    ## Temporary files on the scratch volume (one directory per working directory)
+    if SCRATCH_DIR:
+        scratch.linkScratch('tmp', SCRATCH_DIR)
+        os.environ['TMPDIR'] = SCRATCH_DIR
+    
+    ## Start downloading SRA accessions in sample order while the first samples are processed
+    if SRA_PREFETCH > 0:
+        import sra
+        ## (only samples with missing final outputs whose reads have not been fetched yet)
+        accessions = sra.pendingAccessions(MANIFEST, scratch.pendingSamples(SAMID, OUTPUT_PATTERNS), expand('input/{{sample}}_{pe}.fastq.gz', pe=ENDS))
+        sra.startPrefetch(accessions, dir=sra.SRA_DIR, prefetch_prog=PREFETCH, workers=SRA_PREFETCH, max_mb=SRA_PREFETCH_MB)
+onerror:
+    ## Commit any queued provenance records, let background uploads finish, stop SRA prefetching
+    sqlite.flush(db=LOG_DB)
+    putfile.waitForUploads()
+    import sra
+    sra.stopPrefetch()
+    
+    ## Close the run and update the per-rule/sample/run summaries (a reporting failure does not fail the run)
+    try:
+        sqlite.endRun(db=LOG_DB, status='error')
+        import logsummary
+        logsummary.refresh(db=LOG_DB)
+    except Exception as e:
+        _logging.warning('Log database summaries were not updated: %s' % (e))
 onsuccess:
+    ## Commit any queued provenance records, let background uploads finish
+    sqlite.flush(db=LOG_DB)
+    putfile.waitForUploads()
+    import sra
+    sra.stopPrefetch()
+    
     ## merge featurecounts, rseqc results
-    merged_results = utils.mergeRSEQC(SOURCEDIR, RUN_READ_DIST)
+    ## (per-sample results are cached in merge_cache/ so a continued run only parses new/changed samples)
+    merged_results = utils.mergeRSEQC(RUN_READ_DIST, count_npy=COUNT_NPY, cache_dir='merge_cache', hash=HASH, cache_db=LOG_DB, workers=NCORES)
     
     ## Copy to datadir
     [shutil.copy2(x, DATADIR) for x in merged_results]
     
-    ## Encrypt and/or upload merged results
-    if DOENCRYPT: merged_results = [utils.encryptFile(file=x, openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH) for x in merged_results]
-    if DOARCHIVE: [putfile.upload(file=x, destination=ARCHIVE, cloud='aws', prog=AWS) for x in merged_results]
+    ## Encrypt and/or upload merged results (encrypted uploads are streamed, checksums go to the log database)
+    putfile.archive(file=merged_results, destination=ARCHIVE, cloud='aws', prog=AWS, encrypt=DOENCRYPT, openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH, db=LOG_DB)
+    
+    ## Close the run and update the per-rule/sample/run summaries (a reporting failure does not fail the run)
+    try:
+        sqlite.endRun(db=LOG_DB, status='success')
+        import logsummary
+        logsummary.refresh(db=LOG_DB)
+    except Exception as e:
+        _logging.warning('Log database summaries were not updated: %s' % (e))
 
 
 
@@ -208,23 +333,30 @@ rule build_hisat_index:
         'progress/hisat2_index_built.done'
     benchmark:
         'benchmark/build_index.tab'
-    threads: max(1,NCORES)
+    threads: PLANNER.threads('build_hisat_index', default=NCORES)
+    resources:
+        mem_mb=PLANNER.mem('build_hisat_index', default=8000)
     priority: 1000
     params:
         benchmark='benchmark/build_index.tab.info'
     run:
-        ## Run command
-        cmd = '%s -p %s %s index/hisat2_genome_index && %s %s > annot/splicesites.txt' % (HISAT2BUILD, threads, INDEXSEQ, HISAT2SPLICE, ANNOTATIONS_GTF)
-        start_time = time.time()
-        bench_obj = utils.logging_call(cmd+utils.returnCode(process='HISAT2 Build', log=LOG_FILE), shell=True)    
-        end_time = time.time()
-        utils.touch(output)
-        
-        ## Add process and output file to output (just use the first sample in the sample list)
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=SAMID[0])
-        procid = sqlite.addProcess(db=LOG_DB, samid=sqlite.getSamid(db=LOG_DB, sample_name=SAMID[0]), cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=SAMID[0], file_type='build_hisat_index', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Reuse an index built from the same genome/annotation with the same HISAT2 version if one is cached
+        import refcache
+        with refcache.Bundle(REFCACHE_DIR, 'hisat2', inputs=[INDEXSEQ, ANNOTATIONS_GTF], files=['index/hisat2_genome_index.*', 'annot/splicesites.txt'], versions=[HISAT2BUILD+' --version'], params='hisat2-build; extract_splice_sites', cache_db=LOG_DB, max_gb=REFCACHE_GB) as bundle:
+            start_time = time.time()
+            if bundle.fetch():
+                utils.touch(output)
+                sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=SAMID[0], cmd='refcache '+bundle.path, start_time=start_time, end_time=time.time(), return_code=0)
+            else:
+                ## Run command
+                cmd = '%s -p %s %s index/hisat2_genome_index && %s %s > annot/splicesites.txt' % (HISAT2BUILD, threads, INDEXSEQ, HISAT2SPLICE, ANNOTATIONS_GTF)
+                bench_obj = utils.logging_call(cmd+utils.returnCode(process='HISAT2 Build', log=LOG_FILE), shell=True)    
+                end_time = time.time()
+                bundle.store()
+                utils.touch(output)
+                
+                ## Add process, output file(s) and benchmark to the log database
+                sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=SAMID[0], cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='build_hisat_index', hash=HASH)
 
 
 
@@ -236,22 +368,29 @@ rule build_bowtie_index:
         'progress/bowtie2_index_built.done'
     benchmark:
         'benchmark/bowtie2_index.tab'
-    threads: max(1,NCORES)
+    threads: PLANNER.threads('build_bowtie_index', default=NCORES)
+    resources:
+        mem_mb=PLANNER.mem('build_bowtie_index', default=4000)
     params:
         benchmark='benchmark/bowtie2_index.tab.info'
     run:
-        ## Run command
-        cmd = '%s -f %s index/bowtie2_genome_index --threads %s' % (BOWTIE2BUILD, INDEXSEQ, threads)
-        start_time = time.time()
-        bench_obj = utils.logging_call(cmd+utils.returnCode(process='Bowtie2 Build', log=LOG_FILE), shell=True)
-        end_time = time.time()
-        utils.touch(output)
-        
-        ## Add process and output file to output (just use the first sample in the sample list)
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=SAMID[0])
-        procid = sqlite.addProcess(db=LOG_DB, samid=sqlite.getSamid(db=LOG_DB, sample_name=SAMID[0]), cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=SAMID[0], file_type='build_bowtie_index', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Reuse a cached index if available
+        import refcache
+        with refcache.Bundle(REFCACHE_DIR, 'bowtie2', inputs=[INDEXSEQ], files=['index/bowtie2_genome_index.*'], versions=[BOWTIE2BUILD+' --version'], params='bowtie2-build -f', cache_db=LOG_DB, max_gb=REFCACHE_GB) as bundle:
+            start_time = time.time()
+            if bundle.fetch():
+                utils.touch(output)
+                sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=SAMID[0], cmd='refcache '+bundle.path, start_time=start_time, end_time=time.time(), return_code=0)
+            else:
+                ## Run command
+                cmd = '%s -f %s index/bowtie2_genome_index --threads %s' % (BOWTIE2BUILD, INDEXSEQ, threads)
+                bench_obj = utils.logging_call(cmd+utils.returnCode(process='Bowtie2 Build', log=LOG_FILE), shell=True)
+                end_time = time.time()
+                bundle.store()
+                utils.touch(output)
+                
+                ## Add process, output file(s) and benchmark to the log database
+                sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=SAMID[0], cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='build_bowtie_index', hash=HASH)
 
 
 ## Index reference genome with faidx (only necessary if CRAM compression is enabled)
@@ -264,18 +403,23 @@ rule faidx:
         benchmark='benchmark/faidx.tab.info'
     threads: 1
     run:
-        ## Run command
-        cmd = '%s faidx %s' % (SAMTOOLS, INDEXSEQ)
-        start_time = time.time()
-        bench_obj = utils.logging_call(cmd+utils.returnCode(process='Bowtie2 Build', log=LOG_FILE), shell=True)
-        end_time = time.time()
-        utils.touch(output)
-        
-        ## Add process and output file to output (just use the first sample in the sample list)
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=SAMID[0])
-        procid = sqlite.addProcess(db=LOG_DB, samid=sqlite.getSamid(db=LOG_DB, sample_name=SAMID[0]), cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=SAMID[0], file_type='faidx', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Reuse a cached index if available
+        import refcache
+        with refcache.Bundle(REFCACHE_DIR, 'faidx', inputs=[INDEXSEQ], files=[INDEXSEQ+'.fai'], versions=[SAMTOOLS+' --version'], params='samtools faidx', cache_db=LOG_DB, max_gb=REFCACHE_GB) as bundle:
+            start_time = time.time()
+            if bundle.fetch():
+                utils.touch(output)
+                sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=SAMID[0], cmd='refcache '+bundle.path, start_time=start_time, end_time=time.time(), return_code=0)
+            else:
+                ## Run command
+                cmd = '%s faidx %s' % (SAMTOOLS, INDEXSEQ)
+                bench_obj = utils.logging_call(cmd+utils.returnCode(process='Bowtie2 Build', log=LOG_FILE), shell=True)
+                end_time = time.time()
+                bundle.store()
+                utils.touch(output)
+                
+                ## Add process, output file(s) and benchmark to the log database
+                sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=SAMID[0], cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='faidx', hash=HASH)
     
     
     
@@ -283,33 +427,31 @@ rule faidx:
 rule getfile:
     input:
         rules.directory_setup.output,
-        rules.build_hisat_index.output
+        rules.build_hisat_index.output,
+        admit=lambda wildcards: ['progress/%s_scratch.released' % ADMIT_AFTER[wildcards.sample]] if wildcards.sample in ADMIT_AFTER else []
     output:
         temp(expand('input/{{sample}}_{pe}.fastq.gz',  pe=ENDS))
     params:
         sample='{sample}'
     priority: 1
-    threads: max(1,min(8,NCORES))
+    threads: PLANNER.threads('getfile', default=min(8,NCORES))
+    resources:
+        mem_mb=PLANNER.mem('getfile', default=1000),
+        disk_mb=SCRATCH.disk('getfile')
     run:
-        ## Get files to pull
-        if ENDS == ['1']:
-            in_file = [FASTQ_1[i[0]] for i in enumerate(SAMID) if SAMID[i[0]] == params.sample]
-        else:
-            in_file_1 = [FASTQ_1[i[0]] for i in enumerate(SAMID) if SAMID[i[0]] == params.sample][0]
-            in_file_2 = [FASTQ_2[i[0]] for i in enumerate(SAMID) if SAMID[i[0]] == params.sample][0]
-            in_file = [in_file_1, in_file_2] 
+        import getfile
         
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
+        ## Get files to pull
+        in_file = MANIFEST.inputs(params.sample)
         
         ## Run command
         for f in range(len(in_file)):
             start_time = time.time()
-            return_code = getfile.getFile(in_file=in_file[f], out_file=utils.toList(output)[f], aws_prog=AWS, fastq_dump_prog=FASTQDUMP, openssl_prog=OPENSSL, pw=DECRYPT_PASS, hash=HASH)
+            return_code = getfile.getFile(in_file=in_file[f], out_file=utils.toList(output)[f], aws_prog=AWS, fastq_dump_prog=FASTQDUMP, openssl_prog=OPENSSL, pw=DECRYPT_PASS, hash=HASH, cache_db=LOG_DB, stream=STREAM_INPUT, prefetch_prog=PREFETCH, threads=threads)
             end_time = time.time()
             
             ## Add process and output file to output
-            procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd='getfile.getFile()', return_code=return_code, start_time=start_time, end_time=end_time)
-            sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output)[f], sample_name=params.sample, file_type='getfile', hash=HASH)
+            sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd='getfile.getFile()', start_time=start_time, end_time=end_time, return_code=return_code, file=utils.toList(output)[f], file_type='getfile', hash=HASH)
             
 
 
@@ -322,24 +464,25 @@ rule trimadapters:
     params:
         sample='{sample}',
         benchmark='benchmark/{sample}_trim_adapters.tab.info'
-    threads: max(1,min(8,NCORES))
+    threads: PLANNER.threads('trimadapters', default=min(8,NCORES))
+    resources:
+        mem_mb=PLANNER.mem('trimadapters', default=1000),
+        disk_mb=SCRATCH.disk('trimadapters')
     priority: 2
     benchmark:
         'benchmark/{sample}_trim_adapters.tab'
     run: 
+        import trimadapters
         if TRIM_FP or TRIM_TP:
-            adapters = trimadapters.getAdapters(sam=params.sample, fp_adapters=FP_ADAPTERS, tp_adapters=TP_ADAPTERS, samid_all=SAMID)
+            adapters = MANIFEST.adapters(params.sample)
             
             ## Run command
             start_time = time.time()
             bench_obj = trimadapters.trimAdapters(infile=input.fa, outfile=output, adapt5=adapters['fp'], adapt3=adapters['tp'], cutadapt=CUTADAPT, threads=threads)
             end_time = time.time()
             
-            ## Add process and output file to output
-            samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-            procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd='trimadapters.trimAdapters()', return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-            sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='trimadapters', hash=HASH)
-            sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+            ## Add process, output file(s) and benchmark to the log database
+            sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd='trimadapters.trimAdapters()', start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='trimadapters', hash=HASH)
         else:
             utils.touch(output)
     
@@ -354,7 +497,10 @@ rule qualityfilter:
     params:
         sample='{sample}',
         benchmark='benchmark/{sample}_quality_filter.tab.info'
-    threads: max(1,min(8,NCORES))
+    threads: PLANNER.threads('qualityfilter', default=min(8,NCORES))
+    resources:
+        mem_mb=PLANNER.mem('qualityfilter', default=2000),
+        disk_mb=SCRATCH.disk('qualityfilter')
     priority: 4
     benchmark:
         'benchmark/{sample}_quality_filter.tab'
@@ -375,11 +521,41 @@ rule qualityfilter:
         bench_obj = utils.logging_call(cmd+utils.returnCode(sample='{params.sample}',process='Trimmomatic', log=LOG_FILE, outfile=utils.toList(output)[0]), shell=True)
         end_time = time.time()
         
-        ## Add process and output file to output
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='qualityfilter', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='qualityfilter', hash=HASH)
+
+
+
+## Adapter and quality trimming in one pass, writes the outputs of qualityfilter
+if FUSE_TRIM and (TRIM_FP or TRIM_TP):
+    rule trim_qualityfilter:
+        input:
+            fa=expand('input/{{sample}}_{pe}.fastq.gz',  pe=ENDS)
+        output:
+            temp(expand('rqual_filter/{{sample}}_{pe}{paired}_qual.fastq.gz', pe=ENDS, paired=['P','U'])) if len(ENDS)==2 else temp(expand('rqual_filter/{{sample}}_{pe}_qual.fastq.gz', pe=ENDS))
+        params:
+            sample='{sample}',
+            benchmark='benchmark/{sample}_trim_qualityfilter.tab.info'
+        threads: PLANNER.threads('trim_qualityfilter', default=min(8,NCORES))
+        resources:
+            mem_mb=PLANNER.mem('trim_qualityfilter', default=1000),
+            disk_mb=SCRATCH.disk('trim_qualityfilter')
+        priority: 4
+        benchmark:
+            'benchmark/{sample}_trim_qualityfilter.tab'
+        run:
+            import trimadapters
+            adapters = MANIFEST.adapters(params.sample)
+            
+            ## Run command
+            start_time = time.time()
+            bench_obj = trimadapters.trimAdaptersQuality(infile=input.fa, outfile=utils.toList(output), adapt5=adapters['fp'], adapt3=adapters['tp'], cutadapt=CUTADAPT, threads=threads, quality=int(QUAL_CUTOFF))
+            end_time = time.time()
+            
+            ## Add process, output file(s) and benchmark to the log database
+            sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd='trimadapters.trimAdaptersQuality()', start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='qualityfilter', hash=HASH)
+    
+    ruleorder: trim_qualityfilter > qualityfilter
 
 
 
@@ -392,28 +568,17 @@ rule run_hisat:
         **utils.hisatOutput(ends=ENDS, iontorrent=IONTORRENT)
     benchmark:
         'benchmark/{sample}_run_hisat.tab'
-    threads: max(1,min(8,NCORES))
+    threads: PLANNER.threads('run_hisat', default=min(8,NCORES))
+    resources:
+        mem_mb=PLANNER.mem('run_hisat', default=8000),
+        disk_mb=SCRATCH.disk('run_hisat')
     priority: 5
     params:
         sample='{sample}',
         benchmark='benchmark/{sample}_run_hisat.tab.info'
     run:
         ## Construct input based on read ended-ness
-        if (len(ENDS) == 1):
-            in_fa_str = "-U "+input.fa[0]
-            
-            if (IONTORRENT):
-                unmapped_str = "--un-gz tmp/"+params.sample+"_iontorrent_1.fastq.gz"
-            else:
-                unmapped_str = ''
-            
-        elif (len(ENDS) == 2):
-            in_fa_str = '-1 '+input.fa[0]+' -2 '+input.fa[2]
-            
-            if (IONTORRENT):
-                unmapped_str = "--un-conc-gz tmp/"+params.sample+"_iontorrent_%.fastq.gz"
-            else:
-                unmapped_str = ''
+        in_fa_str, unmapped_str = utils.hisatArgs(fa=input.fa, ends=ENDS, sample=params.sample, iontorrent=IONTORRENT)
         
         ## Run command
         cmd = '%s -p %s -x index/hisat2_genome_index %s %s --known-splicesite-infile annot/splicesites.txt -S %s' % (HISAT2, threads, in_fa_str, unmapped_str, output.aln)
@@ -421,11 +586,8 @@ rule run_hisat:
         bench_obj = utils.logging_call(cmd+utils.returnCode(process='HISAT2 Align', sample='{params.sample}', log=LOG_FILE), shell=True)
         end_time = time.time()
         
-        ## Add process and output file to output
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='hisat2 sam', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)        
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='hisat2 sam', hash=HASH)
 
 rule run_bowtie:
     input:
@@ -435,7 +597,9 @@ rule run_bowtie:
         temp('tmp/{sample}_iontorrent.bam')
     benchmark:
         'benchmark/{sample}_run_bowtie.tab'
-    threads: max(1,min(8,NCORES))
+    threads: PLANNER.threads('run_bowtie', default=min(8,NCORES))
+    resources:
+        mem_mb=PLANNER.mem('run_bowtie', default=4000)
     params:
         sample='{sample}',
         benchmark='benchmark/{sample}_run_bowtie.tab.info'
@@ -452,11 +616,8 @@ rule run_bowtie:
         bench_obj = utils.logging_call(cmd+utils.returnCode(process='Bowtie2 Remapping', sample='{params.sample}', log=LOG_FILE), shell=True)
         end_time = time.time()
         
-        ## Add process and output file to output 
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='sorted bam', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)        
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='sorted bam', hash=HASH)
 
 
 
@@ -469,7 +630,10 @@ rule sam_to_bam:
     benchmark:
         'benchmark/{sample}_sam_to_bam.tab'
     priority: 5
-    threads: max(1,min(8,NCORES))
+    threads: PLANNER.threads('sam_to_bam', default=min(8,NCORES))
+    resources:
+        mem_mb=PLANNER.mem('sam_to_bam', default=1000),
+        disk_mb=SCRATCH.disk('sam_to_bam')
     params:
         sample='{sample}',
         benchmark='benchmark/{sample}_sam_to_bam.tab.info'
@@ -480,11 +644,8 @@ rule sam_to_bam:
         bench_obj = utils.logging_call(cmd+utils.returnCode(process='SAM to BAM', sample='{params.sample}', log=LOG_FILE, outfile=utils.toList(output)[0]), shell=True)
         end_time = time.time()
         
-        ## Add process and output file to output 
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='HISAT2 mapped and unmapped reads BAM file', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='HISAT2 mapped and unmapped reads BAM file', hash=HASH)
         
 
 
@@ -497,22 +658,67 @@ rule sort_bam:
     benchmark:
         'benchmark/{sample}_sort_bam.tab'
     priority: 5
-    threads: max(1,min(8,NCORES))
+    threads: PLANNER.threads('sort_bam', default=min(8,NCORES))
+    resources:
+        mem_mb=PLANNER.mem('sort_bam', default=4000),
+        disk_mb=SCRATCH.disk('sort_bam')
     params:
         sample='{sample}',
         benchmark='benchmark/{sample}_sort_bam.tab.info'
     run:
         ## Run command
-        cmd = '%s sort -@ %s %s > %s' % (SAMTOOLS, threads, input.bam, output)
+        cmd = '%s sort -@ %s -T tmp/%s %s > %s' % (SAMTOOLS, threads, params.sample, input.bam, output)
         start_time = time.time()
         bench_obj = utils.logging_call(cmd+utils.returnCode(process='Sort & Index BAM', sample='{params.sample}', log=LOG_FILE, outfile=utils.toList(output)[0]), shell=True)
         end_time = time.time()
         
-        ## Add process and output file to output 
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='sorted bam', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='sorted bam', hash=HASH)
+        
+
+## Fused alternative to run_hisat -> sam_to_bam -> sort_bam: stream HISAT2 output straight into 
+## BAM encoding and coordinate sorting without writing the SAM/unsorted BAM intermediates
+if FUSE_ALIGN:
+    ruleorder: align_sort_bam > sort_bam
+    ruleorder: align_sort_bam > run_hisat
+    
+    rule align_sort_bam:
+        input:
+            tch=rules.build_hisat_index.output,
+            fa=rules.qualityfilter.output
+        output:
+            **utils.fusedAlignOutput(ends=ENDS, iontorrent=IONTORRENT, cram=CRAM, temp=REMOVEINTFILES)
+        benchmark:
+            'benchmark/{sample}_align_sort_bam.tab'
+        threads: max(2,PLANNER.threads('align_sort_bam', default=min(8,NCORES)))
+        resources:
+            mem_mb=PLANNER.mem('align_sort_bam', default=12000),
+            disk_mb=SCRATCH.disk('align_sort_bam')
+        priority: 5
+        params:
+            sample='{sample}',
+            benchmark='benchmark/{sample}_align_sort_bam.tab.info'
+        run:
+            ## Split threads between the aligner and the sorter (with a single thread both get one)
+            sort_threads = max(1, min(threads - 1, SORT_THREADS if SORT_THREADS > 0 else threads // 4))
+            hisat_threads = max(1, threads - sort_threads)
+            in_fa_str, unmapped_str = utils.hisatArgs(fa=input.fa, ends=ENDS, sample=params.sample, iontorrent=IONTORRENT)
+            
+            ## Build pipe: align -> uncompressed BAM -> sort
+            hisat_cmd = '%s -p %s -x index/hisat2_genome_index %s %s --known-splicesite-infile annot/splicesites.txt' % (HISAT2, hisat_threads, in_fa_str, unmapped_str)
+            view_cmd = '%s view -u -b -' % (SAMTOOLS)
+            sort_cmd = '%s sort -@ %s -m %s -T tmp/%s -o %s -' % (SAMTOOLS, sort_threads, SORT_MEM, params.sample, output.bam)
+            cmd = 'set -o pipefail; %s | %s | %s' % (hisat_cmd, view_cmd, sort_cmd)
+            
+            ## Run command
+            start_time = time.time()
+            bench_obj = utils.logging_call(cmd+utils.returnCode(process='HISAT2 Align & Sort BAM', sample='{params.sample}', log=LOG_FILE, outfile=output.bam), shell=True, executable='/bin/bash')
+            end_time = time.time()
+            
+            ## Add one process, output file(s) and benchmark per stage to the log database
+            sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=hisat_cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj.stage('hisat2'), file=[x for x in utils.toList(output) if x != output.bam], file_type='hisat2 unaligned reads', hash=HASH)
+            sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=view_cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj.stage('samtools view'))
+            sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=sort_cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj.stage('samtools sort'), file=output.bam, file_type='sorted bam', hash=HASH)
         
 
 ## Merge sorted alignments if we re-mapped with bowtie
@@ -535,11 +741,22 @@ rule merge_bam:
         bench_obj = utils.logging_call(cmd+utils.returnCode(process='Merge BAM', sample='{params.sample}', log=LOG_FILE, outfile=utils.toList(output)[0]), shell=True)
         end_time = time.time()
         
-        ## Add process and output file to output 
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='merged sorted bam', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='merged sorted bam', hash=HASH)
+        
+
+
+## Mark a sample's large intermediates as cleared (its sorted BAM exists), which admits the next sample
+## held back by the disk budget (see DISK_MB)
+rule scratch_release:
+    input:
+        'bam/{sample}.bam'
+    output:
+        'progress/{sample}_scratch.released'
+    threads: 1
+    priority: 5
+    run:
+        utils.touch(output)
         
         
 ## Index BAM
@@ -551,7 +768,9 @@ rule index_bam:
     benchmark:
         'benchmark/{sample}_index_bam.tab'
     priority: 5
-    threads: max(1,min(8,NCORES))
+    threads: PLANNER.threads('index_bam', default=min(8,NCORES))
+    resources:
+        mem_mb=PLANNER.mem('index_bam', default=1000)
     params:
         sample='{sample}',
         benchmark='benchmark/{sample}_index_bam.tab.info'
@@ -562,11 +781,8 @@ rule index_bam:
         bench_obj = utils.logging_call(cmd+utils.returnCode(process='Index BAM', sample='{params.sample}', log=LOG_FILE, outfile=utils.toList(output)[0]), shell=True)
         end_time = time.time()
         
-        ## Add process and output file to output 
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='index bam', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='index bam', hash=HASH)
 
 
 ## Convert bam to cram
@@ -579,7 +795,9 @@ rule bam_to_cram:
         prog=touch('progress/{sample}_cram.done')
     benchmark: 
         'benchmark/{sample}_bam_to_cram.tab'
-    threads: max(1,min(8,NCORES))
+    threads: PLANNER.threads('bam_to_cram', default=min(8,NCORES))
+    resources:
+        mem_mb=PLANNER.mem('bam_to_cram', default=2000)
     priority: 5
     params:
         sample='{sample}',
@@ -591,16 +809,13 @@ rule bam_to_cram:
         bench_obj = utils.logging_call(cmd+utils.returnCode(process='CRAM Compression', sample='{params.sample}', log=LOG_FILE, outfile=utils.toList(output.cram)[0]), shell=True)
         end_time = time.time()
         
-        ## Add process and output file to output 
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output.cram), sample_name=params.sample, file_type='cram', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output.cram), file_type='cram', hash=HASH)
         
-        ## Encrypt and/or upload if necessary
-        if DOENCRYPT: output.cram = utils.encryptFile(file=utils.toList(output.cram), openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH)
-        if DOARCHIVE: putfile.upload(file=utils.toList(output.cram), destination=ARCHIVE, cloud='aws', prog=AWS)
-        if DOARCHIVE: putfile.upload(file=utils.toList(INDEXSEQ), destination=ARCHIVE, cloud='aws', prog=AWS, rm=False)    
+        ## Encrypt and/or upload if necessary (uploads run in the background so the job slot is released right away;
+        ## encrypted CRAMs are streamed through openssl to S3 without a local .enc copy)
+        putfile.archive(file=utils.toList(output.cram), destination=ARCHIVE, cloud='aws', prog=AWS, encrypt=DOENCRYPT, openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH, db=LOG_DB, background=True)
+        if DOARCHIVE: putfile.upload(file=utils.toList(INDEXSEQ), destination=ARCHIVE, cloud='aws', prog=AWS, rm=False, background=True)
 
 ## Run FASTQC
 rule fastqc: 
@@ -622,24 +837,61 @@ rule fastqc:
         fq_html = fq_base + '.html'
         
         ## Run command
-        cmd = '%s %s -q -o fastqc' % (FASTQC, input)
+        cmd = '%s %s -t %s -q -o fastqc' % (FASTQC, input, threads)
         start_time = time.time()
         bench_obj = utils.logging_call(cmd+utils.returnCode(sample='{params.sample}',process='FastQC', log=LOG_FILE),shell=True)
         end_time = time.time()
         
-        ## Add process metadata to DB
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Repack the zipped results as a tarball (streamed, nothing is extracted), remove the zip and HTML duplicate
+        utils.zipToTarGz(fq_zip, utils.toList(output)[0], fq_base, hash=HASH, cache_db=LOG_DB)
+        [os.remove(x) for x in [fq_zip, fq_html]]
         
-        ## unzip, remove zipped results, HTML duplicate, and tarball results
-        cmd = 'unzip %s -d %s && tar -zvcf %s %s && rm -r %s %s %s' % (fq_zip, fq_base, output, fq_base, fq_zip, fq_html, fq_base)
-        utils.logging_call(cmd, shell=True)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='FastQC', hash=HASH)
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='FastQC', hash=HASH)
         
         ## Encrypt and/or upload if necessary
-        if DOENCRYPT: output = utils.encryptFile(file=utils.toList(output), openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH)
-        if DOARCHIVE: putfile.upload(file=utils.toList(output), destination=ARCHIVE, cloud='aws', prog=AWS)
+        putfile.archive(file=utils.toList(output), destination=ARCHIVE, cloud='aws', prog=AWS, encrypt=DOENCRYPT, openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH, db=LOG_DB)
+
+
+
+## Single-pass BAM QC: mapping statistics, GC content, junctions and read distribution in one pass
+## over the BAM, split by region across threads (takes over the outputs of the four RSeQC rules below)
+if BAMQC:
+    rule bamqc:
+        input:
+            bam='bam/{sample}.bam',
+            idx=rules.index_bam.output
+        output:
+            qc=['rseqc/{sample}_bam_qc.txt', 'rseqc/{sample}_bam_gc.txt', 'rseqc/{sample}_bam_jc.txt'] + (['rseqc/{sample}_bam_rc.txt'] if RUN_READ_DIST == 1 else []),
+            gc=temp('rseqc/{sample}.GC.xls') if REMOVEINTFILES else 'rseqc/{sample}.GC.xls'
+        benchmark:
+            'benchmark/{sample}_bamqc.tab'
+        threads: PLANNER.threads('bamqc', default=min(4,NCORES))
+        resources:
+            mem_mb=PLANNER.mem('bamqc', default=1000)
+        priority: 5
+        params:
+            sample='{sample}',
+            benchmark='benchmark/{sample}_bamqc.tab.info'
+        run:
+            ## Run command
+            cmd = '%s %s/python/bamqc.py -i %s -r %s -o rseqc/%s -s %s -t %s' % (sys.executable, SOURCEDIR, input.bam, ANNOTATIONS_BED, params.sample, params.sample, threads)
+            if RUN_READ_DIST != 1:
+                cmd += ' --no-read-dist'
+            start_time = time.time()
+            bench_obj = utils.logging_call(cmd+utils.returnCode(process='BAM QC engine', sample='{params.sample}', log=LOG_FILE), shell=True)
+            end_time = time.time()
+            
+            ## Add process, output file(s) and benchmark to the log database
+            sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output.qc), file_type='rseqc bam qc', hash=HASH)
+            
+            ## Encrypt and/or upload if necessary (the intermediate GC histogram is a temporary output)
+            putfile.archive(file=utils.toList(output.qc), destination=ARCHIVE, cloud='aws', prog=AWS, encrypt=DOENCRYPT, openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH, db=LOG_DB)
+
+    ruleorder: bamqc > bam_qc
+    ruleorder: bamqc > bam_gc
+    ruleorder: bamqc > bam_jc
+    ruleorder: bamqc > read_distribution
 
 
 
@@ -664,15 +916,11 @@ rule bam_qc:
         bench_obj = utils.logging_call(cmd+utils.returnCode(process='BAM QC', sample='{params.sample}', log=LOG_FILE), shell=True)    
         end_time = time.time()
         
-        ## Add process and output file to output 
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='rseqc bam statistics', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='rseqc bam statistics', hash=HASH)
         
         ## Encrypt and/or upload if necessary
-        if DOENCRYPT: output = utils.encryptFile(file=utils.toList(output), openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH)
-        if DOARCHIVE: putfile.upload(file=utils.toList(output), destination=ARCHIVE, cloud='aws', prog=AWS)        
+        putfile.archive(file=utils.toList(output), destination=ARCHIVE, cloud='aws', prog=AWS, encrypt=DOENCRYPT, openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH, db=LOG_DB)
     
             
             
@@ -703,20 +951,15 @@ rule bam_gc:
         utils.logging_call(cmd, shell=True)
         utils.logging_call('Rscript --vanilla --quiet '+output.r+utils.returnCode(process='BAM GC Rscript', sample='{params.sample}', log=LOG_FILE), shell=True)
         
-        ## Add process and output file to output 
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='rseqc bam gc%', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='rseqc bam gc%', hash=HASH)
         
         ## Encrypt and/or upload if necessary
-        if DOENCRYPT: output = utils.encryptFile(file=utils.toList(output), openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH)
-        if DOARCHIVE: putfile.upload(file=utils.toList(output), destination=ARCHIVE, cloud='aws', prog=AWS)
+        putfile.archive(file=utils.toList(output), destination=ARCHIVE, cloud='aws', prog=AWS, encrypt=DOENCRYPT, openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH, db=LOG_DB)
         
         ## Remove intermediate read_GC files after s3 upload
         if REMOVEINTFILES:
-            cmd = 'rm rseqc/%s.GC.xls rseqc/%s.GC_plot.pdf' % (params.sample, params.sample)
-            utils.logging_call(cmd, shell=True)
+            [os.remove(x) for x in ['rseqc/%s.GC.xls' % (params.sample), 'rseqc/%s.GC_plot.pdf' % (params.sample)] if os.path.exists(x)]
 
 ## Run RSEQC junction_annotation.py 
 rule bam_jc:
@@ -739,15 +982,11 @@ rule bam_jc:
         bench_obj = utils.logging_call(cmd+utils.returnCode(process='BAM JC', sample='{params.sample}', log=LOG_FILE),shell=True)    
         end_time = time.time()
         
-        ## Add process and output file to output 
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='rseqc bam junctions', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='rseqc bam junctions', hash=HASH)
         
         ## Encrypt and/or upload if necessary
-        if DOENCRYPT: output = utils.encryptFile(file=utils.toList(output), openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH)
-        if DOARCHIVE: putfile.upload(file=utils.toList(output), destination=ARCHIVE, cloud='aws', prog=AWS)
+        putfile.archive(file=utils.toList(output), destination=ARCHIVE, cloud='aws', prog=AWS, encrypt=DOENCRYPT, openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH, db=LOG_DB)
 
 ## Run RSEQC junction_annotation.py 
 rule read_distribution:
@@ -770,16 +1009,75 @@ rule read_distribution:
         bench_obj = utils.logging_call(cmd+utils.returnCode(process='BAM Read Distribution', sample='{params.sample}', log=LOG_FILE),shell=True)    
         end_time = time.time()
         
-        ## Add process and output file to output 
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='reseqc bam read distribution', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='reseqc bam read distribution', hash=HASH)
         
         ## Encrypt and/or upload if necessary
-        if DOENCRYPT: output = utils.encryptFile(file=utils.toList(output), openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH)
-        if DOARCHIVE: putfile.upload(file=utils.toList(output), destination=ARCHIVE, cloud='aws', prog=AWS)
+        putfile.archive(file=utils.toList(output), destination=ARCHIVE, cloud='aws', prog=AWS, encrypt=DOENCRYPT, openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH, db=LOG_DB)
         
+## Run featureCounts over a batch of samples (the GTF is read once per batch)
+## Each sample is recorded with its share (by BAM size) of the run's time and I/O
+if COUNT_BATCH > 0:
+    rule feature_counts_batch:
+        input:
+            lambda wildcards: expand('bam/{sample}.bam', sample=COUNT_BATCHES[int(wildcards.batch)])
+        output:
+            counts=temp('feature_counts_batch/{batch}_count.tab') if REMOVEINTFILES else 'feature_counts_batch/{batch}_count.tab',
+            summary=temp('feature_counts_batch/{batch}_count.tab.summary') if REMOVEINTFILES else 'feature_counts_batch/{batch}_count.tab.summary'
+        benchmark:
+            'benchmark/batch{batch}_feature_counts.tab'
+        threads: PLANNER.threads('feature_counts_batch', default=min(8,NCORES))
+        resources:
+            mem_mb=PLANNER.mem('feature_counts_batch', default=2000)
+        priority: 5
+        params:
+            batch='{batch}',
+            benchmark='benchmark/batch{batch}_feature_counts.tab.info'
+        run:
+            ## Run command - if paired add args
+            samples = COUNT_BATCHES[int(params.batch)]
+            if len(ENDS)>1:
+                cmd = '%s -B -p -C -T %s -s %s -a %s -o %s %s' % (FEATURECOUNTS, threads, STRANDED, ANNOTATIONS_GTF, output.counts, ' '.join(input))
+            else:
+                cmd = '%s -T %s -s %s -a %s -o %s %s' % (FEATURECOUNTS, threads, STRANDED, ANNOTATIONS_GTF, output.counts, ' '.join(input))
+            
+            start_time = time.time()
+            bench_obj = utils.logging_call(cmd+utils.returnCode(process='FeatureCounts', sample='batch '+params.batch, log=LOG_FILE),shell=True)
+            end_time = time.time()
+            
+            ## Add a process and benchmark per sample to the log database
+            sizes = [os.path.getsize(x) for x in input]
+            for i, sample in enumerate(samples):
+                sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj.share(sizes[i] / max(1, sum(sizes)), series=(i == 0)), hash=HASH)
+    
+    ## Per-sample featureCounts results from a batch
+    rule feature_counts_split:
+        input:
+            counts=lambda wildcards: 'feature_counts_batch/%s_count.tab' % (COUNT_BATCH_OF[wildcards.sample]),
+            summary=lambda wildcards: 'feature_counts_batch/%s_count.tab.summary' % (COUNT_BATCH_OF[wildcards.sample])
+        output:
+            counts='feature_counts/{sample}_count.tab',
+            summary='feature_counts/{sample}_count.tab.summary'
+        priority: 5
+        params:
+            sample='{sample}'
+        run:
+            import countmatrix
+            cmd = 'split %s' % (input.counts)
+            start_time = time.time()
+            countmatrix.splitBatch(input.counts, 'bam/%s.bam' % (params.sample), output.counts)
+            end_time = time.time()
+            
+            ## Add process and output file(s) to the log database
+            sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, file=[output.counts], file_type='feature counts', hash=HASH)
+            
+            ## Encrypt and/or upload if necessary
+            putfile.archive(file=[output.counts], destination=ARCHIVE, cloud='aws', prog=AWS, encrypt=DOENCRYPT, openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH, db=LOG_DB)
+    
+    ruleorder: feature_counts_split > feature_counts
+
+
+
 ## Run featureCounts
 rule feature_counts:
     input:
@@ -788,7 +1086,9 @@ rule feature_counts:
         'feature_counts/{sample}_count.tab'
     benchmark:
         'benchmark/{sample}_feature_counts.tab'
-    threads: max(1,min(8,NCORES))
+    threads: PLANNER.threads('feature_counts', default=min(8,NCORES))
+    resources:
+        mem_mb=PLANNER.mem('feature_counts', default=2000)
     priority: 5
     params:
         sample='{sample}',
@@ -804,13 +1104,9 @@ rule feature_counts:
         bench_obj = utils.logging_call(cmd+utils.returnCode(process='FeatureCounts', sample='{params.sample}', log=LOG_FILE),shell=True)
         end_time = time.time()
         
-        ## Add process and output file to output 
-        samid = sqlite.getSamid(db=LOG_DB, sample_name=params.sample)
-        procid = sqlite.addProcess(db=LOG_DB, samid=samid, cmd=cmd, return_code=bench_obj.return_code, start_time=start_time, end_time=end_time)
-        sqlite.addFile(db=LOG_DB, samid=samid, procid=procid, file=utils.toList(output), sample_name=params.sample, file_type='feature counts', hash=HASH)
-        sqlite.addBenchmark(db=LOG_DB, procid=procid, samid=samid, bench_obj=bench_obj)
+        ## Add process, output file(s) and benchmark to the log database
+        sqlite.recordProcess(db=LOG_DB, rule=rule, threads=threads, input=input, sample_name=params.sample, cmd=cmd, start_time=start_time, end_time=end_time, bench_obj=bench_obj, file=utils.toList(output), file_type='feature counts', hash=HASH)
         
         ## Encrypt and/or upload if necessary
-        if DOENCRYPT: output = utils.encryptFile(file=utils.toList(output), openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH)
-        if DOARCHIVE: putfile.upload(file=utils.toList(output), destination=ARCHIVE, cloud='aws', prog=AWS)
+        putfile.archive(file=utils.toList(output), destination=ARCHIVE, cloud='aws', prog=AWS, encrypt=DOENCRYPT, openssl=OPENSSL, password=ENCRYPT_PASS, hash=HASH, db=LOG_DB)
         
@@ -0,0 +1,29 @@
+#############################################################################################################
+# RSEQREP test configuration: helper modules are imported the way the workflow imports them (flat, from
+# source/python); stand-in programs are written as small shell/Python scripts into a temporary directory
+#############################################################################################################
+
+import os
+import sys
+import stat
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRCDIR = os.path.join(ROOT, 'source')
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+sys.path.insert(0, os.path.join(SRCDIR, 'python'))
+
+
+
+## Write an executable stand-in script
+def writeScript(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return(str(path))
+
+
+
+@pytest.fixture
+def script():
+    return(writeScript)
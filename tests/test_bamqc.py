@@ -0,0 +1,130 @@
+## Single-pass BAM QC engine on a small BAM/BED12 fixture (skipped without pysam and RSeQC's qcmodule): the
+## counts of bam_stat, junction_annotation and read_distribution (reads in several regions; read_distribution
+## precedence CDS > UTR > intron > flanks), the GC summary (R's summary() of the read_GC histogram), the same
+## results with the genome split into more regions (reads spanning a split are counted once), and the same
+## results as the RSeQC scripts where those are installed
+
+import os
+import shutil
+import subprocess
+import pytest
+import rseqcparse
+
+pysam = pytest.importorskip('pysam')
+pytest.importorskip('qcmodule')
+import bamqc
+
+## One gene on chr1: 5'UTR 10000-10500, CDS 10500-11000/12000-12500/13000-13500, 3'UTR 13500-14000
+BED = 'chr1\t10000\t14000\tGENEA\t0\t+\t10500\t13500\t0\t3\t1000,500,1000,\t0,2000,3000,\n'
+
+## (flag, 0-based start, mapping quality, CIGAR): where each read should be counted
+READS = [(0, 10600, 60, '50M'),                 # CDS
+         (0, 10200, 60, '50M'),                 # 5'UTR
+         (16, 13700, 60, '50M'),                # 3'UTR, minus strand
+         (0, 11400, 60, '50M'),                 # intron
+         (0, 9500, 60, '50M'),                  # TSS_up_1kb
+         (0, 16000, 60, '50M'),                 # TES_down_5kb
+         (0, 10975, 60, '25M1000N25M'),         # CDS + CDS, known junction
+         (0, 10700, 10, '50M'),                 # non-unique (still in the read distribution)
+         (1024, 10800, 60, '50M'),              # duplicate
+         (256, 10900, 60, '50M'),               # secondary
+         (4, 10600, 0, '*'),                    # unmapped, placed
+         (512, 10650, 60, '50M'),               # QC failed
+         (0, 12480, 60, '50M'),                 # spans the CDS/intron border, midpoint in the intron
+         (0, 9360, 60, '50M'),                  # TSS_up_1kb
+         (0, 13100, 60, '20M30N30M')]           # CDS + CDS, junction shorter than MIN_INTRON (filtered)
+
+
+
+@pytest.fixture
+def fixture(tmp_path):
+    bed = str(tmp_path / 'genes.bed')
+    with open(bed, 'w') as f:
+        f.write(BED)
+    sam, bam = str(tmp_path / 'S1.sam'), str(tmp_path / 'S1.bam')
+    with open(sam, 'w') as f:
+        f.write('@HD\tVN:1.6\n@SQ\tSN:chr1\tLN:50000\n')
+        for i, (flag, start, mapq, cigar) in enumerate(READS):
+            g = (i * 7) % 51
+            f.write('\t'.join(['r%s' % (i), str(flag), 'chr1', str(start + 1), str(mapq), cigar, '*', '0', '0', 'G' * g + 'A' * (50 - g), 'I' * 50]) + '\n')
+    pysam.sort('-o', bam, sam)
+    pysam.index(bam)
+    return(bam, bed)
+
+
+
+def parsed(prefix):
+    qc = rseqcparse.parseQc(prefix + '_bam_qc.txt')[1][0].split('\t')[1:]
+    keys, values = rseqcparse.parseJc(prefix + '_bam_jc.txt')
+    rc = dict(zip(rseqcparse.HEADERS['rc'], rseqcparse.parseRc(prefix + '_bam_rc.txt')[1][0].split('\t')))
+    return(qc, dict(zip(keys.split('\t'), values[0].split('\t'))), rc)
+
+
+
+def histogram(xls_file):
+    with open(xls_file) as f:
+        return(dict([(x.split('\t')[0], int(x.split('\t')[1])) for x in f.read().splitlines()[1:]]))
+
+
+
+## R's summary(): min, quartiles (quantile type 7), mean, max of the expanded histogram
+def rSummary(hist):
+    x = sorted([float(k) for k, n in hist.items() for i in range(n)])
+    def quantile(p):
+        h = (len(x) - 1) * p
+        return(x[int(h)] + (h - int(h)) * (x[min(int(h) + 1, len(x) - 1)] - x[int(h)]))
+    return([quantile(0), quantile(0.25), quantile(0.5), sum(x) / len(x), quantile(0.75), quantile(1)])
+
+
+
+def test_bamqc_counts(tmp_path, fixture):
+    bam, bed = fixture
+    prefix = str(tmp_path / 'S1')
+    bamqc.run(bam, bed, prefix, sample='S1', threads=1)
+    qc, jc, rc = parsed(prefix)
+
+    ## total, qc_failed, duplicates, non_primary, unmapped, non_unique, unique, read_1, read_2, +, -, non_spliced, spliced, proper pairs x2
+    assert qc == ['15', '1', '1', '1', '1', '1', '10', '0', '0', '9', '1', '8', '2', '0', '0']
+    assert [jc[x] for x in ['total_splicing_events', 'known_splicing_events', 'novel_splicing_events', 'filtered_splicing_events']] == ['2', '1', '0', '1']
+    assert [rc[x] for x in ['total_reads', 'total_tags', 'total_assigned_tags', 'cds_exons_tags', 'fp_utr_exons_tags', 'tp_utr_exons_tags',
+                            'intron_tags', 'intergenic_up_tags', 'intergenic_down_tags']] == ['11', '13', '13', '6', '1', '1', '2', '2', '1']
+
+    ## GC of the reads with mapping quality >= 30 that passed QC (duplicates and secondary alignments included)
+    hist = histogram(prefix + '.GC.xls')
+    assert sum(hist.values()) == 12
+    with open(prefix + '_bam_gc.txt') as f:
+        row = f.read().strip().split('\t')
+    assert row[0] == 'S1' and [float(x) for x in row[1:]] == pytest.approx(rSummary(hist))
+
+    ## More regions (several reads span a split): the same results
+    split = str(tmp_path / 'split' / 'S1')
+    os.makedirs(os.path.dirname(split))
+    bamqc.run(bam, bed, split, sample='S1', threads=4)
+    assert parsed(split) == (qc, jc, rc)
+    assert histogram(split + '.GC.xls') == hist
+    assert open(split + '_bam_gc.txt').read() == open(prefix + '_bam_gc.txt').read()
+
+
+
+## The RSeQC scripts on the same fixture (only where they are installed)
+def test_bamqc_matches_rseqc(tmp_path, fixture):
+    if not all([shutil.which(x) for x in ['bam_stat.py', 'read_GC.py', 'junction_annotation.py', 'read_distribution.py']]):
+        pytest.skip('RSeQC scripts not installed')
+    bam, bed = fixture
+    os.makedirs(str(tmp_path / 'rseqc'))
+    ref = str(tmp_path / 'rseqc' / 'S1')
+    with open(ref + '_bam_qc.txt', 'w') as out:
+        subprocess.run(['bam_stat.py', '-i', bam], stdout=out, check=True)
+    with open(ref + '_bam_rc.txt', 'w') as out:
+        subprocess.run(['read_distribution.py', '-i', bam, '-r', bed], stdout=out, check=True)
+    with open(ref + '_bam_jc.txt', 'w') as out:
+        subprocess.run(['junction_annotation.py', '-i', bam, '-o', ref, '-r', bed], stderr=out)
+    subprocess.run(['read_GC.py', '-i', bam, '-o', ref])
+
+    prefix = str(tmp_path / 'S1')
+    bamqc.run(bam, bed, prefix, sample='S1', threads=2)
+    qc, jc, rc = parsed(prefix)
+    ref_qc, ref_jc, ref_rc = parsed(ref)
+    ## junction_annotation.py also logs its R plotting step to stderr: compare the counters only
+    assert (qc, jc, rc) == (ref_qc, dict([(x, ref_jc.get(x)) for x in jc]), ref_rc)
+    assert histogram(prefix + '.GC.xls') == histogram(ref + '.GC.xls')
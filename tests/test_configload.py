@@ -0,0 +1,49 @@
+## Configuration parser on the case study workbook against expected outputs in the layout of the R parser
+## (source/r/parse-configuration.r): preprocess_config.yaml (yaml::as.yaml) and sample_metadata.csv
+## (write.table, quote=F, na=''). The expected files were written from this parser's output and checked by
+## hand against the R code -- they were not produced by R, so parity with R is not verified by this test
+## The program and reference paths of the workbook are taken to exist; they are not on this machine
+
+import os
+import pytest
+import configload
+from conftest import ROOT, DATADIR
+
+GOLDEN = os.path.join(DATADIR, 'config-henn')
+
+
+
+def read(file):
+    with open(file, 'rb') as f:
+        return(f.read())
+
+
+
+def test_case_study_matches_r_parser(tmp_path, monkeypatch):
+    monkeypatch.setattr(configload.os.path, 'exists', lambda x: x != '')
+    monkeypatch.setattr(configload.os.path, 'isdir', lambda x: True)
+    res = configload.parseConfig(os.path.join(ROOT, 'case-study', 'config-henn.xlsx'))
+    monkeypatch.undo()
+    configload.writeYaml(res['workflow'], str(tmp_path / 'preprocess_config.yaml'))
+    configload.writePlainCsv(res['metadata'][0], res['metadata'][1], str(tmp_path / 'sample_metadata.csv'))
+    for x in ['preprocess_config.yaml', 'sample_metadata.csv']:
+        assert read(str(tmp_path / x)) == read(os.path.join(GOLDEN, x)), x
+    assert res['single_end']
+
+
+
+## The template has no samples (the R parser stops with the same message)
+def test_template_has_no_samples():
+    with pytest.raises(configload.ConfigError, match='No samples were found'):
+        configload.parseConfig(os.path.join(ROOT, 'config', 'config.xlsx'))
+
+
+
+## Colors as accepted by R's col2rgb
+def test_is_color():
+    valid = ['dodgerblue4', 'cadetblue3', 'white', 'grey0', 'gray100', 'lightgoldenrod', 'DodgerBlue', 'light goldenrod yellow',
+             '#52A3FF', '#ff303080', 'transparent', 'NA', '0', '12']
+    invalid = ['dodgerblue5', 'gray101', 'crimson', 'bluish', '#52A3F', '#52A3FF8', 'na', 'red-ish', '']
+    assert [x for x in valid if not configload.isColor(x)] == []
+    assert [x for x in invalid if configload.isColor(x)] == []
+    assert len(configload.R_COLORS) == 657
@@ -0,0 +1,81 @@
+## Per-sample featureCounts results split from a run over a batch of two BAMs: each has the layout of a
+## single-BAM run (readable by readCountFile) with its own column of the batch summary
+
+import os
+import gzip
+import pytest
+import countmatrix
+
+PROGRAM = '# Program:featureCounts v2.0.1; Command:"featureCounts" "-T" "2" "-s" "0" "-a" "genes.gtf" "-o" "batch_count.tab" "bam/S1.bam" "bam/S2.bam"\n'
+BATCH = PROGRAM + ''.join(['\t'.join(x) + '\n' for x in [
+    ['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length', 'bam/S1.bam', 'bam/S2.bam'],
+    ['ENSG1', '1;1', '101;301', '200;400', '+;+', '200', '12', '7'],
+    ['ENSG2', '1', '601', '900', '-', '300', '0', '31']]])
+SUMMARY = ''.join(['\t'.join(x) + '\n' for x in [
+    ['Status', 'bam/S1.bam', 'bam/S2.bam'],
+    ['Assigned', '12', '38'],
+    ['Unassigned_NoFeatures', '3', '5']]])
+
+
+
+@pytest.fixture
+def batch(tmp_path):
+    (tmp_path / 'batch_count.tab').write_text(BATCH)
+    (tmp_path / 'batch_count.tab.summary').write_text(SUMMARY)
+    return(str(tmp_path / 'batch_count.tab'))
+
+
+
+def test_split_batch(tmp_path, batch):
+    s1, s2 = str(tmp_path / 'S1_count.tab'), str(tmp_path / 'S2_count.tab')
+    assert countmatrix.splitBatch(batch, 'bam/S1.bam', s1) == s1
+    countmatrix.splitBatch(batch, 'bam/S2.bam', s2)
+    assert open(s2).read() == PROGRAM + 'Geneid\tChr\tStart\tEnd\tStrand\tLength\tbam/S2.bam\nENSG1\t1;1\t101;301\t200;400\t+;+\t200\t7\nENSG2\t1\t601\t900\t-\t300\t31\n'
+    assert list(countmatrix.readCountFile(s1)) == [('ENSG1', '200', ['12']), ('ENSG2', '300', ['0'])]
+    assert open(s1 + '.summary').read() == 'Status\tbam/S1.bam\nAssigned\t12\nUnassigned_NoFeatures\t3\n'
+    assert open(s2 + '.summary').read() == 'Status\tbam/S2.bam\nAssigned\t38\nUnassigned_NoFeatures\t5\n'
+
+
+
+def test_split_batch_unknown_bam(tmp_path, batch):
+    with pytest.raises(RuntimeError):
+        countmatrix.splitBatch(batch, 'bam/S3.bam', str(tmp_path / 'S3_count.tab'))
+    assert not (tmp_path / 'S3_count.tab').exists()
+
+
+
+## Incremental count matrix: every merge adds a cached block, and the partial blocks are rebuilt as full
+## ones once there are more than MAX_BLOCKS
+def test_merge_counts_compacts_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(countmatrix, 'MAX_OPEN_FILES', 2)
+    monkeypatch.setattr(countmatrix, 'MAX_BLOCKS', 3)
+    out, lengths, cache = str(tmp_path / 'matrix.tab.gz'), str(tmp_path / 'lengths.tab'), str(tmp_path / 'cache')
+    files = []
+    for i in range(1, 6):
+        files.append(str(tmp_path / ('S%s_count.tab' % i)))
+        with open(files[-1], 'w') as f:
+            f.write('Geneid\tChr\tStart\tEnd\tStrand\tLength\tbam/S%s.bam\nENSG1\t1\t1\t10\t+\t10\t%s\nENSG2\t1\t20\t40\t+\t21\t%s\n' % (i, i, 10 * i))
+        countmatrix.mergeCounts(files, out, lengths, cache_dir=cache, compresslevel=1)
+        blocks = os.listdir(os.path.join(cache, 'count_blocks'))
+        assert len(blocks) == [1, 2, 3, 2, 3][i-1]
+    with gzip.open(out, 'rt') as f:
+        assert f.read() == 'gene_id\tS1\tS2\tS3\tS4\tS5\nENSG1\t1\t2\t3\t4\t5\nENSG2\t10\t20\t30\t40\t50\n'
+
+
+
+## Genes come out sorted by ID (like the earlier Perl merger), not in GTF order, in the matrix, the gene
+## lengths and the .npy matrix alike
+def test_merge_counts_sorted(tmp_path):
+    numpy = pytest.importorskip('numpy')
+    files = []
+    for i in range(1, 3):
+        files.append(str(tmp_path / ('S%s_count.tab' % i)))
+        with open(files[-1], 'w') as f:
+            f.write('Geneid\tChr\tStart\tEnd\tStrand\tLength\tbam/S%s.bam\n' % (i))
+            [f.write('%s\t1\t1\t10\t+\t%s\t%s\n' % (g, n, n * i)) for g, n in [('ENSG9', 9), ('ENSG10', 10), ('ENSG2', 2)]]
+    out, lengths, npy = str(tmp_path / 'matrix.tab.gz'), str(tmp_path / 'lengths.tab'), str(tmp_path / 'matrix.npy')
+    countmatrix.mergeCounts(files, out, lengths, npy_file=npy, compresslevel=1)
+    with gzip.open(out, 'rt') as f:
+        assert f.read() == 'gene_id\tS1\tS2\nENSG10\t10\t20\nENSG2\t2\t4\nENSG9\t9\t18\n'
+    assert open(lengths).read() == 'Geneid Length\nENSG10 10\nENSG2 2\nENSG9 9\n'
+    assert numpy.load(npy).tolist() == [[10, 20], [2, 4], [9, 18]]
@@ -0,0 +1,40 @@
+## Log database summaries: processes recorded between refreshes are added to the existing per-rule/sample/run
+## rows (without an upsert, so SQLite 3.22 can run them), giving the same result as a rebuild from scratch
+
+import os
+import logsummary
+import sqlite
+
+
+
+def record(db, rule, sample, start, end, return_code=0):
+    sqlite.recordProcess(db, sample, 'cmd', start, end, return_code=return_code, rule=rule, threads=2)
+
+
+
+def test_refresh(tmp_path, monkeypatch):
+    monkeypatch.delenv('RSEQREP_RUN_ID', raising=False)
+    db = str(tmp_path / 'log.db')
+    sqlite.initSqliteDb(db)
+    sqlite.addSample(db, ['S1', 'S2'])
+    run = sqlite.startRun(db)
+    record(db, 'align', 'S1', 100, 110)
+    record(db, 'align', 'S2', 105, 125)
+    assert logsummary.refresh(db) == 2
+    record(db, 'align', 'S1', 130, 135, return_code=1)
+    record(db, 'count', 'S1', 140, 141)
+    assert logsummary.refresh(db) == 2
+    assert logsummary.refresh(db) == 0
+
+    rules = dict([(x['rule'], x) for x in logsummary.ruleSummary(db)])
+    assert [rules['align'][x] for x in ['jobs', 'failed', 'wc_time', 'thread_time']] == [3, 1, 35, 70]
+    assert rules['count']['jobs'] == 1
+    samples = dict([(x['sample_name'], x) for x in logsummary.sampleSummary(db)])
+    assert [samples['S1'][x] for x in ['jobs', 'wc_time', 'first_start', 'last_end']] == [3, 16, 100, 141]
+    runs = logsummary.runSummary(db)
+    assert [(x['run_id'], x['jobs'], x['first_start'], x['last_end']) for x in runs] == [(run, 4, 100, 141)]
+
+    ## Incremental refreshes match a rebuild
+    before = [logsummary.ruleSummary(db, False), logsummary.sampleSummary(db, refresh_first=False), logsummary.runSummary(db, refresh_first=False)]
+    logsummary.rebuild(db)
+    assert before == [logsummary.ruleSummary(db, False), logsummary.sampleSummary(db, refresh_first=False), logsummary.runSummary(db, refresh_first=False)]
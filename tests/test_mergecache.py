@@ -0,0 +1,48 @@
+## Incremental merged tables: an empty input writes the parser's fixed header, new samples are appended,
+## and an output that no longer matches the index (an interrupted append) is rewritten
+
+import os
+import mergecache
+
+HEADER = 'sample_id\tvalue'
+
+
+
+## Stand-in parser: one row per file, from its content
+def parse(files):
+    return(HEADER, dict([(f, [os.path.basename(f) + '\t' + open(f).read().strip()]) for f in files]))
+
+
+
+def sampleFile(tmp_path, name, value):
+    (tmp_path / name).write_text(value)
+    return(str(tmp_path / name))
+
+
+
+def test_merge_table_empty(tmp_path):
+    out = str(tmp_path / 'merged.tab')
+    mergecache.mergeTable([], out, parse, str(tmp_path / 'cache'))
+    assert open(out).read() == HEADER + '\n'
+
+
+
+def test_merge_table_append(tmp_path):
+    out, cache = str(tmp_path / 'merged.tab'), str(tmp_path / 'cache')
+    files = [sampleFile(tmp_path, 'S1', '1'), sampleFile(tmp_path, 'S2', '2')]
+    mergecache.mergeTable(files, out, parse, cache)
+    files.append(sampleFile(tmp_path, 'S3', '3'))
+    mergecache.mergeTable(files, out, parse, cache)
+    expected = HEADER + '\nS1\t1\nS2\t2\nS3\t3\n'
+    assert open(out).read() == expected
+
+    ## An append that was interrupted before its index was saved: the output is rewritten, not appended to
+    index = open(os.path.join(cache, 'merged.tab.json')).read()
+    files.append(sampleFile(tmp_path, 'S4', '4'))
+    mergecache.mergeTable(files, out, parse, cache)
+    with open(os.path.join(cache, 'merged.tab.json'), 'w') as f:
+        f.write(index)
+    with open(out, 'a') as f:
+        f.write('S5\t')
+    mergecache.mergeTable(files, out, parse, cache)
+    assert open(out).read() == expected + 'S4\t4\n'
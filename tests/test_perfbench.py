@@ -0,0 +1,61 @@
+## Pipeline benchmark: regressions are flagged only above both the relative threshold and the minimum change, and the
+## CSV/JSON exports round-trip; import benchmark: the timed helper modules follow the import lines of the Snakefile and rseqrep
+
+import csv
+import json
+import perfbench
+from conftest import SRCDIR
+
+BASELINE = {'align': {'processes': 2, 'wc_time': 100, 'cpu_time': 300, 'resident_set_size': 1000, 'io_read_bytes': 2**30, 'io_write_bytes': 2**20},
+            'count': {'processes': 2, 'wc_time': 4, 'cpu_time': 0, 'resident_set_size': 100, 'io_read_bytes': 0, 'io_write_bytes': 0}}
+SUMMARY = {'align': {'processes': 2, 'wc_time': 140, 'cpu_time': 320, 'resident_set_size': 1200, 'io_read_bytes': 2 * 2**30, 'io_write_bytes': 2 * 2**20},
+           'count': {'processes': 2, 'wc_time': 5.5, 'cpu_time': 3, 'resident_set_size': 100, 'io_read_bytes': 0, 'io_write_bytes': 0},
+           'new_rule': {'processes': 1, 'wc_time': 1000, 'cpu_time': 1000, 'resident_set_size': 1000, 'io_read_bytes': 0, 'io_write_bytes': 0}}
+
+
+
+def test_compare():
+    flagged = lambda res: sorted([(x['rule'], x['metric']) for x in res])
+
+    ## align wall time +40% and reads +100%; CPU time +7% and RSS +20% are under the threshold, writes +1MB under the minimum change;
+    ## count wall time +38% is under the minimum change, CPU time from 0 is flagged without a relative change; new rules have no baseline
+    res = perfbench.compare(SUMMARY, BASELINE)
+    assert flagged(res) == [('align', 'io_read_bytes'), ('align', 'wc_time'), ('count', 'cpu_time')]
+    assert [x['change'] for x in res if x['rule'] == 'align'] == [0.4, 1.0]
+    assert [x for x in res if x['rule'] == 'count'] == [{'rule': 'count', 'metric': 'cpu_time', 'baseline': 0, 'current': 3, 'change': None}]
+
+    assert flagged(perfbench.compare(SUMMARY, BASELINE, threshold=0.1)) == [('align', 'io_read_bytes'), ('align', 'resident_set_size'),
+                                                                            ('align', 'wc_time'), ('count', 'cpu_time')]
+    assert flagged(perfbench.compare(SUMMARY, BASELINE, threshold=1)) == [('count', 'cpu_time')]
+    assert perfbench.compare(BASELINE, BASELINE) == [] and perfbench.compare(BASELINE, SUMMARY) == []
+
+
+
+def test_write_summary(tmp_path):
+    csv_file, json_file = str(tmp_path / 'summary.csv'), str(tmp_path / 'summary.json')
+    perfbench.writeCsv(SUMMARY, csv_file)
+    with open(csv_file, newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['rule', 'processes'] + perfbench.METRICS
+    assert [x[0] for x in rows[1:]] == ['align', 'count', 'new_rule']
+    assert rows[2] == ['count', '2', '5.5', '3', '100', '0', '0']
+
+    ## Each benchmark keeps its own key in a shared baseline file, the regressions are those of the last write
+    regressions = perfbench.compare(SUMMARY, BASELINE)
+    perfbench.writeJson(BASELINE, json_file, key='rules')
+    perfbench.writeJson({'utils': {'wc_time': 0.1, 'heavy_modules': []}}, json_file, regressions, key='imports')
+    with open(json_file) as f:
+        res = json.load(f)
+    assert set(res) == set(['created', 'rules', 'imports', 'regressions']) and res['regressions'] == regressions
+    assert perfbench.readBaseline(json_file) == BASELINE
+    assert perfbench.readBaseline(json_file, key='imports') == {'utils': {'wc_time': 0.1, 'heavy_modules': []}}
+    assert perfbench.readBaseline(json_file, key='compression') == {}
+
+
+
+def test_import_modules():
+    modules = perfbench.importModules(SRCDIR)
+    assert set(['utils', 'sqlite', 'putfile', 'planner', 'manifest', 'scratch', 'sra', 'refcache', 'getfile', 'trimadapters', 'countmatrix',
+                'logsummary', 'configload']) <= set(modules)
+    assert len(modules) == len(set(modules))
+    assert 'snakemake' not in modules and 'logging' not in modules
@@ -0,0 +1,37 @@
+## Resource planner history: only the latest jobs of a rule are read, the processes of a fused job are added
+## up, and the processes of the current run are left out (its jobs must plan what the scheduler planned)
+
+import sqlite3
+import planner
+import sqlite
+
+
+
+def addJob(conn, rule, start, threads, cpu_time, run_id=None, stages=1):
+    for i in range(stages):
+        procid = conn.execute('INSERT INTO process (sample_id, rule, threads, start_time, end_time, wc_time, return_code, run_id) VALUES (1, ?, ?, ?, ?, 10, 0, ?)',
+                              (rule, threads, start, start + 10, run_id)).lastrowid
+        conn.execute('INSERT INTO benchmark (process_id, sample_id, cpu_time, wc_time, resident_set_size, return_code) VALUES (?, 1, ?, 10, 100, 0)', (procid, cpu_time))
+
+
+
+def test_load_history(tmp_path, monkeypatch):
+    db = str(tmp_path / 'log.db')
+    sqlite.initSqliteDb(db)
+    sqlite.addSample(db, 'S1')
+    conn = sqlite3.connect(db)
+    for i in range(planner.HISTORY_JOBS + 5):
+        addJob(conn, 'align', i, 2, 20, stages=2)
+    addJob(conn, 'align', 1000, 8, 80, run_id=5)
+    addJob(conn, 'sort', 0, 1, 5)
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setenv('RSEQREP_RUN_ID', '5')
+    history = planner.loadHistory(db, ['align', 'sort', 'count'])
+    assert [len(history[x]) for x in ['align', 'sort', 'count']] == [planner.HISTORY_JOBS, 1, 0]
+    assert history['align'][0] == {'sample': 'S1', 'threads': 2, 'input_bytes': 0, 'cpu_time': 40, 'wc_time': 10, 'rss': 200}
+    assert planner.ResourcePlanner(db, 16).threads('align', default=1) == 4
+
+    monkeypatch.delenv('RSEQREP_RUN_ID')
+    assert planner.loadHistory(db, ['align'])['align'][0]['threads'] == 8
@@ -0,0 +1,143 @@
+## Streamed encrypted uploads (file -> openssl -> aws s3 cp -) with a stand-in aws CLI writing the uploaded
+## stream to a local directory: the ciphertext decrypts to the file, and a failing openssl fails the upload
+## even though aws itself succeeds (on the empty stream it was given)
+
+import os
+import hashlib
+import sqlite3
+import subprocess
+import pytest
+import putfile
+import sqlite
+import transfer
+
+PASSWORD = 'secret'
+
+
+
+@pytest.fixture
+def s3(tmp_path, script, monkeypatch):
+    bucket = tmp_path / 'bucket'
+    bucket.mkdir()
+    monkeypatch.setattr(transfer, 'ENDPOINT_URL', '')
+    monkeypatch.setattr(transfer, 'TRANSFER_BACKOFF', 0)
+    aws = script(tmp_path / 'aws', '#!/bin/sh\n[ "$1 $2 $3" = "s3 cp -" ] || exit 2\ncat > "%s/$(basename "$4")"\n' % (bucket))
+    return(aws, bucket)
+
+
+
+def plainFile(tmp_path, size=100000):
+    file = tmp_path / 'reads.bam'
+    file.write_bytes(os.urandom(size))
+    return(str(file))
+
+
+
+def decrypt(file):
+    return(subprocess.run(['openssl', 'aes-256-cbc', '-d', '-md', 'md5', '-pass', 'pass:' + PASSWORD, '-in', str(file)], stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL, check=True).stdout)
+
+
+
+def test_stream_encrypted(tmp_path, s3):
+    aws, bucket = s3
+    file = plainFile(tmp_path)
+    plain, cipher = putfile.streamEncrypted(file, 's3://bucket/reads.bam.enc', aws, 'openssl', PASSWORD, 'md5')
+    uploaded = bucket / 'reads.bam.enc'
+    assert uploaded.stat().st_size == putfile.encryptedSize(os.path.getsize(file))
+    assert plain == hashlib.md5(open(file, 'rb').read()).hexdigest()
+    assert cipher == hashlib.md5(uploaded.read_bytes()).hexdigest()
+    assert decrypt(uploaded) == open(file, 'rb').read()
+
+
+
+def test_stream_encrypted_openssl_fails(tmp_path, s3, script):
+    aws, bucket = s3
+    openssl = script(tmp_path / 'openssl', '#!/bin/sh\nhead -c 100 > /dev/null\nexit 1\n')
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        putfile.streamEncrypted(plainFile(tmp_path), 's3://bucket/reads.bam.enc', aws, openssl, PASSWORD, 'md5')
+    assert e.value.returncode == 1 and 'aes-256-cbc' in e.value.cmd
+    assert (bucket / 'reads.bam.enc').stat().st_size == 0
+
+    ## Every attempt fails: the job fails instead of recording an archive
+    db = str(tmp_path / 'log.db')
+    sqlite.initSqliteDb(db)
+    with pytest.raises(SystemExit):
+        putfile.encryptUpload(plainFile(tmp_path), 's3://bucket', aws, openssl, PASSWORD, 'md5', db=db)
+    sqlite.flush(db)
+    conn = sqlite3.connect(db)
+    assert conn.execute('SELECT COUNT(*) FROM file WHERE archive_path IS NOT NULL').fetchone()[0] == 0
+    conn.close()
+
+
+
+## Background upload: the job continues while a detached uploader streams a hard link of the file; the archive
+## and both checksums are recorded once the upload is done and the staged link is removed
+def test_encrypt_upload_background(tmp_path, s3, monkeypatch):
+    aws, bucket = s3
+    monkeypatch.chdir(tmp_path)
+    file = os.path.basename(plainFile(tmp_path))
+    db = str(tmp_path / 'log.db')
+    sqlite.initSqliteDb(db)
+    putfile.archive(file, 's3://bucket', 'aws', aws, True, 'openssl', PASSWORD, 'md5', db=db, background=True)
+    putfile.waitForUploads()
+    sqlite.flush(db)
+    assert [x for x in sorted(os.listdir(tmp_path)) if not x.startswith('log.db')] == ['aws', 'bucket', 'progress', 'reads.bam']
+    assert os.listdir(putfile.UPLOAD_DIR) == []
+    assert decrypt(bucket / 'reads.bam.enc') == open(file, 'rb').read()
+    conn = sqlite3.connect(db)
+    row = conn.execute('SELECT file_checksum, archive_path, archive_checksum FROM file WHERE file_path = ?', (file, )).fetchone()
+    conn.close()
+    assert row == (hashlib.md5(open(file, 'rb').read()).hexdigest(), 's3://bucket/reads.bam.enc', hashlib.md5((bucket / 'reads.bam.enc').read_bytes()).hexdigest())
+
+
+
+## Plain background uploads run in a detached uploader process (jobs are separate processes, so the main
+## process only sees the upload records): the local file is removed only once the upload succeeded
+def backgroundUpload(tmp_path, script, monkeypatch, aws):
+    bucket = tmp_path / 'bucket'
+    bucket.mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(transfer, 'ENDPOINT_URL', '')
+    monkeypatch.setattr(transfer, 'TRANSFER_RETRIES', 1)
+    file = os.path.basename(plainFile(tmp_path))
+    data = open(file, 'rb').read()
+    putfile.upload(file, 's3://bucket', 'aws', script(tmp_path / 'aws', aws.format(bucket=bucket)), background=True)
+    return(file, data, bucket)
+
+
+
+def test_upload_background(tmp_path, script, monkeypatch):
+    file, data, bucket = backgroundUpload(tmp_path, script, monkeypatch, '#!/bin/sh\ncp "$3" "{bucket}/$(basename "$4")"\n')
+    putfile.waitForUploads()
+    assert (bucket / file).read_bytes() == data
+    assert sorted(os.listdir(tmp_path)) == ['aws', 'bucket', 'progress']
+    assert os.listdir(putfile.UPLOAD_DIR) == []
+
+
+
+def test_upload_background_fails(tmp_path, script, monkeypatch):
+    file, data, bucket = backgroundUpload(tmp_path, script, monkeypatch, '#!/bin/sh\nexit 1\n')
+    with pytest.raises(SystemExit):
+        putfile.waitForUploads()
+
+    ## The original and the staged copy are kept, and the failure is reported once
+    staged = [x for x in os.listdir(tmp_path) if x.startswith('.upload.')]
+    assert open(file, 'rb').read() == data and len(staged) == 1 and open(staged[0], 'rb').read() == data
+    assert sorted(x.split('.')[-1] for x in os.listdir(os.path.join(putfile.UPLOAD_DIR, 'failed'))) == ['failed', 'json', 'log', 'pid']
+    putfile.waitForUploads()
+
+
+
+def test_encrypt_upload_background_fails(tmp_path, s3, script, monkeypatch):
+    aws, bucket = s3
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(transfer, 'TRANSFER_RETRIES', 1)
+    file = os.path.basename(plainFile(tmp_path))
+    openssl = script(tmp_path / 'openssl', '#!/bin/sh\nexit 1\n')
+    putfile.archive(file, 's3://bucket', 'aws', aws, True, openssl, PASSWORD, 'md5', background=True)
+    with pytest.raises(SystemExit):
+        putfile.waitForUploads()
+    assert os.path.exists(file) and len([x for x in os.listdir(tmp_path) if x.startswith('.upload.')]) == 1
+    failed = os.path.join(putfile.UPLOAD_DIR, 'failed')
+    assert all([PASSWORD not in open(os.path.join(failed, x)).read() for x in os.listdir(failed)])
@@ -0,0 +1,40 @@
+## Reference index rules on a cache miss with the reference cache disabled (the default configuration):
+## the index is built by stand-in programs and the rule's output is recorded in the log database
+
+import os
+import sqlite3
+import subprocess
+import sys
+import pytest
+from conftest import SRCDIR
+
+pytest.importorskip('snakemake')
+perfbench = pytest.importorskip('perfbench')
+
+TARGETS = ['progress/hisat2_index_built.done', 'progress/bowtie2_index_built.done', 'progress/faidx.done']
+
+
+
+def test_index_rules_cache_disabled(tmp_path, script):
+    bin = tmp_path / 'bin'
+    bin.mkdir()
+    script(bin / 'hisat2-build', '#!/bin/sh\n[ "$1" = "--version" ] && { echo stub 1; exit 0; }\ntouch "$4.1.ht2"\n')
+    script(bin / 'hisat2_extract_splice_sites.py', '#!/bin/sh\necho "1\t100\t200\t+"\n')
+    script(bin / 'bowtie2-build', '#!/bin/sh\n[ "$1" = "--version" ] && { echo stub 1; exit 0; }\ntouch "$3.1.bt2"\n')
+    script(bin / 'samtools', '#!/bin/sh\n[ "$1" = "--version" ] && { echo stub 1; exit 0; }\ntouch "$2.fai"\n')
+
+    work = tmp_path / 'work'
+    perfbench.makeFixture(str(work), SRCDIR, samples=1, reads=10, programs={'hisat_prog': str(bin / 'hisat2'),
+                          'bowtie_prog': str(bin / 'bowtie2'), 'samtools_prog': str(bin / 'samtools')})
+    log_file = str(work / 'test.log')
+    res = subprocess.run([sys.executable, '-m', 'snakemake'] + TARGETS + ['-s', os.path.join(SRCDIR, 'snakemake', 'Snakefile.sh'), '-d', str(work), '--cores', '1',
+                          '--config', 'srcdir=' + SRCDIR, 'datadir=' + str(work / 'data'), 'log_level=INFO', 'log_file=' + log_file, 'ncores=1',
+                          'saveintlocalfiles=False'], capture_output=True, text=True)
+    assert res.returncode == 0, res.stderr[-3000:]
+    assert all([(work / x).exists() for x in TARGETS])
+    assert (work / 'index' / 'hisat2_genome_index.1.ht2').exists()
+
+    conn = sqlite3.connect(log_file + '.db')
+    rules = set([x[0] for x in conn.execute("SELECT p.rule FROM file f JOIN process p ON p.process_id = f.process_id WHERE f.file_path LIKE 'progress/%'")])
+    conn.close()
+    assert rules == set(['build_hisat_index', 'build_bowtie_index', 'faidx'])
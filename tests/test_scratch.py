@@ -0,0 +1,74 @@
+## Disk budget admission: slots from the projected sample footprints, and no admission chain through
+## samples whose final outputs already exist (a continued run must not recreate their temporary BAMs)
+
+import os
+import subprocess
+import sys
+import pytest
+import scratch
+from conftest import SRCDIR
+
+CHAIN = ['trimadapters', 'run_hisat']
+FINAL = ['rseqc/{sample}_bam_qc.txt', 'rseqc/{sample}_bam_gc.txt', 'rseqc/{sample}_bam_jc.txt', 'feature_counts/{sample}_count.tab']
+
+
+
+## Samples of 1 MB reads: footprint 1 + 1 (trimadapters) + 5 (run_hisat) = 7 MB
+def manager(tmp_path, samples, budget_mb):
+    files = {}
+    for s in samples:
+        files[s] = [str(tmp_path / ('%s.fastq.gz' % (s)))]
+        with open(files[s][0], 'wb') as f:
+            f.write(b'\0' * 1024 ** 2)
+    return(scratch.ScratchManager(db=str(tmp_path / 'none.db'), samples=files, chain=CHAIN, budget_mb=budget_mb))
+
+
+
+def test_admission_slots(tmp_path):
+    m = manager(tmp_path, ['A', 'B', 'C', 'D'], 15)
+    assert m.footprint('A') == 7 * 1024 ** 2
+    assert m.admission(['A', 'B', 'C', 'D']) == {'C': 'A', 'D': 'B'}
+    assert manager(tmp_path, ['A', 'B', 'C'], 1).admission(['A', 'B', 'C']) == {'B': 'A', 'C': 'B'}
+    assert manager(tmp_path, ['A', 'B'], 0).admission(['A', 'B']) == {}
+
+
+
+def test_pending_samples(tmp_path):
+    os.chdir(tmp_path)
+    os.makedirs('rseqc')
+    os.makedirs('feature_counts')
+    [open(x.format(sample='A'), 'w').close() for x in FINAL]
+    open(FINAL[0].format(sample='B'), 'w').close()
+    assert scratch.pendingSamples(['A', 'B', 'C'], FINAL) == ['B', 'C']
+
+
+
+## Jobs use the admission order saved at the start of their run, not one computed again
+def test_saved_admission(tmp_path):
+    file = str(tmp_path / 'log.admission.json')
+    scratch.saveAdmission(file, 7, {'C': 'A', 'D': 'B'})
+    assert scratch.loadAdmission(file, 7) == {'C': 'A', 'D': 'B'}
+    assert scratch.loadAdmission(file, 8) is None
+    assert scratch.loadAdmission(file, None) is None
+    assert scratch.loadAdmission(str(tmp_path / 'none.json'), 7) is None
+
+
+
+## Dry run of a continued run: the reference index and S1 are finished (its BAM, a temporary file, is gone), S2 and S3 are not and
+## the budget admits one sample at a time. No S1 job may be scheduled
+def test_resume_skips_finished_samples(tmp_path):
+    pytest.importorskip('snakemake')
+    perfbench = pytest.importorskip('perfbench')
+    work = tmp_path / 'work'
+    perfbench.makeFixture(str(work), SRCDIR, samples=3, reads=5000)
+    for x in ['progress/dirs.done', 'progress/hisat2_index_built.done'] + FINAL:
+        os.makedirs(os.path.dirname(str(work / x)), exist_ok=True)
+        open(str(work / x.format(sample='S1')), 'w').close()
+    log_file = str(work / 'test.log')
+    res = subprocess.run([sys.executable, '-m', 'snakemake', '-n', '-s', os.path.join(SRCDIR, 'snakemake', 'Snakefile.sh'), '-d', str(work),
+                          '--cores', '1', '--config', 'srcdir=' + SRCDIR, 'datadir=' + str(work / 'data'), 'log_level=INFO', 'log_file=' + log_file,
+                          'ncores=1', 'saveintlocalfiles=False', 'disk_mb=1'], capture_output=True, text=True)
+    assert res.returncode == 0, res.stderr[-3000:]
+    out = res.stdout + res.stderr
+    assert 'sample=S2' in out and 'progress/S2_scratch.released' in out
+    assert 'sample=S1' not in out and 'progress/S1_scratch.released' not in out
@@ -0,0 +1,96 @@
+## SRA prefetch queue with stand-in prefetch/fasterq-dump programs: only accessions still to be fetched are
+## queued, getfile jobs (separate processes) use the queue's downloads, and downloads that were never used
+## are removed when the queue stops
+
+import os
+import sys
+import gzip
+import time
+import subprocess
+import manifest
+import sra
+from conftest import SRCDIR
+
+FASTQ = '@r1\nACGT\n+\nIIII\n'
+
+
+
+def stubs(tmp_path, script, delay=0):
+    prefetch = script(tmp_path / 'prefetch', '#!/bin/sh\necho "$3" >> %s\nsleep %s\nmkdir -p "$2/$3"\necho "$3" > "$2/$3/$3.sra"\n' % (tmp_path / 'prefetch.log', delay))
+    dump = script(tmp_path / 'fasterq-dump', '#!/bin/sh\nprintf "%s"\n' % (FASTQ.replace('\n', '\\n')))
+    return(prefetch, dump)
+
+
+
+def sraFiles(dir):
+    return(sorted([f for d, s, files in os.walk(dir) for f in files if f.endswith('.sra')]))
+
+
+
+def wait(condition, timeout=20):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.05)
+    return(condition())
+
+
+
+def test_pending_accessions(tmp_path):
+    m = manifest.SampleManifest(['A', 'B', 'C'], ['SRR1', 'SRR2;SRR3', 's3://bucket/c.fastq.gz'], [''], ['NA'], ['NA'], paired=False)
+    os.chdir(tmp_path)
+    os.makedirs('input')
+    open('input/A_1.fastq.gz', 'w').close()
+    assert sra.pendingAccessions(m, ['A', 'B', 'C'], ['input/{sample}_1.fastq.gz']) == ['SRR2', 'SRR3']
+    assert sra.pendingAccessions(m, ['C'], ['input/{sample}_1.fastq.gz']) == []
+
+
+
+def test_stop_removes_untaken_downloads(tmp_path, script):
+    prefetch, dump = stubs(tmp_path, script)
+    sra_dir, out_dir = str(tmp_path / 'sra'), str(tmp_path / 'out')
+    os.makedirs(out_dir)
+    sra.startPrefetch(['SRR1', 'SRR2', 'SRR3'], sra_dir, prefetch_prog=prefetch, workers=2)
+    queue = sra._queue
+    try:
+        res = sra.fetch(['SRR1'], out_dir, dump, prefetch_prog=prefetch, sra_dir=sra_dir)
+        with gzip.open(res[0], 'rt') as f:
+            assert f.read() == FASTQ
+        assert wait(lambda: sraFiles(sra_dir) == ['SRR2.sra', 'SRR3.sra'])
+    finally:
+        sra.stopPrefetch()
+    assert wait(lambda: queue.running == 0 and sraFiles(sra_dir) == [])
+    assert queue.ready == {}
+
+
+
+def test_stop_removes_running_downloads(tmp_path, script):
+    prefetch, dump = stubs(tmp_path, script, delay=1)
+    sra_dir = str(tmp_path / 'sra')
+    sra.startPrefetch(['SRR1'], sra_dir, prefetch_prog=prefetch, workers=1)
+    queue = sra._queue
+    assert wait(lambda: queue.running == 1)
+    sra.stopPrefetch()
+    assert wait(lambda: queue.running == 0 and sraFiles(sra_dir) == [])
+    assert queue.ready == {}
+
+
+
+## A getfile job in its own process, like a snakemake job: it waits for the queue's running download of SRR1
+## instead of downloading it again, and downloads SRR2 itself, which the queue then skips
+def test_getfile_uses_prefetch_queue(tmp_path, script, monkeypatch):
+    prefetch, dump = stubs(tmp_path, script, delay=1)
+    monkeypatch.chdir(tmp_path)
+    sra.startPrefetch(['SRR1', 'SRR2'], sra.SRA_DIR, prefetch_prog=prefetch, workers=1)
+    queue = sra._queue
+    try:
+        assert wait(lambda: queue.running == 1)
+        code = 'import sys; sys.path.insert(0, %r); import getfile; getfile.downloadSRAFile(["SRR2", "SRR1"], %r, %r)' % (os.path.join(SRCDIR, 'python'), dump, prefetch)
+        subprocess.run([sys.executable, '-c', code], check=True)
+    finally:
+        sra.stopPrefetch()
+    for x in ['SRR1', 'SRR2']:
+        with gzip.open(x + '.fastq.gz', 'rt') as f:
+            assert f.read() == FASTQ
+    assert wait(lambda: queue.running == 0)
+    assert sorted(open('prefetch.log').read().split()) == ['SRR1', 'SRR2']
+    assert sraFiles(sra.SRA_DIR) == []
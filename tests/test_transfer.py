@@ -0,0 +1,45 @@
+## Transfer retries with exponential backoff against a stand-in aws CLI failing a given number of times
+
+import time
+import types
+import subprocess
+import pytest
+import transfer
+
+
+
+## Waits between attempts (recorded instead of slept; only the transfer module's clock is replaced)
+@pytest.fixture
+def sleeps(monkeypatch):
+    res = []
+    monkeypatch.setattr(transfer, 'time', types.SimpleNamespace(time=time.time, sleep=res.append))
+    return(res)
+
+
+
+## aws stand-in: fails the first <failures> calls, then copies src to dst (local paths under tmp_path/bucket)
+def aws(tmp_path, script, failures):
+    (tmp_path / 'bucket').mkdir()
+    return(script(tmp_path / 'aws', '#!/bin/sh\nn=$(cat "%s/calls" 2>/dev/null || echo 0)\necho $((n + 1)) > "%s/calls"\n[ "$n" -lt %s ] && exit 1\n'
+                  'cp "$3" "%s/$(basename "$4")"\n' % (tmp_path, tmp_path, failures, tmp_path / 'bucket')))
+
+
+
+def test_retry_then_succeed(tmp_path, script, sleeps):
+    prog = aws(tmp_path, script, 2)
+    (tmp_path / 'a.txt').write_text('a')
+    assert transfer.s3Copy([(str(tmp_path / 'a.txt'), 's3://bucket/a.txt')], prog=prog, endpoint_url='') == [str(tmp_path / 'a.txt')]
+    assert (tmp_path / 'bucket' / 'a.txt').read_text() == 'a'
+    assert (tmp_path / 'calls').read_text().strip() == '3'
+    assert sleeps == [transfer.TRANSFER_BACKOFF, 2 * transfer.TRANSFER_BACKOFF]
+
+
+
+def test_retries_exhausted(tmp_path, script, sleeps):
+    prog = aws(tmp_path, script, 3)
+    (tmp_path / 'a.txt').write_text('a')
+    with pytest.raises(subprocess.CalledProcessError):
+        transfer.s3Copy([(str(tmp_path / 'a.txt'), 's3://bucket/a.txt')], prog=prog, endpoint_url='')
+    assert (tmp_path / 'calls').read_text().strip() == '3'
+    assert sleeps == [transfer.TRANSFER_BACKOFF, 2 * transfer.TRANSFER_BACKOFF]
+    assert not (tmp_path / 'bucket' / 'a.txt').exists()
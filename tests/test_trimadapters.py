@@ -0,0 +1,175 @@
+## Sliding window quality trimmer of the fused adapter/quality trimming rule against the expected result of
+## Trimmomatic SE -phred33 SLIDINGWINDOW:4:20 on tests/data/trim_input.fastq. trim_expected_sw4_20.fastq was
+## derived by hand from Trimmomatic's SlidingWindowTrimmer, not produced by Trimmomatic (no Java here): reads
+## shorter than a window or failing their first window are dropped, the others are cut at the first window
+## averaging below 20 and then lose their trailing bases below 20
+## The fused rule (cutadapt --interleaved | trimmer) is also compared with the two-step rules (cutadapt, then
+## java -jar Trimmomatic), both run with stand-in programs
+
+import os
+import sys
+import gzip
+import random
+import subprocess
+import pytest
+import trimadapters
+from conftest import DATADIR
+
+INPUT = os.path.join(DATADIR, 'trim_input.fastq')
+EXPECTED = os.path.join(DATADIR, 'trim_expected_sw4_20.fastq')
+
+
+
+def records(file):
+    with open(file, 'rb') as f:
+        return([tuple(x) for x in trimadapters.readFastq(f)])
+
+
+
+def trimmed(file):
+    with gzip.open(file, 'rb') as f:
+        return([tuple(x) for x in trimadapters.readFastq(f)])
+
+
+
+def test_single_end_matches_trimmomatic(tmp_path):
+    out = str(tmp_path / 'out.fastq.gz')
+    with open(INPUT, 'rb') as f:
+        counts = trimadapters.qualityTrim(f, [out], window=4, quality=20)
+    assert trimmed(out) == records(EXPECTED)
+    assert counts[:2] == [10, 8]
+
+
+
+## The same reads as interleaved pairs: pairs with both mates left go to 1P/2P, single survivors to 1U/2U
+def test_paired_end_routing(tmp_path):
+    out = [str(tmp_path / ('%s.fastq.gz' % (x))) for x in ['1P', '1U', '2P', '2U']]
+    with open(INPUT, 'rb') as f:
+        counts = trimadapters.qualityTrim(f, out, window=4, quality=20, interleaved=True)
+    expected = dict([(x[0].split(b' ')[0], x) for x in records(EXPECTED)])
+    assert [trimmed(x) for x in out] == [[expected[x] for x in [b'@r5', b'@r7', b'@r9']], [expected[b'@r1']],
+                                         [expected[x] for x in [b'@r6', b'@r8', b'@r10']], [expected[b'@r4']]]
+    assert counts == [5, 3, 1, 1, 0]
+
+
+
+## Stand-in cutadapt: cuts reads at the first full occurrence of their 3' adapter (-a read 1, -A read 2) and
+## drops pairs with a read shorter than -m; writes -o/-p (gzipped for .gz), or interleaved pairs to stdout
+CUTADAPT = '''#!%s
+import sys, gzip
+args, adapters, outs, files, pairs = sys.argv[1:], {}, [], [], []
+minlen, interleaved, i = 0, False, 0
+while i < len(args):
+    if args[i] in ['-a', '-A', '-o', '-p', '-m', '-e', '-O', '--cores']:
+        adapters[args[i]], i = args[i+1], i + 2
+        outs += [adapters[args[i-2]]] if args[i-2] in ['-o', '-p'] else []
+    elif args[i].startswith('-'):
+        interleaved, i = interleaved or args[i] == '--interleaved', i + 1
+    else:
+        files, i = files + [args[i]], i + 1
+def reads(file):
+    lines = gzip.open(file, 'rt').read().split('\\n')
+    return([lines[j:j+4] for j in range(0, len(lines) - 1, 4)])
+def cut(r, adapter):
+    n = r[1].find(adapter)
+    return(r if n < 0 else [r[0], r[1][:n], r[2], r[3][:n]])
+mates = [reads(f) for f in files]
+res = [[cut(r, adapters[x]) for r in m] for m, x in zip(mates, ['-a', '-A'])]
+keep = [p for p in zip(*res) if min([len(r[1]) for r in p]) >= int(adapters['-m'])]
+text = lambda rs: ''.join([''.join([x + '\\n' for x in r]) for r in rs])
+if outs == ['-']:
+    sys.stdout.write(text([r for p in keep for r in p]))
+else:
+    [(gzip.open if f.endswith('.gz') else open)(f, 'wt').write(text([p[j] for p in keep])) for j, f in enumerate(outs)]
+''' % (sys.executable)
+
+## Stand-in java -jar trimmomatic.jar SE|PE -threads N <inputs> <outputs> SLIDINGWINDOW:<window>:<quality>
+## Written out literally (every window is averaged) rather than with the trimmer's running sum
+TRIMMOMATIC = '''#!%s
+import sys, gzip
+args = sys.argv[3:]
+window, quality = [int(x) for x in args[-1].split(':')[1:]]
+files = args[3:-1]
+n = 1 if args[0] == 'SE' else 2
+def reads(file):
+    lines = gzip.open(file, 'rt').read().split('\\n')
+    return([lines[j:j+4] for j in range(0, len(lines) - 1, 4)])
+def trim(r):
+    q = [ord(x) - 33 for x in r[3]]
+    keep = len(q)
+    for s in range(len(q) - window + 1):
+        if sum(q[s:s+window]) < window * quality:
+            keep = s + window - 1 if s > 0 else 0
+            break
+    if len(q) < window:
+        keep = 0
+    while keep > 0 and q[keep - 1] < quality:
+        keep -= 1
+    return([r[0], r[1][:keep], r[2], r[3][:keep]] if keep > 0 else None)
+res = [[trim(r) for r in reads(f)] for f in files[:n]]
+outs = [gzip.open(f, 'wt') for f in files[n:]]
+text = lambda r: ''.join([x + '\\n' for x in r])
+for p in zip(*res):
+    if n == 1:
+        [outs[0].write(text(p[0])) if p[0] else None]
+    elif p[0] and p[1]:
+        outs[0].write(text(p[0]))
+        outs[2].write(text(p[1]))
+    elif p[0] or p[1]:
+        outs[1 if p[0] else 3].write(text(p[0] or p[1]))
+[x.close() for x in outs]
+''' % (sys.executable)
+
+ADAPTERS = {'tp': 'AGATCGGAAGAGC', 'fp': 'CTGTCTCTTATAC'}
+
+
+
+## Reads of 60 bases, some with their adapter, some with a low quality start (dropped) or tail (trimmed)
+def randomReads(file, adapter, seed):
+    rng = random.Random(seed)
+    with gzip.open(file, 'wt') as f:
+        for i in range(60):
+            seq = ''.join([rng.choice('ACGT') for j in range(60)])
+            if rng.random() < 0.4:
+                n = rng.randrange(5, 50)
+                seq = (seq[:n] + adapter + seq)[:60]
+            qual, x = 'I' * 60, rng.random()
+            if x < 0.2:
+                qual = '#' * 4 + qual[4:]
+            elif x < 0.5:
+                n = rng.randrange(10, 55)
+                qual = qual[:n] + rng.choice('#+5') + rng.choice(['I', '#']) * (59 - n)
+            f.write('@p%s\n%s\n+\n%s\n' % (i, seq, qual))
+    return(file)
+
+
+
+def text(file):
+    with gzip.open(file, 'rt') as f:
+        return(f.read())
+
+
+
+@pytest.mark.parametrize('ends', [['1'], ['1', '2']])
+def test_fused_matches_two_steps(tmp_path, script, monkeypatch, ends):
+    bin = tmp_path / 'bin'
+    bin.mkdir()
+    cutadapt = script(bin / 'cutadapt', CUTADAPT)
+    script(bin / 'java', TRIMMOMATIC)
+    monkeypatch.setenv('PATH', str(bin) + os.pathsep + os.environ['PATH'])
+    infile = [randomReads(str(tmp_path / ('in_%s.fastq.gz' % (x))), ADAPTERS['tp' if x == '1' else 'fp'], int(x)) for x in ends]
+    adapt5 = ADAPTERS['fp'] if len(ends) == 2 else 'NA'
+    suffixes = ['P', 'U'] if len(ends) == 2 else ['']
+
+    ## Two steps: trimadapters, then qualityfilter's Trimmomatic command
+    cut = [str(tmp_path / ('cut_%s.fastq.gz' % (x))) for x in ends]
+    trimadapters.trimAdapters(cutadapt, infile, cut, adapt3=ADAPTERS['tp'], adapt5=adapt5)
+    two = [str(tmp_path / ('two_%s%s.fastq.gz' % (x, y))) for x in ends for y in suffixes]
+    subprocess.run('java -jar trimmomatic.jar %s -threads 1 %s %s SLIDINGWINDOW:4:20' % ('PE' if len(ends) == 2 else 'SE', ' '.join(cut), ' '.join(two)),
+                   shell=True, check=True)
+
+    ## Fused
+    fused = [str(tmp_path / ('fused_%s%s.fastq.gz' % (x, y))) for x in ends for y in suffixes]
+    trimadapters.trimAdaptersQuality(cutadapt, infile, fused, adapt3=ADAPTERS['tp'], adapt5=adapt5, quality=20, window=4)
+    assert [text(x) for x in fused] == [text(x) for x in two]
+    assert all([text(x) for x in fused])
@@ -0,0 +1,24 @@
+## Benchmarked process calls: the CPU time of short-lived children that exit between two resource samples is counted,
+## and a failing command still raises with its return code
+
+import sys
+import subprocess
+import pytest
+import utils
+
+BUSY = '%s -c "import time; t = time.process_time()\nwhile time.process_time() - t < 0.4: pass"' % (sys.executable)
+
+
+
+def test_logging_call_children_cpu():
+    pytest.importorskip('psutil')
+
+    ## Only the first sample is taken (before the children start), each child uses 0.4s of CPU
+    res = utils.logging_call(['sh', '-c', '%s; %s' % (BUSY, BUSY)], interval=60)
+    assert res.return_code == 0
+    assert res.cpu_seconds >= 0.7
+    assert res.running_time < 60
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        utils.logging_call(['sh', '-c', 'exit 3'], interval=60)
+    assert e.value.returncode == 3